@@ -1,5 +1,7 @@
+import mmap
 import os
 import stat
+import threading
 
 from andb.constants.values import MAX_OPEN_FILES
 from andb.common.replacement.lru import LRUCache
@@ -48,24 +50,38 @@ class SLRU(LRUCache):
 
 
 _FD_SLRU = SLRU()
+# sessions open files concurrently
+_FD_LOCK = threading.RLock()
 
 
 def file_open(filepath, flags, mode=FILE_MODE):
     """We use a simple LRU cache to avoid file descriptor leaks."""
-    fd = _FD_SLRU.get(filepath)
-    if fd:
+    with _FD_LOCK:
+        fd = _FD_SLRU.get(filepath)
+        if fd and flags & os.O_CREAT and not os.path.exists(filepath):
+            # the file was removed, don't write into the unlinked one
+            _FD_SLRU.pop(filepath)
+            fd.file_object.close()
+            fd = None
+        if fd:
+            return fd
+        fd = FileDescriptor(filepath, flags, mode)
+        _FD_SLRU.put(filepath, fd)
+        for evicted in _FD_SLRU.get_evicted_list():
+            evicted.close()
+        _FD_SLRU.get_evicted_list().clear()
         return fd
-    fd = FileDescriptor(filepath, flags, mode)
-    _FD_SLRU.put(filepath, fd)
-    for evicted in _FD_SLRU.get_evicted_list():
-        evicted.close()
-    _FD_SLRU.get_evicted_list().clear()
-    return fd
 
 
 def file_close(fd: FileDescriptor):
-    _FD_SLRU.pop(fd.filepath)
-    return fd.close()
+    with _FD_LOCK:
+        _FD_SLRU.pop(fd.filepath)
+        return fd.close()
+
+
+def _fileno(fd: FileDescriptor):
+    # go through the cache, the fd may have been evicted and closed
+    return file_open(fd.filepath, fd.flags, fd.mode).file_object.fileno()
 
 
 def file_write(fd: FileDescriptor, data: bytes, sync=False):
@@ -83,6 +99,12 @@ def file_read(fd: FileDescriptor, n):
     return fd.file_object.read(n)
 
 
+def file_readinto(fd: FileDescriptor, buffer):
+    """Read into a caller-provided buffer to avoid allocating a new bytes object."""
+    fd = _FD_SLRU.get(fd.filepath)
+    return fd.file_object.readinto(buffer)
+
+
 def file_lseek(fd: FileDescriptor, offset, whence=os.SEEK_SET):
     fd = _FD_SLRU.get(fd.filepath)
     return fd.file_object.seek(offset, whence)
@@ -94,10 +116,42 @@ def file_tell(fd: FileDescriptor):
 
 
 def file_size(fd: FileDescriptor):
-    old_position = file_tell(fd)
-    tail_position = file_lseek(fd, 0, os.SEEK_END)
-    file_lseek(fd, old_position, os.SEEK_SET)
-    return tail_position
+    # not seeking, the fd may be shared by threads
+    return os.fstat(_fileno(fd)).st_size
+
+
+# Positional I/O doesn't move the file position, so threads can share an fd
+# without a lock. Windows has no pread() and pwrite(), seek under a lock there.
+_SEEK_LOCK = threading.Lock()
+
+
+def file_pread(fd: FileDescriptor, n, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(_fileno(fd), n, offset)
+    with _SEEK_LOCK:
+        file_lseek(fd, offset)
+        return file_read(fd, n)
+
+
+def file_preadinto(fd: FileDescriptor, buffer, offset):
+    if hasattr(os, 'preadv'):
+        return os.preadv(_fileno(fd), [buffer], offset)
+    with _SEEK_LOCK:
+        file_lseek(fd, offset)
+        return file_readinto(fd, buffer)
+
+
+def file_pwrite(fd: FileDescriptor, data, offset, sync=False):
+    if hasattr(os, 'pwrite'):
+        n = os.pwrite(_fileno(fd), data, offset)
+        assert n == len(data)
+    else:
+        with _SEEK_LOCK:
+            file_lseek(fd, offset)
+            n = file_write(fd, data)
+    if sync:
+        os.fsync(_fileno(fd))
+    return n
 
 
 def file_extend(fd: FileDescriptor, size=1024):
@@ -109,6 +163,13 @@ def file_extend(fd: FileDescriptor, size=1024):
     return rv
 
 
+def aligned_buffer(size):
+    """Allocate a zero-filled buffer that starts at a memory page boundary.
+    Direct I/O requires the user buffer to be aligned, but bytes and bytearray
+    objects are not."""
+    return mmap.mmap(-1, size)
+
+
 def directio_file_open(filepath, flags, mode=FILE_MODE):
     if unix_like_env:
         flags |= os.O_DIRECT
@@ -120,6 +181,26 @@ def file_remove(fd: FileDescriptor):
     os.remove(fd.filepath)
 
 
+def _forget_fd(filepath):
+    with _FD_LOCK:
+        fd = _FD_SLRU.pop(filepath)
+        if fd:
+            fd.close()
+
+
+def file_rename(filepath, new_filepath):
+    """Rename a file, cached fds of both paths are closed first since they
+    would point to the wrong file after renaming."""
+    _forget_fd(filepath)
+    _forget_fd(new_filepath)
+    os.rename(filepath, new_filepath)
+
+
+def file_unlink(filepath):
+    _forget_fd(filepath)
+    os.remove(filepath)
+
+
 def file_touch(filepath, startup_size=0):
     fd = file_open(filepath, flags=os.O_RDWR | os.O_CREAT)
     if startup_size > 0:
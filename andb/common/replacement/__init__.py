@@ -1,3 +1,20 @@
 from .lru import LRUCache
+from .clock_sweep import ClockSweepCache
+from .two_queue import TwoQueueCache
+from .arc import ARCCache
 
-__all__ = ['LRUCache']
+REPLACEMENT_POLICIES = {
+    'lru': LRUCache,
+    'clock_sweep': ClockSweepCache,
+    '2q': TwoQueueCache,
+    'arc': ARCCache,
+}
+
+
+def create_cache(policy, capacity):
+    if policy not in REPLACEMENT_POLICIES:
+        raise ValueError(f'unknown replacement policy {policy}')
+    return REPLACEMENT_POLICIES[policy](capacity)
+
+
+__all__ = ['LRUCache', 'ClockSweepCache', 'TwoQueueCache', 'ARCCache', 'REPLACEMENT_POLICIES', 'create_cache']
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+
+from andb.common.replacement.base import BaseCache, CacheEntry
+from andb.errno.errors import BufferOverflow
+
+
+class ARCCache(BaseCache):
+    """Adaptive Replacement Cache (Megiddo and Modha, FAST'03).
+
+    `t1` holds keys seen once recently and `t2` holds keys seen at least twice,
+    both in LRU order. `b1` and `b2` are their ghost lists, which only keep
+    evicted keys. A hit in a ghost list tells which side should have been
+    bigger, so the target size `p` of `t1` is adjusted and ARC adapts between
+    recency and frequency by itself.
+
+    Pinned entries are skipped when looking for a victim, so `t1` may exceed
+    `p` for a while.
+    """
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.evicted = []
+
+    def clear(self):
+        self.p = 0
+        for d in (self.t1, self.t2, self.b1, self.b2):
+            d.clear()
+        self.evicted.clear()
+
+    def _find(self, key):
+        entry = self.t1.get(key)
+        if entry is None:
+            entry = self.t2.get(key)
+        return entry
+
+    def _promote(self, key):
+        entry = self.t1.pop(key, None)
+        if entry is not None:
+            self.t2[key] = entry
+        else:
+            self.t2.move_to_end(key)
+
+    def get(self, key):
+        entry = self._find(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._promote(key)
+        self.hits += 1
+        return entry.value
+
+    def put(self, key, value, pinned=False):
+        entry = self._find(key)
+        if entry is not None:
+            entry.value = value
+            entry.pinned = pinned
+            self._promote(key)
+            return
+
+        if key in self.b1:
+            # t1 was too small
+            delta = max(len(self.b2) // len(self.b1), 1)
+            self._replace(hit_in_b2=False, target=min(self.capacity, self.p + delta))
+            self.p = min(self.capacity, self.p + delta)
+            del self.b1[key]
+            self.t2[key] = CacheEntry(value, pinned)
+        elif key in self.b2:
+            # t2 was too small
+            delta = max(len(self.b1) // len(self.b2), 1)
+            self._replace(hit_in_b2=True, target=max(0, self.p - delta))
+            self.p = max(0, self.p - delta)
+            del self.b2[key]
+            self.t2[key] = CacheEntry(value, pinned)
+        else:
+            self._replace(hit_in_b2=False, target=self.p)
+            self.t1[key] = CacheEntry(value, pinned)
+        self._trim_ghosts()
+
+    def _replace(self, hit_in_b2, target):
+        if len(self.t1) + len(self.t2) < self.capacity:
+            return
+        if self.t1 and (len(self.t1) > target or (hit_in_b2 and len(self.t1) == target)):
+            candidates = ((self.t1, self.b1), (self.t2, self.b2))
+        else:
+            candidates = ((self.t2, self.b2), (self.t1, self.b1))
+        for queue, ghost in candidates:
+            for key, entry in queue.items():
+                if entry.pinned:
+                    continue
+                del queue[key]
+                ghost[key] = None
+                self.evicted.append(entry.value)
+                self.evictions += 1
+                return
+        raise BufferOverflow('All buffers are pinned, no room to put.')
+
+    def _trim_ghosts(self):
+        # keep |t1| + |b1| <= c and |t1| + |t2| + |b1| + |b2| <= 2c
+        while self.b1 and len(self.t1) + len(self.b1) > self.capacity:
+            self.b1.popitem(last=False)
+        while self.b2 and len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) > 2 * self.capacity:
+            self.b2.popitem(last=False)
+
+    def pop(self, key):
+        entry = self.t1.pop(key, None)
+        if entry is None:
+            entry = self.t2.pop(key, None)
+        self.b1.pop(key, None)
+        self.b2.pop(key, None)
+        return entry.value if entry is not None else None
+
+    def pin(self, key):
+        entry = self._find(key)
+        if entry is not None:
+            entry.pinned = True
+
+    def unpin(self, key):
+        entry = self._find(key)
+        if entry is not None:
+            entry.pinned = False
+
+    def is_pinned(self, key):
+        entry = self._find(key)
+        return entry is not None and entry.pinned
+
+    def get_evicted_list(self):
+        return self.evicted
+
+    def items(self):
+        for queue in (self.t1, self.t2):
+            for entry in list(queue.values()):
+                yield entry.value
+
+    def keys(self):
+        return list(self.t1.keys()) + list(self.t2.keys())
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
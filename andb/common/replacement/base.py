@@ -2,6 +2,10 @@ from abc import ABCMeta, abstractmethod
 
 
 class BaseCache(metaclass=ABCMeta):
+    """The interface of replacement policies. Evicted values are appended
+    to the evicted list, the owner should drain it (e.g., write dirty buffers
+    back) and clear it. Pinned entries are never evicted."""
+
     @abstractmethod
     def get(self, key):
         pass
@@ -10,7 +14,7 @@ class BaseCache(metaclass=ABCMeta):
     def put(self, key, value, pinned):
         pass
 
-    @staticmethod
+    @abstractmethod
     def pop(self, key):
         pass
 
@@ -22,9 +26,47 @@ class BaseCache(metaclass=ABCMeta):
     def unpin(self, key):
         pass
 
+    @abstractmethod
+    def is_pinned(self, key):
+        pass
+
     @abstractmethod
     def get_evicted_list(self):
         pass
 
+    @abstractmethod
+    def clear(self):
+        pass
+
+    @abstractmethod
+    def items(self):
+        pass
+
+    @abstractmethod
+    def keys(self):
+        pass
+
     def __init__(self, capacity):
         self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __iter__(self):
+        return self.items()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class CacheEntry:
+    __slots__ = ('value', 'pinned')
+
+    def __init__(self, value, pinned=False):
+        self.value = value
+        self.pinned = pinned
@@ -0,0 +1,119 @@
+from andb.common.replacement.base import BaseCache
+from andb.errno.errors import BufferOverflow
+
+# the same as BM_MAX_USAGE_COUNT of PostgreSQL
+MAX_USAGE_COUNT = 5
+
+
+class ClockSweepCache(BaseCache):
+    """The clock sweep algorithm that PostgreSQL uses for its buffer pool.
+
+    Each slot has a usage count, a hit increases it (up to `MAX_USAGE_COUNT`)
+    without moving anything. To find a victim, the clock hand goes around the
+    slots, skips pinned ones and decreases the usage count of the others until
+    it meets a zero. Hence, pages read only once by a large scan are evicted
+    before the frequently used ones.
+    """
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.slots = {}  # key -> slot index
+        self.slot_keys = [None] * capacity
+        self.slot_values = [None] * capacity
+        self.usage_counts = [0] * capacity
+        self.pinned = [False] * capacity
+        self.free_slots = list(reversed(range(capacity)))
+        self.hand = 0
+        self.evicted = []
+
+    def clear(self):
+        self.slots.clear()
+        self.slot_keys = [None] * self.capacity
+        self.slot_values = [None] * self.capacity
+        self.usage_counts = [0] * self.capacity
+        self.pinned = [False] * self.capacity
+        self.free_slots = list(reversed(range(self.capacity)))
+        self.hand = 0
+        self.evicted.clear()
+
+    def get(self, key):
+        idx = self.slots.get(key)
+        if idx is None:
+            self.misses += 1
+            return None
+        if self.usage_counts[idx] < MAX_USAGE_COUNT:
+            self.usage_counts[idx] += 1
+        self.hits += 1
+        return self.slot_values[idx]
+
+    def put(self, key, value, pinned=False):
+        idx = self.slots.get(key)
+        if idx is None:
+            idx = self.free_slots.pop() if self.free_slots else self._sweep()
+            self.slots[key] = idx
+            self.slot_keys[idx] = key
+            self.usage_counts[idx] = 1
+        elif self.usage_counts[idx] < MAX_USAGE_COUNT:
+            self.usage_counts[idx] += 1
+        self.slot_values[idx] = value
+        self.pinned[idx] = pinned
+
+    def _sweep(self):
+        # each round decreases usage counts by one, so this is enough
+        # to visit every slot with zero count
+        for _ in range(self.capacity * (MAX_USAGE_COUNT + 1)):
+            idx = self.hand
+            self.hand = (self.hand + 1) % self.capacity
+            if self.pinned[idx]:
+                continue
+            if self.usage_counts[idx] > 0:
+                self.usage_counts[idx] -= 1
+                continue
+            del self.slots[self.slot_keys[idx]]
+            self.evicted.append(self.slot_values[idx])
+            self.evictions += 1
+            self._reset_slot(idx)
+            return idx
+        raise BufferOverflow('All buffers are pinned, no room to put.')
+
+    def _reset_slot(self, idx):
+        self.slot_keys[idx] = None
+        self.slot_values[idx] = None
+        self.usage_counts[idx] = 0
+        self.pinned[idx] = False
+
+    def pop(self, key):
+        idx = self.slots.pop(key, None)
+        if idx is None:
+            return None
+        value = self.slot_values[idx]
+        self._reset_slot(idx)
+        self.free_slots.append(idx)
+        return value
+
+    def pin(self, key):
+        idx = self.slots.get(key)
+        if idx is not None:
+            self.pinned[idx] = True
+
+    def unpin(self, key):
+        idx = self.slots.get(key)
+        if idx is not None:
+            self.pinned[idx] = False
+
+    def is_pinned(self, key):
+        idx = self.slots.get(key)
+        return idx is not None and self.pinned[idx]
+
+    def get_evicted_list(self):
+        return self.evicted
+
+    def items(self):
+        for idx in list(self.slots.values()):
+            yield self.slot_values[idx]
+
+    def keys(self):
+        return self.slots.keys()
+
+    def __len__(self):
+        return len(self.slots)
@@ -44,7 +44,9 @@ class LRUCache(BaseCache):
             node = self.cache[key]
             self._remove(node)
             self._add(node)
+            self.hits += 1
             return node.value
+        self.misses += 1
         return None
 
     def put(self, key, value, pinned=False):
@@ -65,7 +67,8 @@ class LRUCache(BaseCache):
                 raise BufferOverflow('All buffers are pinned, no room to put.')
             self._remove(node)
             # add to evicted list
-            self.evicted.append(node)
+            self.evicted.append(node.value)
+            self.evictions += 1
             del self.cache[node.key]
 
     def pop(self, key):
@@ -86,6 +89,9 @@ class LRUCache(BaseCache):
             return
         self.cache[key].pinned = False
 
+    def is_pinned(self, key):
+        return key in self.cache and self.cache[key].pinned
+
     def get_evicted_list(self):
         return self.evicted
 
@@ -114,3 +120,6 @@ class LRUCache(BaseCache):
     def __iter__(self):
         return self.items()
 
+    def __len__(self):
+        return len(self.cache)
+
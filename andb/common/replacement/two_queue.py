@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+from andb.common.replacement.base import BaseCache, CacheEntry
+from andb.errno.errors import BufferOverflow
+
+
+class TwoQueueCache(BaseCache):
+    """The full version of 2Q (Johnson and Shasha, VLDB'94).
+
+    A new key goes into the FIFO queue `a1in` first. Keys evicted from `a1in`
+    are remembered (without values) in the ghost queue `a1out`, and only a key
+    that comes back while still in `a1out` is promoted to the LRU queue `am`.
+    So, pages touched once by a scan pass through `a1in` and never push out
+    the hot pages in `am`.
+    """
+
+    def __init__(self, capacity, kin_ratio=0.25, kout_ratio=0.5):
+        super().__init__(capacity)
+        self.kin = max(1, int(capacity * kin_ratio))
+        self.kout = max(1, int(capacity * kout_ratio))
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+        self.evicted = []
+
+    def clear(self):
+        self.a1in.clear()
+        self.a1out.clear()
+        self.am.clear()
+        self.evicted.clear()
+
+    def _find(self, key):
+        entry = self.am.get(key)
+        if entry is None:
+            entry = self.a1in.get(key)
+        return entry
+
+    def get(self, key):
+        entry = self.am.get(key)
+        if entry is not None:
+            self.am.move_to_end(key)
+        else:
+            # 2Q does not move entries within a1in on hit, as the
+            # correlated references should not count
+            entry = self.a1in.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.value
+
+    def put(self, key, value, pinned=False):
+        entry = self._find(key)
+        if entry is not None:
+            entry.value = value
+            entry.pinned = pinned
+            if key in self.am:
+                self.am.move_to_end(key)
+            return
+        if len(self.a1in) + len(self.am) >= self.capacity:
+            self._reclaim()
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = CacheEntry(value, pinned)
+        else:
+            self.a1in[key] = CacheEntry(value, pinned)
+
+    def _reclaim(self):
+        if len(self.a1in) > self.kin:
+            queues = (self.a1in, self.am)
+        else:
+            queues = (self.am, self.a1in)
+        for queue in queues:
+            for key, entry in queue.items():
+                if entry.pinned:
+                    continue
+                del queue[key]
+                if queue is self.a1in:
+                    self.a1out[key] = None
+                    if len(self.a1out) > self.kout:
+                        self.a1out.popitem(last=False)
+                self.evicted.append(entry.value)
+                self.evictions += 1
+                return
+        raise BufferOverflow('All buffers are pinned, no room to put.')
+
+    def pop(self, key):
+        entry = self.am.pop(key, None)
+        if entry is None:
+            entry = self.a1in.pop(key, None)
+        self.a1out.pop(key, None)
+        return entry.value if entry is not None else None
+
+    def pin(self, key):
+        entry = self._find(key)
+        if entry is not None:
+            entry.pinned = True
+
+    def unpin(self, key):
+        entry = self._find(key)
+        if entry is not None:
+            entry.pinned = False
+
+    def is_pinned(self, key):
+        entry = self._find(key)
+        return entry is not None and entry.pinned
+
+    def get_evicted_list(self):
+        return self.evicted
+
+    def items(self):
+        for queue in (self.a1in, self.am):
+            for entry in list(queue.values()):
+                yield entry.value
+
+    def keys(self):
+        return list(self.a1in.keys()) + list(self.am.keys())
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
@@ -140,16 +140,83 @@ class ConfigurationMgr(ConfigParser):
             ConfigOption(name='buffer_pool_size', value=1024, opttype=int, min_val=0, max_val=65535, enumvals=None,
                          context='reboot').set_side_effect_function(
                 get_side_effect_function('global', 'buffer_pool_size')),
+            ConfigOption(name='buffer_replacement_policy', value='lru', opttype=str,
+                         enumvals=('lru', 'clock_sweep', '2q', 'arc'),
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'buffer_replacement_policy')),
             ConfigOption(name='port', value=5678, opttype=int, min_val=1024, max_val=65535, enumvals=None,
-                         context='reboot'),
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'port')),
             ConfigOption(name='max_connections', value=1024, opttype=int, min_val=0, max_val=65535, enumvals=None,
-                         context='reload'),
+                         context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'max_connections')),
+            ConfigOption(name='session_workers', value=64, opttype=int, min_val=1, max_val=65535, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'session_workers')),
             ConfigOption(name='process_pool_size', value=0, opttype=int, min_val=0, max_val=2048, enumvals=None,
                          context='reboot'),
             ConfigOption(name='work_mem', value=1024, opttype=int, min_val=0, max_val=65535, enumvals=None,
                          context='reload'),
             ConfigOption(name='max_dirty_page_pct', value=90, opttype=int, min_val=0, max_val=100, enumvals=None,
-                         context='reboot'),
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'max_dirty_page_pct')),
+            ConfigOption(name='bgwriter_delay', value=200, opttype=int, min_val=10, max_val=10000, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'bgwriter_delay')),
+            ConfigOption(name='bgwriter_max_pages', value=100, opttype=int, min_val=1, max_val=65535, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'bgwriter_max_pages')),
+            ConfigOption(name='checkpoint_timeout', value=300, opttype=int, min_val=0, max_val=86400, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'checkpoint_timeout')),
+            ConfigOption(name='checkpoint_target_duration', value=30, opttype=int, min_val=0, max_val=86400,
+                         enumvals=None, context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'checkpoint_target_duration')),
+            ConfigOption(name='commit_delay', value=0, opttype=int, min_val=0, max_val=100000, enumvals=None,
+                         context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'commit_delay')),
+            ConfigOption(name='commit_siblings', value=5, opttype=int, min_val=0, max_val=1000, enumvals=None,
+                         context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'commit_siblings')),
+            ConfigOption(name='recovery_workers', value=4, opttype=int, min_val=1, max_val=64, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'recovery_workers')),
+            ConfigOption(name='synchronous_commit', value='on', opttype=str, enumvals=('on', 'off'),
+                         context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'synchronous_commit')),
+            ConfigOption(name='wal_writer_delay', value=200, opttype=int, min_val=1, max_val=10000, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'wal_writer_delay')),
+            ConfigOption(name='wal_writer_flush_after', value=1024, opttype=int, min_val=0, max_val=1048576,
+                         enumvals=None, context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'wal_writer_flush_after')),
+            ConfigOption(name='wal_prealloc_segments', value=2, opttype=int, min_val=0, max_val=64, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'wal_prealloc_segments')),
+            ConfigOption(name='wal_prealloc_delay', value=1000, opttype=int, min_val=10, max_val=60000,
+                         enumvals=None, context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'wal_prealloc_delay')),
+            ConfigOption(name='wal_recycle_segments', value=4, opttype=int, min_val=0, max_val=1024,
+                         enumvals=None, context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'wal_recycle_segments')),
+            ConfigOption(name='commit_mode', value='force', opttype=str, enumvals=('force', 'no_force'),
+                         context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'commit_mode')),
+            ConfigOption(name='autovacuum', value=1, opttype=int, min_val=0, max_val=1, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'autovacuum')),
+            ConfigOption(name='autovacuum_naptime', value=10, opttype=int, min_val=1, max_val=86400, enumvals=None,
+                         context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'autovacuum_naptime')),
+            ConfigOption(name='autovacuum_vacuum_threshold', value=50, opttype=int, min_val=1, max_val=2147483647,
+                         enumvals=None, context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'autovacuum_vacuum_threshold')),
+            ConfigOption(name='lock_timeout', value=0, opttype=int, min_val=0, max_val=2147483647,
+                         enumvals=None, context='reload').set_side_effect_function(
+                get_side_effect_function('global', 'lock_timeout')),
+            ConfigOption(name='deadlock_timeout', value=1000, opttype=int, min_val=1, max_val=2147483647,
+                         enumvals=None, context='reboot').set_side_effect_function(
+                get_side_effect_function('global', 'deadlock_timeout')),
         ]
         for config_opt in defaults:
             key = config_opt.name
@@ -3,3 +3,8 @@ DUMMY_XID = 1  # for select
 FIRST_XID = 2
 XID_SIZE = 8
 MAX_XID = 0xffffffffffffffff  # 8 bytes
+
+# states of a session's transaction block
+TBLOCK_DEFAULT = 0  # not in a transaction block, every statement commits itself
+TBLOCK_INPROGRESS = 1
+TBLOCK_FAILED = 2  # aborted by an error, waiting for COMMIT or ROLLBACK
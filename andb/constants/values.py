@@ -1,6 +1,7 @@
 PAGE_SIZE = 8 * 1024  # 8kb
 WAL_SEGMENT_SIZE = 16 * 1024 * 1024  # 16MB
 WAL_PAGE_SIZE = 8 * 1024
+UNDO_SEGMENT_SIZE = 1024 * 1024  # 1MB
 
 MAX_OPEN_FILES = 1024
 
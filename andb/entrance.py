@@ -1,57 +1,125 @@
-from andb.constants.macros import INVALID_XID
-from andb.constants.values import QUERY_TERMINATOR
-from andb.sql.parser import andb_query_parse, get_ast_type, CmdType
+import time
+
+from andb.constants.macros import INVALID_XID, TBLOCK_DEFAULT, TBLOCK_INPROGRESS, TBLOCK_FAILED
+from andb.sql.parser import andb_query_parse, andb_query_split, get_ast_type, CmdType
+from andb.sql.parser.ast.utility import TransactionStmt
 from andb.sql.optimizer import andb_query_plan
-from andb.executor.portal import ExecutionPortal
-from andb.runtime import global_vars
-from andb.constants.macros import DUMMY_XID
+from andb.executor.portal import ExecutionPortal, ExecutionResult
+from andb.runtime import global_vars, session_vars
 from andb.errno.errors import RollbackError, FatalError
 
 
 def tell_session(errno, message):
+    messages = session_vars.SessionVars.messages
+    if messages is not None:
+        # sent back to the client along with the result
+        messages.append((errno, message))
+        return
     #TODO: not using print
     print(errno, message)
 
 
 def execute_simple_query(query_string):
-    queries = query_string.split(QUERY_TERMINATOR)
-    if '' in queries:
-        queries.remove('')
-    assert len(queries) == 1
-    query = queries[0]
-    ast = andb_query_parse(query)
-    plan_tree = andb_query_plan(ast)
-    portal = ExecutionPortal(query, get_ast_type(ast), plan_tree)
-    xid = DUMMY_XID  # for select
-    if portal.cmd_type in (
-            CmdType.CMD_INSERT, CmdType.CMD_DELETE, CmdType.CMD_UPDATE
-    ):
-        xid = global_vars.xact_manager.allocate_xid()
+    """Run the statements of `query_string` one after another and return
+    the result of the last one. A statement out of a transaction block
+    commits itself, and a failed statement stops the rest."""
+    result = None
+    for query in andb_query_split(query_string):
+        if not query.strip():
+            continue
+        result = execute_statement(query)
+        if result is None:
+            break
+    return result
+
+
+def execute_transaction_statement(ast):
+    start_time = time.monotonic()
+    xact_manager = global_vars.xact_manager
+    warning = None
+    if ast.action == TransactionStmt.BEGIN:
+        if xact_manager.begin_transaction_block() == INVALID_XID:
+            warning = 'there is already a transaction in progress'
+    else:
+        state = xact_manager.transaction_block_state()
+        if state == TBLOCK_DEFAULT:
+            warning = 'there is no transaction in progress'
+        elif state == TBLOCK_FAILED and ast.action == TransactionStmt.COMMIT:
+            warning = 'the transaction has been rolled back'
+        xact_manager.end_transaction_block(commit=ast.action == TransactionStmt.COMMIT)
+    return ExecutionResult(warning=warning, elapsed=time.monotonic() - start_time)
+
+
+def execute_statement(query):
+    xact_manager = global_vars.xact_manager
+    block_state = xact_manager.transaction_block_state()
+    in_block = block_state != TBLOCK_DEFAULT
+    try:
+        ast = andb_query_parse(query)
+        cmd_type = get_ast_type(ast)
+        if cmd_type == CmdType.CMD_TRANSACTION:
+            return execute_transaction_statement(ast)
+        if block_state == TBLOCK_FAILED:
+            tell_session(1, 'current transaction is aborted, commands ignored until end of transaction block')
+            return
+        plan_tree = andb_query_plan(ast)
+    except Exception as e:
+        # an invalid statement fails the transaction block as well
+        if xact_manager.transaction_block_state() == TBLOCK_INPROGRESS:
+            xact_manager.fail_transaction_block()
+        raise e
+
+    portal = ExecutionPortal(query, cmd_type, plan_tree)
+    if in_block:
+        if portal.cmd_type == CmdType.CMD_UTILITY:
+            # DDL creates and removes files, which cannot be rolled back
+            xact_manager.fail_transaction_block()
+            tell_session(1, 'DDL cannot run inside a transaction block')
+            return
+        xid = xact_manager.get_xid()
+    elif portal.cmd_type in (CmdType.CMD_SELECT, CmdType.CMD_EXPLAIN):
+        # read-only, no need to pay for WAL, undo and buffer sync
+        xid = xact_manager.begin_read_only_transaction()
+    else:
+        # utilities get an xid of their own as well, a shared one would be
+        # ended by whichever session finishes first
+        xid = xact_manager.allocate_xid()
         if xid == INVALID_XID:
             tell_session(0, 'cannot get xid')
             return
-    global_vars.xact_manager.begin_transaction(xid)
+        xact_manager.begin_transaction(xid)
 
+    # each statement sees the transactions committed before it starts
+    xact_manager.take_snapshot()
     try:
         portal.xid = xid
         portal.initialize()
         portal.execute()
         portal.finalize()
     except RollbackError as e:
-        global_vars.xact_manager.abort_transaction(xid)
+        # the whole transaction block is rolled back
+        if in_block:
+            xact_manager.fail_transaction_block()
+        else:
+            xact_manager.abort_transaction(xid)
         tell_session(e.errno, e.msg)
+        return
     except FatalError as e:
         # non-rollbackable error
         raise e
     except Exception as e:
         #TODO: all failure transactions should be aborted
-        global_vars.xact_manager.abort_transaction(xid)
+        if in_block:
+            xact_manager.fail_transaction_block()
+        else:
+            xact_manager.abort_transaction(xid)
         raise e
     else:
-        global_vars.xact_manager.commit_transaction(xid)
+        if not in_block:
+            xact_manager.commit_transaction(xid)
+    finally:
+        xact_manager.release_snapshot()
 
     #TODO: add error information into result as well
     # and use a protocol to parse and serialize the result
     return portal.results()
-
-
@@ -1,8 +1,7 @@
 from andb.catalog.syscache import CATALOG_ANDB_INDEX
 from andb.errno.errors import InitializationStageError
 from andb.storage.engines.heap.bptree import TuplePointer
-from andb.storage.engines.heap.relation import hot_simple_delete, bt_delete, hot_simple_select, open_relation, \
-    close_relation
+from andb.storage.engines.heap.relation import hot_simple_delete, hot_simple_select, open_relation, close_relation
 from andb.storage.lock import rlock
 from andb.executor.operator.physical.select import Scan
 from andb.catalog.oid import INVALID_OID
@@ -51,12 +50,9 @@ class DeletePhysicalOperator(PhysicalOperator):
     def next(self):
         for tuple_ in self.scan.next():
             pageno, tid = self.scan.get_cursor()
-            # delete both heap table and indexes
+            # index entries stay for older snapshots, vacuum removes them
+            # together with the deleted tuple
             hot_simple_delete(self.relation, pageno, tid)
-            for index_relation in self.index_relations:
-                index_forms = self.index_relations[index_relation]
-                key = [tuple_[form.attr_num] for form in index_forms]
-                bt_delete(index_relation, key)
             yield
 
     def close(self):
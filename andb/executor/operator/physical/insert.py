@@ -1,12 +1,16 @@
 from andb.catalog.syscache import CATALOG_ANDB_INDEX
 from andb.errno.errors import InitializationStageError
 from andb.storage.engines.heap.bptree import TuplePointer
-from andb.storage.engines.heap.relation import hot_simple_insert, bt_simple_insert, open_relation, close_relation
+from andb.storage.engines.heap.relation import hot_simple_insert, hot_multi_insert, bt_simple_insert, open_relation, \
+    close_relation
 from andb.storage.lock import rlock
 from .base import PhysicalOperator
 
 
 class InsertPhysicalOperator(PhysicalOperator):
+    # rows of INSERT ... SELECT are inserted in batches of this size
+    BATCH_SIZE = 1000
+
     def __init__(self, table_oid, python_tuples=None, select=None):
         super().__init__('Insert')
         self.startup_cost = 0
@@ -20,6 +24,8 @@ class InsertPhysicalOperator(PhysicalOperator):
         self.index_relations = None
         self.select = select
         self.python_tuples = python_tuples
+        if select is not None:
+            self.add_child(select)
 
     def get_args(self):
         return ('table_name', self.relation.name), ('table_oid', self.table_oid) + super().get_args()
@@ -40,13 +46,32 @@ class InsertPhysicalOperator(PhysicalOperator):
                 self.index_relations[relation] = []
             self.index_relations[relation].append(form)
 
+        if self.select is not None:
+            self.select.open()
+
     def next(self):
-        if not self.python_tuples:
-            #TODO: fetch tuples from select clause
-            pass
+        if not self.python_tuples and self.select is not None:
+            # insert the rows of the select clause batch by batch
+            batch = []
+            for python_tuple in self.select.next():
+                batch.append(tuple(python_tuple))
+                if len(batch) >= self.BATCH_SIZE:
+                    yield from self._insert(batch)
+                    batch = []
+            yield from self._insert(batch)
+            return
+
+        yield from self._insert(self.python_tuples)
 
-        for python_tuple in self.python_tuples:
-            pageno, tid = hot_simple_insert(self.relation, python_tuple=python_tuple)
+    def _insert(self, python_tuples):
+        if not python_tuples:
+            return
+        if len(python_tuples) == 1:
+            locations = [hot_simple_insert(self.relation, python_tuple=python_tuples[0])]
+        else:
+            # one WAL record per page rather than per tuple
+            locations = hot_multi_insert(self.relation, python_tuples)
+        for python_tuple, (pageno, tid) in zip(python_tuples, locations):
             for relation, form_array in self.index_relations.items():
                 key = [python_tuple[form.attr_num] for form in form_array]
                 bt_simple_insert(relation, key=key, tuple_pointer=TuplePointer(pageno, tid))
@@ -57,5 +82,7 @@ class InsertPhysicalOperator(PhysicalOperator):
         close_relation(self.table_oid, rlock.ROW_EXCLUSIVE_LOCK)
         for relation in self.index_relations:
             close_relation(relation.oid, rlock.ROW_EXCLUSIVE_LOCK)
+        if self.select is not None:
+            self.select.close()
 
         super().close()
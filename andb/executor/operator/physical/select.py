@@ -2,7 +2,8 @@ from andb.sql.parser.ast.operation import Function
 from andb.storage.engines.heap.relation import close_relation, open_relation
 from andb.storage.lock import rlock
 from andb.errno.errors import InitializationStageError, ExecutionStageError, FinalizationStageError
-from andb.storage.engines.heap.relation import hot_simple_select, bt_search_range, bt_search, bt_scan_all_keys
+from andb.storage.engines.heap.relation import hot_simple_select, bt_search_range, bt_search, bt_scan_all_keys, \
+    hot_page_decode
 from andb.catalog.syscache import CATALOG_ANDB_ATTRIBUTE, CATALOG_ANDB_INDEX, CATALOG_ANDB_FUNCTIONS, get_all_catalogs
 from andb.runtime import global_vars, session_vars
 from andb.sql.parser.ast.misc import Constant, Star
@@ -203,6 +204,8 @@ class Scan(PhysicalOperator):
         self.relation = None
         self.base_table_relation = None
         self.lock = lock
+        # tuple versions that the scan sees
+        self.snapshot = None
         self._pageno = 0
         self._tid = 0
 
@@ -219,6 +222,7 @@ class Scan(PhysicalOperator):
         self.base_table_relation = open_relation(self.base_table_oid, self.lock)
         if not self.relation:
             raise InitializationStageError(f'cannot open relation {self.relation_oid}.')
+        self.snapshot = global_vars.xact_manager.get_snapshot()
 
         attr_form_array = CATALOG_ANDB_ATTRIBUTE.get_table_forms(self.base_table_oid)
         self.projection_attr_idx = []
@@ -323,10 +327,16 @@ class IndexScan(Scan):
         return combinations
 
     def fetch_tuple(self, key):
+        key_codec = self.relation.codec.prefix(len(key))
+        key_data = key_codec.encode(key)
         for pointer in bt_search(self.relation, key=key):
-            tuple_ = hot_simple_select(self.base_table_relation, pointer.pageno, pointer.tid)
+            tuple_ = hot_simple_select(self.base_table_relation, pointer.pageno, pointer.tid,
+                                       self.snapshot)
             self.set_cursor(pointer.pageno, pointer.tid)
-            if tuple_:
+            # entries of old versions are kept until vacuum, so the visible
+            # version may have another key, recheck it
+            if tuple_ and key_codec.encode(
+                    [tuple_[form.attr_num] for form in self.index_forms[:len(key)]]) == key_data:
                 yield tuple_
 
     def next_internal(self):
@@ -376,15 +386,46 @@ class CoveredIndexScan(IndexScan):
             for tuple_ in super().next_internal():
                 yield tuple_
         else:
-            # index only scan
-            for tuple_ in bt_scan_all_keys(self.relation):
-                yield tuple_
+            # keys of invisible tuples are in the index as well, a key is
+            # returned for each visible tuple
+            for key in bt_scan_all_keys(self.relation):
+                for _ in self.fetch_tuple(list(key)):
+                    yield key
 
 
 class TableScan(Scan):
     def __init__(self, relation_oid, columns, filter_: Filter = None, lock=rlock.ACCESS_SHARE_LOCK):
         super().__init__(relation_oid, columns, filter_, lock)
         self.name = 'TableScan'
+        # attributes decoded from heap tuples, None means all
+        self.decode_attr_idx = None
+
+    def open(self):
+        super().open()
+        self._prune_decoded_columns()
+
+    def _prune_decoded_columns(self):
+        # only decode the columns used by the projection and the filter, then
+        # re-map both of them onto the positions of the decoded tuple.
+        attr_form_array = self.base_table_relation.attrs
+        name_to_num = {attr_form.name: attr_form.num for attr_form in attr_form_array}
+        needed = set(self.projection_attr_idx)
+        if self._filter:
+            for column in self._filter.column_condition:
+                if column.column_name not in name_to_num:
+                    return
+                needed.add(name_to_num[column.column_name])
+        if not needed or len(needed) == len(attr_form_array):
+            return
+
+        self.decode_attr_idx = sorted(needed)
+        position = {num: i for i, num in enumerate(self.decode_attr_idx)}
+        self.projection_attr_idx = [position[num] for num in self.projection_attr_idx]
+        if self._filter:
+            self._filter.set_tuple_columns(
+                [TableColumn(self.base_table_relation.name, attr_form_array[num].name)
+                 for num in self.decode_attr_idx]
+            )
 
     def get_args(self):
         if self._filter:
@@ -394,14 +435,16 @@ class TableScan(Scan):
 
     def next_internal(self):
         for pageno in range(0, self.relation.last_pageno() + 1):
-            buffer_page = global_vars.buffer_manager.get_page(self.relation, pageno)
-            global_vars.buffer_manager.pin_page(buffer_page)
-            for tid in range(0, len(buffer_page.page.item_ids)):
-                tuple_ = hot_simple_select(self.relation, pageno, tid)
-                self.set_cursor(pageno, tid)
-                if tuple_:
-                    yield tuple_
-            global_vars.buffer_manager.unpin_page(buffer_page)
+            buffer_page = global_vars.buffer_manager.get_page(self.relation, pageno, pin=True)
+            try:
+                for tid, tuple_ in hot_page_decode(self.relation, buffer_page, self.decode_attr_idx,
+                                                  self.snapshot):
+                    self.set_cursor(pageno, tid)
+                    if tuple_:
+                        yield tuple_
+            finally:
+                # pins are counted, the scan may stop early
+                global_vars.buffer_manager.unpin_page(buffer_page)
 
 
 class SystemTableScan(TableScan):
@@ -409,6 +452,10 @@ class SystemTableScan(TableScan):
         super().__init__(relation_oid, columns, filter_, lock)
         self.name = 'SystemTableScan'
 
+    def _prune_decoded_columns(self):
+        # catalog rows are python tuples already, nothing to decode
+        pass
+
     def next_internal(self):
         for catalog_table in get_all_catalogs():
             if catalog_table.__oid__ == self.relation_oid:
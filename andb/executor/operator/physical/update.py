@@ -1,8 +1,7 @@
 from andb.catalog.syscache import CATALOG_ANDB_INDEX
 from andb.errno.errors import InitializationStageError
 from andb.storage.engines.heap.bptree import TuplePointer
-from andb.storage.engines.heap.relation import bt_update, hot_simple_update, open_relation, close_relation, bt_delete, \
-    bt_simple_insert
+from andb.storage.engines.heap.relation import hot_simple_update, open_relation, close_relation, bt_simple_insert
 from andb.storage.lock import rlock
 from andb.executor.operator.physical.select import Scan
 from andb.catalog.oid import INVALID_OID
@@ -31,9 +30,9 @@ class UpdatePhysicalOperator(PhysicalOperator):
         self.attr_num_value_pair = attr_num_value_pair
 
     def _need_to_modify_key(self, index_attrs):
-        for table_attr in self.attr_num_value_pair:
+        for attr_num in self.attr_num_value_pair:
             for index_attr in index_attrs:
-                if table_attr.num == index_attr.attr_num:
+                if attr_num == index_attr.attr_num:
                     return True
         return False
 
@@ -71,17 +70,21 @@ class UpdatePhysicalOperator(PhysicalOperator):
             new_tuple = list(tuple_)
             for attr_num, new_value in self.attr_num_value_pair.items():
                 new_tuple[attr_num] = new_value
-            new_pageno, new_tid = hot_simple_update(relation=self.relation, pageno=pageno, tid=tid,
-                                                    python_tuple=new_tuple)
-            new_tuple_pointer = TuplePointer(new_pageno, new_tid)
-            for index_relation in self.index_relations:
-                index_forms = self.index_relations[index_relation]
-
-                key = [tuple_[form.attr_num] for form in index_forms]
-                if index_relation not in self.modify_index_relations:
-                    bt_update(index_relation, key, new_tuple_pointer)
-                else:
-                    bt_delete(index_relation, key)
+            location = hot_simple_update(relation=self.relation, pageno=pageno, tid=tid,
+                                         python_tuple=new_tuple,
+                                         heap_only=not self.modify_index_relations)
+            if location is None:
+                # the tuple is gone or the transaction has deleted it
+                # itself, skip it as delete does
+                continue
+            new_pageno, new_tid = location
+            # heap-only update keeps the tuple pointer and the keys
+            if (new_pageno, new_tid) != (pageno, tid):
+                new_tuple_pointer = TuplePointer(new_pageno, new_tid)
+                # the old entries stay for older snapshots, vacuum removes
+                # them together with the old version
+                for index_relation in self.index_relations:
+                    index_forms = self.index_relations[index_relation]
                     new_key = [new_tuple[form.attr_num] for form in index_forms]
                     bt_simple_insert(index_relation, new_key, new_tuple_pointer)
             yield
@@ -27,6 +27,28 @@ def init_shared_resource():
     pass
 
 
+def init_background_workers():
+    # import here since it depends on the storage engine
+    from andb.storage.engines.heap.autovacuum import start_autovacuum, stop_autovacuum
+    from andb.storage.buffer.bgwriter import start_bgwriter, stop_bgwriter
+    from andb.storage.engines.heap.walwriter import start_walwriter, stop_walwriter
+    from andb.storage.engines.heap.walsegment import start_wal_preallocator, stop_wal_preallocator
+    from andb.storage.lock.deadlock import start_deadlock_detector, stop_deadlock_detector
+
+    stop_autovacuum()
+    stop_bgwriter()
+    stop_walwriter()
+    stop_wal_preallocator()
+    stop_deadlock_detector()
+    start_walwriter()
+    if global_vars.wal_prealloc_segments > 0:
+        start_wal_preallocator()
+    start_bgwriter()
+    start_deadlock_detector()
+    if global_vars.autovacuum:
+        start_autovacuum()
+
+
 def init_logger():
     pass
 
@@ -60,4 +82,4 @@ def init_all_database_components(database_dir=None):
     init_storage()
     init_catalog()
     global_vars.xact_manager.recovery()
-
+    init_background_workers()
@@ -0,0 +1,69 @@
+import socket
+
+from andb.net.protocol import ProtocolError, recv_message, send_message
+
+
+class ClientError(Exception):
+    def __init__(self, msg, messages=None):
+        super().__init__(msg)
+        self.msg = msg
+        self.messages = messages or []
+
+
+class QueryResult:
+    def __init__(self, result, messages):
+        result = result or {}
+        self.success = result.get('success', False)
+        self.notice = result.get('notice')
+        self.warning = result.get('warning')
+        self.effect_rows = result.get('effect_rows', 0)
+        self.elapsed = result.get('elapsed', 0)
+        self.fields = result.get('fields', [])
+        self.rows = [tuple(row) for row in result.get('rows', [])]
+        # (errno, message) the server told during the query
+        self.messages = [tuple(m) for m in messages]
+        # None means the statement was refused, see messages
+        self.empty = not result
+
+    def __repr__(self):
+        return f'QueryResult(effect_rows={self.effect_rows}, fields={self.fields}, rows={self.rows})'
+
+
+class Connection:
+    """A session on the server. Queries of a connection run one by one,
+    use a connection per thread to run them concurrently."""
+
+    def __init__(self, host, port, timeout=None):
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        greeting = self._recv()
+        if not greeting.get('ok'):
+            self.close()
+            raise ClientError(greeting.get('error', 'connection refused'))
+
+    def _recv(self):
+        message = recv_message(self._sock)
+        if message is None:
+            raise ProtocolError('server closed the connection.')
+        return message
+
+    def execute(self, query):
+        send_message(self._sock, {'query': query})
+        response = self._recv()
+        if not response.get('ok'):
+            raise ClientError(response.get('error'), response.get('messages'))
+        return QueryResult(response.get('result'), response.get('messages', []))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def connect(host='127.0.0.1', port=5678, timeout=None):
+    return Connection(host, port, timeout)
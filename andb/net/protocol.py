@@ -0,0 +1,63 @@
+import json
+import struct
+
+from andb.executor.portal import ExecuteResultSet
+
+# each message is a JSON object encoded in UTF-8 with a 4-byte length ahead
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_message(sock, message):
+    payload = json.dumps(message, default=str).encode('utf-8')
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'message is too large ({len(payload)} bytes).')
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    """Return the next message, or None if the peer has closed the connection."""
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'message is too large ({size} bytes).')
+    payload = _recv_exactly(sock, size)
+    if payload is None:
+        raise ProtocolError('connection closed in the middle of a message.')
+    try:
+        return json.loads(payload.decode('utf-8'))
+    except ValueError as e:
+        raise ProtocolError(f'invalid message: {e}')
+
+
+def result_to_message(result):
+    if result is None:
+        return None
+    message = {
+        'success': result.success,
+        'notice': result.notice,
+        'warning': result.warning,
+        'effect_rows': result.effect_rows,
+        'elapsed': result.elapsed,
+    }
+    if isinstance(result, ExecuteResultSet):
+        message['fields'] = [attr_form.name for attr_form in result.attr_forms]
+        message['rows'] = [list(t) for t in result.tuples]
+    return message
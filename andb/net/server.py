@@ -0,0 +1,175 @@
+import argparse
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from andb.constants.macros import TBLOCK_DEFAULT
+from andb.entrance import execute_simple_query
+from andb.errno.errors import FatalError
+from andb.net.protocol import ProtocolError, recv_message, result_to_message, send_message
+from andb.runtime import global_vars, session_vars
+
+
+class SessionServer:
+    """Serves each client connection as a session on a thread of the pool.
+    A session keeps its thread until the client goes away, so its
+    `SessionVars` (transaction block, snapshot...) and the locks it holds
+    stay with it between queries.
+
+    The pool has `workers` threads. Connections beyond that are accepted but
+    queued, their clients wait for the greeting until a session ends.
+    Connections beyond `max_connections` are refused."""
+
+    def __init__(self, host='127.0.0.1', port=None, max_connections=None, workers=None):
+        if port is None:
+            port = global_vars.port
+        if max_connections is None:
+            max_connections = global_vars.max_connections
+        if workers is None:
+            workers = global_vars.session_workers
+        self.max_connections = max_connections
+        self.workers = max(min(workers, max_connections), 1)
+        self.listener = socket.create_server((host, port))
+        self.address = self.listener.getsockname()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='session')
+        self._sessions = set()
+        self._sessions_lock = threading.Lock()
+        self._stopping = False
+        self._accept_thread = threading.Thread(target=self._accept_loop, name='session server', daemon=True)
+
+    def start(self):
+        self._accept_thread.start()
+        logging.info(f'listening on {self.address[0]}:{self.address[1]}')
+        return self
+
+    def active_sessions(self):
+        with self._sessions_lock:
+            return len(self._sessions)
+
+    def _accept_loop(self):
+        while not self._stopping:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                break
+            with self._sessions_lock:
+                accepted = len(self._sessions) < self.max_connections
+                if accepted:
+                    self._sessions.add(conn)
+            if not accepted:
+                try:
+                    send_message(conn, {'ok': False, 'error': 'too many connections'})
+                except OSError:
+                    pass
+                conn.close()
+                continue
+            self._pool.submit(self._serve_session, conn)
+
+    def _serve_session(self, conn):
+        session = session_vars.SessionVars
+        # pooled threads are reused, start from a clean session
+        session.reset()
+        session.messages = []
+        try:
+            send_message(conn, {'ok': True})
+            while True:
+                request = recv_message(conn)
+                if request is None:
+                    break
+                send_message(conn, self._execute(request))
+        except (OSError, ProtocolError) as e:
+            if not self._stopping:
+                logging.warning(f'session closed: {e}')
+        except Exception as e:
+            logging.error(f'session failed: {e}')
+        finally:
+            # an unfinished transaction block is rolled back
+            try:
+                xact_manager = global_vars.xact_manager
+                if xact_manager.transaction_block_state() != TBLOCK_DEFAULT:
+                    xact_manager.end_transaction_block(commit=False)
+            except Exception as e:
+                logging.error(f'cannot roll back the transaction block of the session: {e}')
+            session.reset()
+            with self._sessions_lock:
+                self._sessions.discard(conn)
+            conn.close()
+
+    @staticmethod
+    def _execute(request):
+        messages = session_vars.SessionVars.messages
+        messages.clear()
+        query = request.get('query') if isinstance(request, dict) else None
+        if not isinstance(query, str):
+            return {'ok': False, 'error': 'query is required', 'messages': []}
+        try:
+            result = execute_simple_query(query)
+        except FatalError:
+            raise
+        except Exception as e:
+            return {'ok': False, 'error': str(e), 'messages': list(messages)}
+        return {'ok': True, 'result': result_to_message(result), 'messages': list(messages)}
+
+    def stop(self):
+        self._stopping = True
+        # closing the listener does not wake up accept() on every platform
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        with self._sessions_lock:
+            sessions = list(self._sessions)
+        for conn in sessions:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._accept_thread.join()
+        self._pool.shutdown(wait=True)
+
+
+def start_session_server(host='127.0.0.1', port=None, max_connections=None, workers=None):
+    if global_vars.session_server is not None:
+        return global_vars.session_server
+    server = SessionServer(host, port, max_connections, workers).start()
+    global_vars.session_server = server
+    return server
+
+
+def stop_session_server():
+    if global_vars.session_server is None:
+        return
+    global_vars.session_server.stop()
+    global_vars.session_server = None
+
+
+def main():
+    from andb.cmd.setup import setup_data_dir
+    from andb.initializer import init_all_database_components
+
+    parser = argparse.ArgumentParser(description='AnDB session server')
+    parser.add_argument('--datadir', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=global_vars.port)
+    parser.add_argument('--max-connections', type=int, default=global_vars.max_connections)
+    parser.add_argument('--workers', type=int, default=global_vars.session_workers)
+    args = parser.parse_args()
+
+    datadir = os.path.realpath(args.datadir)
+    if not os.path.exists(datadir):
+        setup_data_dir(datadir)
+    init_all_database_components(datadir)
+    server = start_session_server(args.host, args.port, args.max_connections, args.workers)
+    try:
+        server._accept_thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_session_server()
+
+
+if __name__ == '__main__':
+    main()
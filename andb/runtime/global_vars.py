@@ -5,9 +5,39 @@ import platform
 
 database_directory = None
 buffer_pool_size = 512
+buffer_replacement_policy = 'lru'
+max_dirty_page_pct = 90
+bgwriter_delay = 200  # in milliseconds
+bgwriter_max_pages = 100  # written in each round
+checkpoint_timeout = 300  # in seconds, 0 means no checkpoint by bgwriter
+checkpoint_target_duration = 30  # in seconds, for a spread checkpoint
 wal_buffer_size = 10
+recovery_workers = 4  # threads to replay WAL in parallel
+commit_delay = 0  # in microseconds, wait before a group flush
+commit_siblings = 5  # committers needed to wait commit_delay
+synchronous_commit = 'on'  # 'off' returns from commit before the WAL is flushed
+wal_writer_delay = 200  # in milliseconds
+wal_writer_flush_after = 1024  # in KB, wake up the WAL writer
+wal_prealloc_segments = 2  # zero-filled segments kept ahead of the current one
+wal_prealloc_delay = 1000  # in milliseconds
+wal_recycle_segments = 4  # obsolete segments kept for reuse besides the preallocated ones
+commit_mode = 'force'  # or 'no_force', which leaves dirty pages to bgwriter and checkpoint
+autovacuum = 1
+autovacuum_naptime = 10  # in seconds
+autovacuum_vacuum_threshold = 50  # dead items of a relation
+lock_timeout = 0  # in milliseconds, 0 means waiting for a relation lock until it is granted
+deadlock_timeout = 1000  # in milliseconds, how often to check for deadlocks
+port = 5678
+max_connections = 1024  # client connections accepted at the same time
+session_workers = 64  # threads serving sessions, the other connections wait for one
 
 unix_like_env = (platform.uname().system != 'Windows' and platform.uname().system != 'Darwin')
 
 buffer_manager: 'BufferManager' = None
 xact_manager = None
+autovacuum_worker = None
+bgwriter_worker = None
+walwriter_worker = None
+deadlock_detector_worker = None
+wal_preallocator_worker = None
+session_server = None
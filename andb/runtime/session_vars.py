@@ -1,9 +1,26 @@
 from threading import local
 
 from andb.catalog.oid import OID_DATABASE_ANDB
-from andb.constants.macros import INVALID_XID
+from andb.constants.macros import INVALID_XID, TBLOCK_DEFAULT
 
-class SessionVars(local):
-    database_oid = OID_DATABASE_ANDB
-    session_xid = INVALID_XID
 
+class _SessionVars(local):
+    """Variables of the session served by the current thread. Each thread
+    sees its own copy, starting from the defaults below."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.database_oid = OID_DATABASE_ANDB
+        self.session_xid = INVALID_XID
+        self.transaction_block = TBLOCK_DEFAULT
+        # None means following the global one
+        self.synchronous_commit = None
+        # snapshot of the running statement
+        self.snapshot = None
+        # (errno, message) told to the client, None means printing them
+        self.messages = None
+
+
+SessionVars = _SessionVars()
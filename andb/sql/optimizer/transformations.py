@@ -472,7 +472,7 @@ class InsertTransformation(BaseTransformation):
             raise InitializationStageError(f'cannot get the table {ast.table.parts}.')
 
         rows = []
-        for value in ast.values:
+        for value in ast.values or ():
             row = [None for _ in range(len(attr_forms))]
             if isinstance(value, Constant):
                 row[0] = value.value
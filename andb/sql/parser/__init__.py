@@ -1,13 +1,16 @@
+import threading
 from enum import Enum
 
 from andb.sql.parser.ast import drop
 
 from .parser_ import SQLParser
 from .lexer import SQLLexer
-from .ast import select, delete, insert, update, create, explain, alter
+from .ast import select, delete, insert, update, create, explain, alter, utility
 
 andb_lexer = SQLLexer()
 andb_parser = SQLParser()
+# the lexer and parser keep the parsing state in themselves
+_parse_lock = threading.Lock()
 
 
 class CmdType(Enum):
@@ -18,10 +21,34 @@ class CmdType(Enum):
     CMD_UTILITY = 4
     CMD_EXPLAIN = 5
     CMD_UNDEFINED = 6
+    CMD_TRANSACTION = 7
+
+
+class _StatementLexer(SQLLexer):
+    tokens = SQLLexer.tokens
+
+    def error(self, t):
+        # only looking for the end of statements, the parser reports errors
+        self.index += 1
+
+
+def andb_query_split(query):
+    """Split `query` into statements at semicolons, but not those in string
+    literals or comments."""
+    statements = []
+    start = 0
+    # a lexer of its own, tokenizing keeps the state in the lexer
+    for token in _StatementLexer().tokenize(query):
+        if token.type == 'SEMICOLON':
+            statements.append(query[start: token.index])
+            start = token.index + 1
+    statements.append(query[start:])
+    return statements
 
 
 def andb_query_parse(query):
-    return andb_parser.parse(andb_lexer.tokenize(query))
+    with _parse_lock:
+        return andb_parser.parse(andb_lexer.tokenize(query))
 
 
 def get_ast_type(ast_):
@@ -43,6 +70,8 @@ def get_ast_type(ast_):
         return CmdType.CMD_UTILITY
     elif isinstance(ast_, explain.Explain):
         return CmdType.CMD_EXPLAIN
+    elif isinstance(ast_, utility.TransactionStmt):
+        return CmdType.CMD_TRANSACTION
 
     else:
         return CmdType.CMD_UNDEFINED
@@ -4,4 +4,13 @@ class Command(ASTNode):
     def __init__(self, command: str, *args, **kwargs):
         super().__init__(*args, **kwargs) 
         self.command = command
-    
\ No newline at end of file
+
+
+class TransactionStmt(ASTNode):
+    BEGIN = 'BEGIN'
+    COMMIT = 'COMMIT'
+    ROLLBACK = 'ROLLBACK'
+
+    def __init__(self, action: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.action = action
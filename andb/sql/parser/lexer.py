@@ -32,7 +32,7 @@ class SQLLexer(sly.Lexer):
         UPDATE, SET,
 
         # PUNCTUATION
-        DOT, COMMA, LPAREN, RPAREN, PARAMETER,
+        DOT, COMMA, LPAREN, RPAREN, PARAMETER, SEMICOLON,
 
         # OPERATORS
         PLUS, MINUS, DIVIDE, MODULO,
@@ -46,7 +46,10 @@ class SQLLexer(sly.Lexer):
         CAST,
 
         # COMMANDS
-        CHECKPOINT
+        CHECKPOINT,
+
+        # TRANSACTION CONTROL
+        BEGIN, START_TRANSACTION, COMMIT, ROLLBACK
     }
 
     CREATE = 'CREATE'
@@ -95,11 +98,16 @@ class SQLLexer(sly.Lexer):
     INTO = 'INTO'
     VALUES = 'VALUES'
     CHECKPOINT = 'CHECKPOINT'
+    BEGIN = r'\bBEGIN\b'
+    START_TRANSACTION = r'\bSTART[\s]+TRANSACTION\b'
+    COMMIT = r'\bCOMMIT\b'
+    ROLLBACK = r'\bROLLBACK\b'
 
     DOT = r'\.'
     COMMA = r','
     LPAREN = r'\('
     RPAREN = r'\)'
+    SEMICOLON = r';'
 
     PLUS = r'\+'
     MINUS = r'-'
@@ -17,7 +17,7 @@ from .ast.identifier import Identifier
 from .ast.misc import Constant, Star, Tuple
 from .exception import ParsingException
 from .ast.drop import DropTable, DropIndex
-from .ast.utility import Command
+from .ast.utility import Command, TransactionStmt
 
 
 def check_select_keywords(select, operation):
@@ -85,6 +85,7 @@ class SQLParser(sly.Parser):
         'update',
         'drop',
         'command',
+        'transaction',
     )
     def query(self, p):
         return p[0]
@@ -572,6 +573,19 @@ class SQLParser(sly.Parser):
     def command(self, p):
         return Command(command=p[0])
 
+    # transaction blocks
+    @_('BEGIN', 'START_TRANSACTION')
+    def transaction(self, p):
+        return TransactionStmt(action=TransactionStmt.BEGIN)
+
+    @_('COMMIT', 'END')
+    def transaction(self, p):
+        return TransactionStmt(action=TransactionStmt.COMMIT)
+
+    @_('ROLLBACK')
+    def transaction(self, p):
+        return TransactionStmt(action=TransactionStmt.ROLLBACK)
+
     # Add new rules for function calls
     @_('identifier LPAREN expr_list RPAREN')
     def expr(self, p):
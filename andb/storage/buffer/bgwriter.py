@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+from andb.runtime import global_vars
+
+
+class BackgroundWriter(threading.Thread):
+    """Writes dirty pages in the background, so that foreground queries rarely
+    write pages themselves when evicting them.
+
+    Every `delay` seconds, if dirty pages take more than `max_dirty_page_pct`
+    percent of the buffer pool, it writes at most `max_pages` pages, the oldest
+    change (smallest LSN) first. It also runs a spread checkpoint every
+    `checkpoint_timeout` seconds, and removes undo segments and old tuple
+    versions that no running transaction or snapshot needs."""
+
+    def __init__(self, delay, max_pages, checkpoint_timeout=0):
+        super().__init__(name='bgwriter', daemon=True)
+        self.delay = delay
+        self.max_pages = max_pages
+        self.checkpoint_timeout = checkpoint_timeout
+        self.last_checkpoint_time = time.monotonic()
+        self.written_pages = 0
+        self.checkpoints = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.delay):
+            try:
+                self.write_once()
+                global_vars.xact_manager.undo_manager.truncate()
+                global_vars.xact_manager.undo_manager.prune_versions(global_vars.xact_manager.oldest_xmin())
+                if (self.checkpoint_timeout > 0 and
+                        time.monotonic() - self.last_checkpoint_time >= self.checkpoint_timeout):
+                    global_vars.xact_manager.checkpoint(spread=True)
+                    self.last_checkpoint_time = time.monotonic()
+                    self.checkpoints += 1
+            except Exception as e:
+                logging.error(f'bgwriter failed: {e}')
+
+    def write_once(self):
+        buffer_manager = global_vars.buffer_manager
+        max_dirty_pages = global_vars.buffer_pool_size * global_vars.max_dirty_page_pct // 100
+        excess = buffer_manager.dirty_page_count() - max_dirty_pages
+        if excess <= 0:
+            return 0
+        written = buffer_manager.flush_pages(
+            buffer_manager.get_oldest_dirty_pages(min(excess, self.max_pages)))
+        self.written_pages += written
+        return written
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def start_bgwriter():
+    if global_vars.bgwriter_worker is not None:
+        return global_vars.bgwriter_worker
+    worker = BackgroundWriter(delay=global_vars.bgwriter_delay / 1000,
+                              max_pages=global_vars.bgwriter_max_pages,
+                              checkpoint_timeout=global_vars.checkpoint_timeout)
+    worker.start()
+    global_vars.bgwriter_worker = worker
+    return worker
+
+
+def stop_bgwriter():
+    if global_vars.bgwriter_worker is None:
+        return
+    global_vars.bgwriter_worker.stop()
+    global_vars.bgwriter_worker = None
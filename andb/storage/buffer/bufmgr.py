@@ -1,15 +1,19 @@
 import logging
-from andb.common.file_operation import file_size, file_write, file_read, file_lseek
-from andb.common.replacement.lru import LRUCache
+import threading
+import time
+from andb.common.file_operation import file_size, file_pread, file_preadinto, file_pwrite, aligned_buffer
+from andb.common.replacement import create_cache
 from andb.common.utils import get_the_nearest_two_power_number, pageno_to_filesize
 from andb.constants.values import PAGE_SIZE
 from andb.runtime import global_vars
 from andb.storage.engines.heap.page import SlotPage
 from andb.storage.engines.heap.bptree import BPlusTree, create_node
+from andb.storage.engines.heap.fsm import get_fsm
 from andb.storage.engines.heap.relation import RelationKinds
-from andb.storage.lock.lwlock import LWLockName, lwlock_acquire, lwlock_release
+from andb.storage.lock.lwlock import SharedExclusiveLatch
 
 SIXTEEN_MB = 1024 * 1024 * 16
+NUM_BUFFER_PARTITIONS = 16
 
 
 def get_next_allocation_size(v, upper=SIXTEEN_MB):
@@ -26,6 +30,14 @@ class BufferPage:
         self._page = None
         self.pageno = pageno
         self._dirty = False
+        # held exclusively while the page content is being changed or
+        # reorganized, e.g., by a foreground modification or autovacuum, and
+        # shared while it is being read or written out
+        self.content_lock = SharedExclusiveLatch()
+        # only one thread writes the page out at a time
+        self.io_lock = threading.Lock()
+        # changed under the lock of the buffer partition, see `BufferManager.pin_page()`
+        self.pin_count = 0
 
     def set_page(self, page):
         self._page = page
@@ -41,15 +53,31 @@ class BufferPage:
 
     @property
     def data(self):
-        if not self._page_data:
-            self._page_data = self._page.pack()
-        return self._page_data
+        if self._page is None:
+            return self._page_data
+        if isinstance(self._page, SlotPage):
+            # The heap page lives in its page-sized buffer, so we can
+            # return the buffer directly rather than repacking.
+            return self._page.buffer
+        return self._page.pack()
 
     def mark_dirty(self):
         self._dirty = True
+        if global_vars.buffer_manager is not None:
+            global_vars.buffer_manager.track_dirty(self)
 
     def erase_dirty(self):
         self._dirty = False
+        if self._page is not None and not isinstance(self._page, SlotPage):
+            # B-tree node keeps its own flag
+            self._page.dirty = False
+
+    @property
+    def lsn(self):
+        # both the heap page and B-tree node remember the LSN of the last change
+        if isinstance(self.page, SlotPage):
+            return self.page.header.lsn
+        return self.page.lsn
 
     @property
     def dirty(self):
@@ -66,10 +94,11 @@ def heap_read_page(relation, pageno):
     if pageno_to_filesize(pageno) >= filesize:
         return None
     offset = pageno * PAGE_SIZE
-    file_lseek(relation.fd, offset)
-    data = file_read(relation.fd, PAGE_SIZE)
+    # read into the buffer that the page will live in
+    buffer = aligned_buffer(PAGE_SIZE)
+    file_preadinto(relation.fd, buffer, offset)
     buffer_page = BufferPage(relation, pageno)
-    buffer_page.set_data(data)
+    buffer_page.set_page(SlotPage(buffer))
     return buffer_page
 
 
@@ -78,7 +107,8 @@ def heap_allocate_page(relation, pageno):
     # don't need to increase
     if pageno > 0:
         relation.increase_last_pageno()
-    page = SlotPage.allocate(lsn=global_vars.xact_manager.max_lsn())
+    # nothing has been applied to a new page yet, redo relies on it
+    page = SlotPage.allocate(lsn=0, buffer=aligned_buffer(PAGE_SIZE))
     buffer_page = BufferPage(relation, pageno)
     buffer_page.set_page(page)
     buffer_page.mark_dirty()
@@ -88,15 +118,17 @@ def heap_allocate_page(relation, pageno):
 def heap_write_page(buffer_page):
     pageno = buffer_page.pageno
     #TODO: allocate page space ahead in disk using the following code, but
-    # currently we cannot because insert action depends on the last pageno, we
-    # doesn't implement a fsm mechanism yet.
+    # currently we cannot because `Relation.last_pageno()` depends on the file size.
 
     # fz = file_size(buffer_page.relation.fd)
     # if fz <= (PAGE_SIZE * pageno):
     #     file_extend(buffer_page.relation.fd, get_next_allocation_size(fz))
-    file_lseek(buffer_page.relation.fd, pageno_to_filesize(pageno))
     # not sync
-    file_write(buffer_page.relation.fd, buffer_page.data)
+    file_pwrite(buffer_page.relation.fd, buffer_page.data, pageno_to_filesize(pageno))
+    # the page on disk is what the free space map describes after restart
+    fsm = get_fsm(buffer_page.relation)
+    fsm.record_free_space(pageno, buffer_page.page.free_space_size())
+    fsm.persist(pageno)
 
 
 def bt_read_page(relation, pageno):
@@ -105,8 +137,7 @@ def bt_read_page(relation, pageno):
     if pageno_to_filesize(pageno) >= filesize:
         return None
     offset = pageno * PAGE_SIZE + header_size
-    file_lseek(relation.fd, offset)
-    data = file_read(relation.fd, PAGE_SIZE)
+    data = file_pread(relation.fd, PAGE_SIZE, offset)
     buffer_page = BufferPage(relation, pageno)
     node = create_node(data)
     # BTree's node is page
@@ -121,9 +152,8 @@ def bt_allocate_page(relation, pageno):
 def bt_write_page(buffer_page):
     pageno = buffer_page.pageno
     header_size = BPlusTree.Header.size()
-    file_lseek(buffer_page.relation.fd, pageno_to_filesize(pageno) + header_size)
     # not sync
-    file_write(buffer_page.relation.fd, buffer_page.data)
+    file_pwrite(buffer_page.relation.fd, buffer_page.data, pageno_to_filesize(pageno) + header_size)
 
 
 _registry = {
@@ -140,27 +170,101 @@ _registry = {
 }
 
 
+class BufferPartition:
+    """A part of the buffer pool. Pages are mapped to partitions by hash, and each
+    partition has its own latch and replacement cache, so threads working on
+    different pages rarely wait for each other."""
+
+    def __init__(self, capacity):
+        self.cache = create_cache(global_vars.buffer_replacement_policy, capacity=capacity)
+        # guards the replacement cache and the pin counts of its pages
+        self.lock = threading.RLock()
+
+
 class BufferManager:
     def __init__(self):
-        self.cache = LRUCache(capacity=global_vars.buffer_pool_size)
-
-    def get_page(self, relation, pageno) -> BufferPage:
+        partitions = max(1, min(NUM_BUFFER_PARTITIONS, global_vars.buffer_pool_size))
+        self._partitions = [BufferPartition(global_vars.buffer_pool_size // partitions)
+                            for _ in range(partitions)]
+        # Both are {relation oid: {pageno: buffer page}}. Sync, checkpoint and
+        # `evict_relation()` only visit them rather than the whole pool.
+        self._resident_pages = {}
+        self._dirty_pages = {}
+        self._index_lock = threading.Lock()
+
+    def _get_partition(self, relation, pageno):
+        return self._partitions[hash((relation.oid, pageno)) % len(self._partitions)]
+
+    def get_page(self, relation, pageno, pin=False) -> BufferPage:
+        """Return the buffer page, and pin it if `pin` is True, so that it cannot
+        be evicted before the caller pins it."""
         key = (relation, pageno)
-        page = self.cache.get(key)
-        if page is None:
-            page = self._read_page_from_disk(relation, pageno)
-            self.cache.put(key, page)
+        partition = self._get_partition(relation, pageno)
+        with partition.lock:
+            page = partition.cache.get(key)
+            if page is None:
+                page = self._read_page_from_disk(relation, pageno)
+                self._put(partition, page, pin)
+            elif pin:
+                self._pin(partition, page)
         return page
 
-    def put_page(self, buffer_page):
+    def put_page(self, buffer_page, pin=False):
         assert isinstance(buffer_page, BufferPage)
         key = (buffer_page.relation, buffer_page.pageno)
-        return self.cache.put(key, buffer_page)
+        partition = self._get_partition(buffer_page.relation, buffer_page.pageno)
+        with partition.lock:
+            return self._put(partition, buffer_page, pin)
+
+    def _put(self, partition, buffer_page, pin):
+        # pinned while putting, otherwise the page could be the one evicted
+        if pin:
+            buffer_page.pin_count += 1
+        try:
+            rv = partition.cache.put((buffer_page.relation, buffer_page.pageno), buffer_page,
+                                     pinned=buffer_page.pin_count > 0)
+        except Exception:
+            if pin:
+                buffer_page.pin_count -= 1
+            raise
+        self._track_resident(buffer_page)
+        self._sync_evicted_pages(partition)
+        return rv
+
+    def lookup_page(self, relation, pageno):
+        """Return the buffer page if it is in the pool, never read the disk."""
+        return self._resident_pages.get(relation.oid, {}).get(pageno)
     
     def mark_dirty(self, relation, pageno):
         buffer_page = self.get_page(relation, pageno)
         buffer_page.mark_dirty()
 
+    def _track_resident(self, buffer_page):
+        with self._index_lock:
+            self._resident_pages.setdefault(buffer_page.relation.oid, {})[buffer_page.pageno] = buffer_page
+
+    def _untrack(self, index, buffer_page):
+        with self._index_lock:
+            pages = index.get(buffer_page.relation.oid)
+            if pages is not None and pages.get(buffer_page.pageno) is buffer_page:
+                del pages[buffer_page.pageno]
+                if not pages:
+                    del index[buffer_page.relation.oid]
+
+    def track_dirty(self, buffer_page):
+        with self._index_lock:
+            self._dirty_pages.setdefault(buffer_page.relation.oid, {})[buffer_page.pageno] = buffer_page
+
+    def get_dirty_pages(self, relation=None):
+        with self._index_lock:
+            if relation is not None:
+                return list(self._dirty_pages.get(relation.oid, {}).values())
+            return [buffer_page for pages in self._dirty_pages.values() for buffer_page in pages.values()]
+
+    def dirty_page_count(self):
+        with self._index_lock:
+            return sum(len(pages) for pages in self._dirty_pages.values())
+
     @staticmethod
     def create_buffer_page(relation, pageno, page):
         assert not isinstance(page, BufferPage), 'purge page only'
@@ -169,46 +273,120 @@ class BufferManager:
         return buffer_page
 
     def evict_relation(self, relation):
-        lwlock_acquire(LWLockName.BUFFER_UPDATE)
-        keys = list(self.cache.keys())
-        for key in keys:
-            r, p = key
-            if r == relation:
-                self.cache.pop(key)
-        lwlock_release(LWLockName.BUFFER_UPDATE)
+        """Drop all pages of the relation without writing them, e.g., the relation
+        has been dropped."""
+        with self._index_lock:
+            pages = self._resident_pages.pop(relation.oid, {})
+            pages.update(self._dirty_pages.pop(relation.oid, {}))
+        for pageno in pages:
+            partition = self._get_partition(relation, pageno)
+            with partition.lock:
+                partition.cache.pop((relation, pageno))
+
+    def _pin(self, partition, buffer_page):
+        # the cache only knows whether the page is pinned, not by how many
+        buffer_page.pin_count += 1
+        if buffer_page.pin_count == 1:
+            partition.cache.pin((buffer_page.relation, buffer_page.pageno))
 
     def pin_page(self, buffer_page):
-        key = (buffer_page.relation, buffer_page.pageno)
-        self.cache.pin(key)
+        partition = self._get_partition(buffer_page.relation, buffer_page.pageno)
+        with partition.lock:
+            self._pin(partition, buffer_page)
 
     def unpin_page(self, buffer_page):
-        key = (buffer_page.relation, buffer_page.pageno)
-        self.cache.unpin(key)
+        partition = self._get_partition(buffer_page.relation, buffer_page.pageno)
+        with partition.lock:
+            assert buffer_page.pin_count > 0
+            buffer_page.pin_count -= 1
+            if buffer_page.pin_count == 0:
+                partition.cache.unpin((buffer_page.relation, buffer_page.pageno))
+
+    def is_pinned(self, buffer_page):
+        return buffer_page.pin_count > 0
+
+    def get_stats(self):
+        stats = {}
+        for partition in self._partitions:
+            for name, value in partition.cache.get_stats().items():
+                stats[name] = stats.get(name, 0) + value
+        return stats
+
+    def flush_page(self, buffer_page):
+        # readers can go on while the page is being written
+        with buffer_page.io_lock, buffer_page.content_lock.shared():
+            # untrack and erase first, so a change made while writing
+            # marks the page dirty again
+            self._untrack(self._dirty_pages, buffer_page)
+            if not buffer_page.dirty:
+                return False
+            buffer_page.erase_dirty()
+            logging.debug('writing dirty page %s of relation %s', buffer_page.pageno, buffer_page.relation)
+            try:
+                # WAL-before-data: the records up to the page LSN must be
+                # durable before the page itself, so must be the undo
+                # records of the changes, which a crash rolls back
+                if global_vars.xact_manager is not None:
+                    global_vars.xact_manager.undo_manager.flush_page_writers(buffer_page.relation.oid,
+                                                                             buffer_page.pageno)
+                    global_vars.xact_manager.wal_manager.flush(buffer_page.lsn)
+                self._write_page_to_disk(buffer_page)
+            except Exception:
+                buffer_page.mark_dirty()
+                raise
+            return True
+
+    def get_oldest_dirty_pages(self, n=None):
+        """Return dirty pages in LSN order, the oldest change first."""
+        pages = sorted(self.get_dirty_pages(), key=lambda buffer_page: buffer_page.lsn)
+        return pages if n is None else pages[:n]
+
+    def flush_pages(self, buffer_pages, duration=0, batch_size=16):
+        """Write the pages in batches, and spread the batches over `duration`
+        seconds rather than writing all of them at once.
+        :return: the number of written pages
+        """
+        written = 0
+        batches = [buffer_pages[i: i + batch_size] for i in range(0, len(buffer_pages), batch_size)]
+        deadline = time.monotonic() + duration
+        for i, batch in enumerate(batches):
+            for buffer_page in batch:
+                written += self.flush_page(buffer_page)
+            if duration > 0 and i + 1 < len(batches):
+                # sleep according to the progress, so we finish near the deadline
+                # even if writing takes some time
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining / (len(batches) - i - 1))
+        return written
 
     def sync(self):
-        lwlock_acquire(LWLockName.BUFFER_UPDATE)
-        try:
-            for buffer_page in self.cache.items():
-                if buffer_page.dirty:
-                    logging.info(f"writing dirty page: {buffer_page}")
-                    print(f"writing dirty page: {buffer_page}")
-                    self._write_page_to_disk(buffer_page)
-                    buffer_page.erase_dirty()
-            self.sync_evicted_pages()
-        finally:
-            lwlock_release(LWLockName.BUFFER_UPDATE)
+        for buffer_page in self.get_dirty_pages():
+            self.flush_page(buffer_page)
+        self.sync_evicted_pages()
 
     def reset(self):
         #TODO: sync ahead?
-        self.cache.clear()
+        for partition in self._partitions:
+            with partition.lock:
+                partition.cache.clear()
+        with self._index_lock:
+            self._resident_pages.clear()
+            self._dirty_pages.clear()
 
     def sync_evicted_pages(self):
-        evicted = self.cache.get_evicted_list()
-        for buffer_page in evicted:
-            if buffer_page.dirty:
-                self._write_page_to_disk(buffer_page)
-                buffer_page.erase_dirty()
-        evicted.clear()
+        for partition in self._partitions:
+            with partition.lock:
+                self._sync_evicted_pages(partition)
+
+    def _sync_evicted_pages(self, partition):
+        evicted = partition.cache.get_evicted_list()
+        while evicted:
+            buffer_page = evicted.pop()
+            self._untrack(self._resident_pages, buffer_page)
+            # write it back right now, otherwise, reading the page again
+            # would get the stale one from disk
+            self.flush_page(buffer_page)
 
     @staticmethod
     def _read_page_from_disk(relation, pageno):
@@ -0,0 +1,66 @@
+import logging
+import threading
+
+from andb.runtime import global_vars
+from andb.storage.engines.heap.relation import open_relation, close_relation
+from andb.storage.engines.heap.vacuum import dead_item_tracker, vacuum_relation
+from andb.storage.lock import rlock
+
+
+class AutoVacuumWorker(threading.Thread):
+    """A background thread that wakes up every `naptime` seconds and vacuums
+    relations having at least `threshold` dead items.
+
+    It works page by page and only holds the content lock of the page being
+    vacuumed, pinned pages are left for the next round. Hence, foreground
+    queries are blocked for one page at most."""
+
+    def __init__(self, naptime, threshold):
+        super().__init__(name='autovacuum', daemon=True)
+        self.naptime = naptime
+        self.threshold = threshold
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.naptime):
+            try:
+                self.vacuum_once()
+            except Exception as e:
+                logging.error(f'autovacuum failed: {e}')
+
+    def vacuum_once(self):
+        # the dead items of active transactions may be rolled back
+        active_xids = set(global_vars.xact_manager.active_transactions)
+        for oid in dead_item_tracker.relations_over_threshold(self.threshold):
+            if self._stop_event.is_set():
+                break
+            relation = open_relation(oid, rlock.ACCESS_SHARE_LOCK)
+            if not relation:
+                # maybe the relation is being dropped, try it next time
+                continue
+            try:
+                vacuum_relation(relation, active_xids)
+            finally:
+                close_relation(oid, rlock.ACCESS_SHARE_LOCK)
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def start_autovacuum():
+    if global_vars.autovacuum_worker is not None:
+        return global_vars.autovacuum_worker
+    worker = AutoVacuumWorker(naptime=global_vars.autovacuum_naptime,
+                              threshold=global_vars.autovacuum_vacuum_threshold)
+    worker.start()
+    global_vars.autovacuum_worker = worker
+    return worker
+
+
+def stop_autovacuum():
+    if global_vars.autovacuum_worker is None:
+        return
+    global_vars.autovacuum_worker.stop()
+    global_vars.autovacuum_worker = None
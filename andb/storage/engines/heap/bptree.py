@@ -268,7 +268,14 @@ class BPlusTree:
         node.lsn = lsn
         if key in node.keys:
             index = node.keys.index(key)
-            node.key_value_pairs[index].remove(value)
+            values = node.key_value_pairs[index]
+            if value not in values:
+                return
+            values.remove(value)
+            # the key goes away with its last value
+            if not values:
+                node.key_value_pairs.pop(index)
+                node.keys.pop(index)
             self.mark_dirty(node)
 
     def search(self, key):
@@ -279,6 +286,11 @@ class BPlusTree:
         else:
             return []
 
+    def leaf_lsn(self, key):
+        """LSN of the leaf node that the key belongs to, e.g., redo skips
+        the changes that the node has had."""
+        return self._find_leaf_node(key).lsn
+
     def search_range(self, start_key, end_key):
         """apart from the value of either start_key or end_key."""
         result = []
@@ -295,9 +307,11 @@ class BPlusTree:
                     result.append(node.key_value_pairs[i])
                 else:
                     return result
-            node = node.next_leaf
-            if node and node.state == LeafNode.STATE_UNLOADED:
-                node = self.load_page(node.get_pageno())
+            next_node = node.next_leaf
+            if next_node is not None:
+                next_node = self._load(next_node)
+            self._unload(node)
+            node = next_node
             index = 0
 
         return result
@@ -308,11 +322,25 @@ class BPlusTree:
         while node is not None:
             for key in node.keys:
                 yield key
-            node = node.next_leaf
+            next_node = node.next_leaf
+            if next_node is not None:
+                next_node = self._load(next_node)
+            self._unload(node)
+            node = next_node
 
     def load_page(self, pageno):
         raise NotImplementedError
 
+    def _load(self, node):
+        """Return the loaded node that `node` refers to."""
+        if node.state == node.STATE_UNLOADED:
+            return self.load_page(node.get_pageno())
+        return node
+
+    def _unload(self, node):
+        """The caller will not use `node` anymore."""
+        pass
+
     def _allocate_pageno(self):
         """Should override this method while using disk-based B+ tree."""
         current_pageno = self._next_pageno
@@ -331,66 +359,103 @@ class BPlusTree:
     def _find_leaf_node(self, key):
         current_node = self.root
         while True:
-            if current_node.state == current_node.STATE_UNLOADED:
-                current_node = self.load_page(current_node.get_pageno())
+            current_node = self._load(current_node)
             if not isinstance(current_node, InternalNode):
                 break
             index = self._find_index(current_node, key)
             current_node = current_node.children[index]
-        # Maybe, the key is just in a gap between two nodes.
-        # if that, we should get the next leaf node.
-        while (len(current_node.keys) > 0 and (current_node.keys[-1] < key)
-                and current_node.next_leaf):
-            current_node = current_node.next_leaf
-            if current_node.state == current_node.STATE_UNLOADED:
-                current_node = self.load_page(current_node.get_pageno())
+        # A separator is the first key of its right node but searching it
+        # goes left, so go on to the next leaf node if the key belongs there.
+        while len(current_node.keys) > 0 and current_node.keys[-1] < key and current_node.next_leaf:
+            next_node = self._load(current_node.next_leaf)
+            if not next_node.keys or key < next_node.keys[0]:
+                break
+            current_node = next_node
         return current_node
 
     def _split(self, lsn, node):
         mid = len(node.keys) // 2
-        new_node = self._allocate_node(is_leaf=True)
+        if isinstance(node, InternalNode):
+            # the middle key moves up, the children around it are divided
+            new_node = self._allocate_node(is_leaf=False)
+            separator = node.keys[mid]
+            new_node.keys = node.keys[mid + 1:]
+            new_node.children = node.children[mid + 1:]
+            node.keys = node.keys[:mid]
+            node.children = node.children[:mid + 1]
+        else:
+            new_node = self._allocate_node(is_leaf=True)
+            new_node.keys = node.keys[mid:]
+            new_node.key_value_pairs = node.key_value_pairs[mid:]
+            new_node.high_key = node.high_key
+            separator = new_node.keys[0]
+
+            node.keys = node.keys[:mid]
+            node.key_value_pairs = node.key_value_pairs[:mid]
+            node.high_key = separator  # Update the high key of the left node
+
+            if node.next_leaf is not None:
+                new_node.next_leaf = node.next_leaf
+            node.next_leaf = new_node
         new_node.lsn = lsn
-        new_node.keys = node.keys[mid:]
-        new_node.key_value_pairs = node.key_value_pairs[mid:]
-        new_node.high_key = node.high_key
-
-        node.keys = node.keys[:mid]
-        node.key_value_pairs = node.key_value_pairs[:mid]
-        node.high_key = new_node.keys[0]  # Update the high key of the left node
         self.mark_dirty(node)
 
-        if node.next_leaf is not None:
-            new_node.next_leaf = node.next_leaf
-        node.next_leaf = new_node
         if node is self.root:
-            parent = self._allocate_node(is_leaf=False)
-            parent.lsn = lsn
-            parent.keys.append(new_node.keys[0])
-            parent.children.append(node)
-            parent.children.append(new_node)
-            self.root = parent
+            self._grow_root(lsn, node, new_node, separator)
         else:
             parent = self._find_parent(node)
-            index = self._find_index(parent, node.keys[0])
-            parent.keys.insert(index, new_node.keys[0])
+            index = self._child_index(parent, node)
+            parent.keys.insert(index, separator)
             parent.children.insert(index + 1, new_node)
+            parent.lsn = lsn
             self.mark_dirty(parent)
 
             if self._need_to_split(parent):
                 self._split(lsn, parent)
 
+    def _grow_root(self, lsn, left, right, separator):
+        parent = self._allocate_node(is_leaf=False)
+        parent.lsn = lsn
+        parent.keys.append(separator)
+        parent.children.append(left)
+        parent.children.append(right)
+        self.root = parent
+
     def _need_to_split(self, node):
         """This method is just for demonstrating. We should override it according
         the size of data or other rules."""
         max_load_factor = 0.5
         return node.load_factor() > max_load_factor
 
+    @staticmethod
+    def _child_index(parent, node):
+        # children may be unloaded stubs or loaded again, so compare pagenos
+        pageno = node.get_pageno()
+        for i, child in enumerate(parent.children):
+            if child is node or child.get_pageno() == pageno:
+                return i
+        return -1
+
     def _find_parent(self, node):
-        current_node = self.root
-        while True:
-            if node in current_node.children:
-                return current_node
-            current_node = current_node.children[self._find_index(current_node, node.keys[0])]
+        return self._find_parent_from(self.root, node, node.keys[0])
+
+    def _find_parent_from(self, current_node, node, key):
+        current_node = self._load(current_node)
+        if not isinstance(current_node, InternalNode):
+            return None
+        if self._child_index(current_node, node) >= 0:
+            return current_node
+        index = self._find_index(current_node, key)
+        candidates = [index]
+        # a separator is the first key of its right side, which is
+        # reached from the left side by searching
+        if index < len(current_node.keys) and current_node.keys[index] == key:
+            candidates.append(index + 1)
+        for i in candidates:
+            parent = self._find_parent_from(current_node.children[i], node, key)
+            if parent is not None:
+                return parent
+        return None
 
     @staticmethod
     def _find_index(node, key):
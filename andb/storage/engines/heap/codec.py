@@ -0,0 +1,283 @@
+import struct
+
+from andb.catalog.syscache import CATALOG_ANDB_TYPE
+from andb.catalog.type import VARIABLE_LENGTH, VARIABLE_TYPE_HEADER_LENGTH, IntegerType, BigintType, RealType, \
+    DoubleType, BooleanType, VarcharType, TextType
+from andb.common.cstructure import CTYPE_BIG_ENDIAN, CTYPE_TYPE_UINT4, CTYPE_TYPE_UINT8
+from andb.constants.values import MAX_TABLE_COLUMNS
+from andb.errno.errors import RollbackError
+
+NULLS_BYTES = 8
+_NULLS_CTYPE = 'Q'
+_NULLS = struct.Struct(CTYPE_BIG_ENDIAN + _NULLS_CTYPE)
+_VARIABLE_HEADER = struct.Struct(CTYPE_BIG_ENDIAN + 'i')
+
+# Types whose byte form is exactly one struct item. The value is a tuple of
+# (ctype, bias), where bias is added before packing to keep integers
+# order-preserving, see `IntegerType.to_bytes()`.
+_FIXED_TYPES = {
+    IntegerType: (CTYPE_TYPE_UINT4, 0xffffffff >> 1),
+    BigintType: (CTYPE_TYPE_UINT8, 0xffffffffffffffff >> 1),
+    RealType: (RealType.type_char, 0),
+    DoubleType: (DoubleType.type_char, 0),
+    BooleanType: (BooleanType.type_char, 0),
+}
+
+_STEP_FIXED = 0
+_STEP_VARCHAR = 1
+_STEP_TEXT = 2
+_STEP_GENERIC = 3
+
+
+def _resolve_type(form):
+    # go through the catalog as the original per-column path does
+    return CATALOG_ANDB_TYPE.get_type_form(CATALOG_ANDB_TYPE.get_type_name(form.type_oid))
+
+
+class TupleCodec:
+    """Converts between python tuples and heap tuple bytes for one attribute form array.
+
+    The byte layout is the same as `TupleData`: an 8-byte null bitmap followed by
+    the non-null columns. All catalog lookups are done once in the constructor,
+    and consecutive fixed-width columns are packed and unpacked by one
+    precompiled `struct.Struct`. Since a null column takes no bytes, the merged
+    runs only apply to tuples without nulls; other tuples are coded column by column.
+    """
+
+    def __init__(self, attr_form_array):
+        self.attr_forms = tuple(attr_form_array)
+        self.natts = len(self.attr_forms)
+        self.notnull_mask = 0
+        self.type_classes = []
+        # per-column plan: (kind, idx, argument)
+        self._column_steps = []
+        for i, form in enumerate(self.attr_forms):
+            type_class = _resolve_type(form)
+            self.type_classes.append(type_class)
+            if form.notnull:
+                self.notnull_mask |= (1 << i)
+            self._column_steps.append(self._compile_column(i, form, type_class))
+        self._merged_steps = self._merge_fixed_steps(self._column_steps)
+        self._prefixes = {}
+        self._projections = {}
+
+    @staticmethod
+    def _compile_column(i, form, type_class):
+        if type_class in _FIXED_TYPES:
+            ctype, bias = _FIXED_TYPES[type_class]
+            packer = struct.Struct(CTYPE_BIG_ENDIAN + ctype)
+            if packer.size == form.length:
+                return _STEP_FIXED, i, (ctype, bias, packer)
+        elif type_class is VarcharType and form.length != VARIABLE_LENGTH:
+            return _STEP_VARCHAR, i, form.length
+        elif type_class is TextType:
+            return _STEP_TEXT, i, None
+        return _STEP_GENERIC, i, None
+
+    @staticmethod
+    def _merge_fixed_steps(column_steps):
+        """Build steps for tuples without nulls. Each step of fixed columns
+        is a tuple (kind, start, end, struct, biases)."""
+        steps = []
+        run = []
+
+        def close_run():
+            if run:
+                fmt = CTYPE_BIG_ENDIAN + ''.join(ctype for _, (ctype, _, _) in run)
+                biases = tuple(bias for _, (_, bias, _) in run)
+                steps.append((_STEP_FIXED, run[0][0], run[-1][0] + 1, struct.Struct(fmt),
+                              biases if any(biases) else None))
+                run.clear()
+
+        for kind, i, argument in column_steps:
+            if kind == _STEP_FIXED:
+                run.append((i, argument))
+            else:
+                close_run()
+                steps.append((kind, i, argument))
+        close_run()
+        return steps
+
+    def prefix(self, n):
+        """Return the codec of the first n attributes, e.g., for the leftmost
+        prefix of an index key."""
+        if n == self.natts:
+            return self
+        if n not in self._prefixes:
+            self._prefixes[n] = TupleCodec(self.attr_forms[:n])
+        return self._prefixes[n]
+
+    def encode(self, python_tuple) -> bytes:
+        assert len(python_tuple) == self.natts
+        nulls = 0
+        for i, datum in enumerate(python_tuple):
+            if datum is None:
+                if self.notnull_mask & (1 << i):
+                    raise RollbackError(f'the field {self.attr_forms[i].name} cannot be null.')
+                assert i < MAX_TABLE_COLUMNS
+                nulls |= (1 << i)
+
+        chunks = [_NULLS.pack(nulls)]
+        try:
+            if nulls == 0:
+                self._encode_steps(self._merged_steps, python_tuple, chunks)
+            else:
+                self._encode_steps(
+                    [step for step in self._column_steps if not (nulls & (1 << step[1]))],
+                    python_tuple, chunks, single_column=True
+                )
+        except struct.error:
+            # Let the type itself report what is wrong with the datum.
+            chunks = [_NULLS.pack(nulls)]
+            for i, datum in enumerate(python_tuple):
+                if datum is not None:
+                    chunks.append(self._encode_generic(i, datum))
+        return b''.join(chunks)
+
+    def _encode_steps(self, steps, python_tuple, chunks, single_column=False):
+        for step in steps:
+            kind = step[0]
+            if kind == _STEP_FIXED:
+                if single_column:
+                    i, (_, bias, packer) = step[1], step[2]
+                    chunks.append(packer.pack(python_tuple[i] + bias if bias else python_tuple[i]))
+                else:
+                    _, start, end, packer, biases = step
+                    values = python_tuple[start:end]
+                    if biases:
+                        values = [v + b for v, b in zip(values, biases)]
+                    chunks.append(packer.pack(*values))
+            elif kind == _STEP_VARCHAR:
+                # as varchar is fixed length, we should truncate it here
+                chunks.append(str.encode(python_tuple[step[1]][:step[2]], encoding='utf8'))
+            elif kind == _STEP_TEXT:
+                encoded = str.encode(python_tuple[step[1]], encoding='utf8')
+                chunks.append(_VARIABLE_HEADER.pack(len(encoded)))
+                chunks.append(encoded)
+            else:
+                i = step[1]
+                chunks.append(self._encode_generic(i, python_tuple[i]))
+
+    def _encode_generic(self, i, datum):
+        if self.attr_forms[i].type_oid == VarcharType.oid:
+            datum = datum[:self.attr_forms[i].length]
+        return self.type_classes[i].to_bytes(datum)
+
+    def decode(self, data) -> tuple:
+        if len(data) < NULLS_BYTES:
+            raise RollbackError('the data corrupt')
+        nulls = _NULLS.unpack_from(data, 0)[0]
+        values = []
+        cursor = NULLS_BYTES  # starts from real data
+        if nulls == 0:
+            steps = self._merged_steps
+        else:
+            steps = self._column_steps
+        for step in steps:
+            kind = step[0]
+            if kind == _STEP_FIXED and nulls == 0:
+                _, start, end, packer, biases = step
+                run = packer.unpack_from(data, cursor)
+                if biases:
+                    run = [v - b for v, b in zip(run, biases)]
+                values.extend(run)
+                cursor += packer.size
+                continue
+            i = step[1]
+            if nulls & (1 << i):
+                values.append(None)
+            elif kind == _STEP_FIXED:
+                _, bias, packer = step[2]
+                value = packer.unpack_from(data, cursor)[0]
+                values.append(value - bias if bias else value)
+                cursor += packer.size
+            elif kind == _STEP_VARCHAR:
+                values.append(str(data[cursor: cursor + step[2]], 'utf8'))
+                cursor += step[2]
+            elif kind == _STEP_TEXT:
+                length = _VARIABLE_HEADER.unpack_from(data, cursor)[0]
+                start = cursor + VARIABLE_TYPE_HEADER_LENGTH
+                values.append(str(data[start: start + length], 'utf8'))
+                cursor = start + length
+            else:
+                value, cursor = self._decode_generic(i, data, cursor)
+                values.append(value)
+        return tuple(values)
+
+    def _projection(self, attr_idx):
+        plan = self._projections.get(attr_idx)
+        if plan is None:
+            positions = {}
+            for pos, i in enumerate(attr_idx):
+                positions.setdefault(i, []).append(pos)
+            # columns after the last projected one are never visited
+            plan = [(step, tuple(positions.get(step[1], ())))
+                    for step in self._column_steps[:max(attr_idx) + 1]]
+            self._projections[attr_idx] = plan
+        return plan
+
+    def decode_columns(self, data, attr_idx) -> tuple:
+        """Decode only the attributes in `attr_idx`, in that order. Other
+        columns are skipped over without being converted."""
+        attr_idx = tuple(attr_idx)
+        if not attr_idx:
+            return ()
+        if len(data) < NULLS_BYTES:
+            raise RollbackError('the data corrupt')
+        nulls = _NULLS.unpack_from(data, 0)[0]
+        values = [None] * len(attr_idx)
+        cursor = NULLS_BYTES
+        for step, positions in self._projection(attr_idx):
+            kind, i = step[0], step[1]
+            if nulls & (1 << i):
+                continue
+            if kind == _STEP_FIXED:
+                packer = step[2][2]
+                if positions:
+                    value = packer.unpack_from(data, cursor)[0]
+                    bias = step[2][1]
+                    value = value - bias if bias else value
+                cursor += packer.size
+            elif kind == _STEP_VARCHAR:
+                if positions:
+                    value = str(data[cursor: cursor + step[2]], 'utf8')
+                cursor += step[2]
+            elif kind == _STEP_TEXT:
+                length = _VARIABLE_HEADER.unpack_from(data, cursor)[0]
+                start = cursor + VARIABLE_TYPE_HEADER_LENGTH
+                if positions:
+                    value = str(data[start: start + length], 'utf8')
+                cursor = start + length
+            else:
+                value, cursor = self._decode_generic(i, data, cursor)
+            for pos in positions:
+                values[pos] = value
+        return tuple(values)
+
+    def _decode_generic(self, i, data, cursor):
+        type_class = self.type_classes[i]
+        length = self.attr_forms[i].length
+        if length == VARIABLE_LENGTH:
+            length = type_class.bytes_length(
+                bytes(data[cursor: cursor + VARIABLE_TYPE_HEADER_LENGTH])) + VARIABLE_TYPE_HEADER_LENGTH
+        value = type_class.to_datum(bytes(data[cursor: cursor + length]))
+        return value, cursor + length
+
+
+def _codec_key(attr_form_array):
+    return tuple((form.name, form.type_oid, form.length, form.notnull)
+                 for form in attr_form_array)
+
+
+_codec_cache = {}
+
+
+def get_tuple_codec(attr_form_array) -> TupleCodec:
+    """Return a compiled codec for the attribute form array. Codecs are cached by
+    the attribute definitions, so the same schema is compiled once."""
+    key = _codec_key(attr_form_array)
+    codec = _codec_cache.get(key)
+    if codec is None:
+        codec = TupleCodec(attr_form_array)
+        _codec_cache[key] = codec
+    return codec
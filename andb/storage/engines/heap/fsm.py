@@ -0,0 +1,116 @@
+import os
+import re
+
+from andb.common.file_operation import file_open, file_close, file_pread, file_pwrite, file_size
+from andb.constants.values import PAGE_SIZE
+
+FSM_FILE_SUFFIX = '_fsm'
+# Like PostgreSQL, each heap page takes one byte in the free space map, and
+# the byte is the category of its free space rather than the exact size.
+FSM_CATEGORIES = 256
+FSM_CATEGORY_SIZE = PAGE_SIZE // FSM_CATEGORIES
+INVALID_PAGENO = -1
+
+
+def free_bytes_to_category(free_bytes):
+    # round down, so that a category never promises more than the page has
+    return min(FSM_CATEGORIES - 1, max(0, free_bytes) // FSM_CATEGORY_SIZE)
+
+
+def needed_bytes_to_category(needed_bytes):
+    # round up, see `free_bytes_to_category()`. It can be beyond the last
+    # category, then no page is large enough.
+    return -(-needed_bytes // FSM_CATEGORY_SIZE)
+
+
+_category_patterns = {}
+
+
+def _category_pattern(category):
+    # let the regular expression engine search the byte array for us
+    pattern = _category_patterns.get(category)
+    if pattern is None:
+        pattern = re.compile(b'[%s-\xff]' % re.escape(bytes((category,))))
+        _category_patterns[category] = pattern
+    return pattern
+
+
+class FreeSpaceMap:
+    """The free space map fork of a heap relation. The map is kept in memory
+    and its file (the relation file path with `FSM_FILE_SUFFIX`) is updated
+    when a heap page is written, so it comes back after restart.
+
+    The map is only a hint, a caller must check whether the page can really hold
+    the item, and correct the map if not."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.categories = bytearray()
+        # where the next search starts, it spreads insertions
+        # when there are many pages with free space.
+        self.next_pageno = 0
+        self.load()
+
+    @property
+    def fd(self):
+        return file_open(self.file_path, os.O_RDWR | os.O_CREAT)
+
+    def load(self):
+        fd = self.fd
+        self.categories = bytearray(file_pread(fd, file_size(fd), 0))
+
+    def __len__(self):
+        return len(self.categories)
+
+    def get_free_space(self, pageno):
+        """Return the free bytes of the page at least."""
+        if pageno >= len(self.categories):
+            return 0
+        return self.categories[pageno] * FSM_CATEGORY_SIZE
+
+    def get_page_with_free_space(self, needed_bytes):
+        category = needed_bytes_to_category(needed_bytes)
+        if not self.categories or category >= FSM_CATEGORIES:
+            return INVALID_PAGENO
+        pattern = _category_pattern(max(1, category))
+        start = self.next_pageno if self.next_pageno < len(self.categories) else 0
+        match = pattern.search(self.categories, start)
+        if match is None and start > 0:
+            match = pattern.search(self.categories, 0, start)
+        if match is None:
+            return INVALID_PAGENO
+        self.next_pageno = match.start()
+        return match.start()
+
+    def record_free_space(self, pageno, free_bytes):
+        if pageno >= len(self.categories):
+            self.categories.extend(bytes(pageno + 1 - len(self.categories)))
+        self.categories[pageno] = free_bytes_to_category(free_bytes)
+
+    def persist(self, pageno):
+        """Write the entry of the page to the file. Not sync, the map can
+        be rebuilt from heap pages."""
+        file_pwrite(self.fd, self.categories[pageno: pageno + 1], pageno)
+
+    def close(self):
+        file_close(self.fd)
+
+
+_fsm_cache = {}
+
+
+def get_fsm(relation) -> FreeSpaceMap:
+    fsm = _fsm_cache.get(relation.oid)
+    if fsm is None:
+        fsm = FreeSpaceMap(relation.file_path + FSM_FILE_SUFFIX)
+        _fsm_cache[relation.oid] = fsm
+    return fsm
+
+
+def drop_fsm(relation):
+    fsm = _fsm_cache.pop(relation.oid, None)
+    if fsm is not None:
+        fsm.close()
+    file_path = relation.file_path + FSM_FILE_SUFFIX
+    if os.path.exists(file_path):
+        os.unlink(file_path)
@@ -0,0 +1,90 @@
+"""Multi-version concurrency control of heap tuples.
+
+Each heap tuple starts with a header of two xids: xmin is the transaction
+that created the version and xmax is the one that deleted it (INVALID_XID if
+nobody did). A delete only sets xmax, the tuple stays in its page until vacuum
+finds that no snapshot can see it anymore.
+
+A heap-only update overwrites the tuple in place, so the page always has the
+newest version. Older versions are the data of HEAP_UPDATE undo records,
+which the undo manager keeps by tuple location as long as a snapshot may
+need them, see `UndoManager.tuple_versions()`.
+"""
+import struct
+
+from andb.common.cstructure import CTYPE_BIG_ENDIAN
+from andb.constants.macros import INVALID_XID
+from andb.errno.errors import RollbackError
+from andb.runtime import global_vars
+from andb.storage.engines.heap.page import ItemIdFlags
+
+# xmin, xmax, followed by the tuple data coded by `TupleCodec`
+_HEADER = struct.Struct(CTYPE_BIG_ENDIAN + 'QQ')
+_XMAX = struct.Struct(CTYPE_BIG_ENDIAN + 'Q')
+_XMAX_OFFSET = 8
+HEAP_TUPLE_HEADER_SIZE = _HEADER.size
+
+
+def form_heap_tuple(xmin, data):
+    return _HEADER.pack(xmin, INVALID_XID) + data
+
+
+def heap_tuple_header(tuple_bytes):
+    """Return (xmin, xmax)."""
+    return _HEADER.unpack_from(tuple_bytes)
+
+
+def heap_tuple_data(tuple_bytes):
+    return tuple_bytes[HEAP_TUPLE_HEADER_SIZE:]
+
+
+def set_heap_tuple_xmax(page, tid, xmax):
+    data = page.select_view(tid)
+    if data is None:
+        return False
+    _XMAX.pack_into(data, _XMAX_OFFSET, xmax)
+    return True
+
+
+def visible_version(snapshot, relation_oid, pageno, tid, tuple_bytes):
+    """Return the version of the tuple that `snapshot` sees, or None if it
+    sees none, e.g., the tuple is inserted or deleted after the snapshot."""
+    xmin, xmax = _HEADER.unpack_from(tuple_bytes)
+    if not snapshot.is_visible(xmin):
+        # walk back through older versions, the newest first
+        for undo_record in global_vars.xact_manager.undo_manager.tuple_versions(relation_oid, pageno, tid):
+            if undo_record.xid != xmin:
+                continue
+            tuple_bytes = undo_record.data
+            xmin, xmax = _HEADER.unpack_from(tuple_bytes)
+            if snapshot.is_visible(xmin):
+                break
+        else:
+            return None
+    if xmax != INVALID_XID and snapshot.is_visible(xmax):
+        return None
+    return tuple_bytes
+
+
+def check_write_conflict(snapshot, xid, tuple_bytes):
+    """A transaction can only change the newest version of a tuple, and only
+    if its snapshot sees that version, otherwise the tuple has been changed by
+    a concurrent transaction (the first updater wins). The caller holds the
+    tuple lock, so that transaction has ended by now.
+    Return False if the transaction has deleted the tuple itself."""
+    xmin, xmax = _HEADER.unpack_from(tuple_bytes)
+    if xmax == xid:
+        return False
+    if xmax != INVALID_XID or not snapshot.is_visible(xmin):
+        raise RollbackError('could not serialize access due to concurrent update.')
+    return True
+
+
+def deleted_tuples(page):
+    """Yield (tid, xmax) of the tuples that are deleted but still in the page."""
+    for tid in range(page.item_count):
+        if page.get_item_id(tid)[1] != ItemIdFlags.NORMAL:
+            continue
+        xmax = _XMAX.unpack_from(page.select_view(tid), _XMAX_OFFSET)[0]
+        if xmax != INVALID_XID:
+            yield tid, xmax
@@ -1,12 +1,12 @@
-from functools import lru_cache
 import logging
+import struct
 
 from andb.common.cstructure import CStructure
 from andb.common.cstructure import Integer8Field
 from andb.common.cstructure import Integer4Field
+from andb.common.cstructure import CTYPE_BIG_ENDIAN
 
 from andb.constants.values import PAGE_SIZE
-from andb.common.utils import is_array_like
 
 
 class PageHeader(CStructure):
@@ -81,66 +81,185 @@ INVALID_ITEM_ID = -1
 INVALID_BYTES = bytes()
 
 
-@lru_cache(maxsize=8)
-def _get_item_ids_parser(length):
-    class ItemIdsTemp(CStructure):
-        item_ids = Integer4Field(unsigned=True, num=length)
+class _HeaderField:
+    """A descriptor that reads and writes one field of the page header
+    in place, so that the header never has to be packed or unpacked as a whole."""
 
-    obj = ItemIdsTemp()
+    def __init__(self, offset, ctype):
+        self.offset = offset
+        self.struct = struct.Struct(CTYPE_BIG_ENDIAN + ctype)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.struct.unpack_from(obj.buffer, self.offset)[0]
+
+    def __set__(self, obj, value):
+        self.struct.pack_into(obj.buffer, self.offset, value)
+
+
+def _header_field_offsets():
+    offsets = {}
+    offset = 0
+    for name, field in PageHeader.__mappings__.items():
+        ctype = CTYPE_BIG_ENDIAN + field.ctype
+        offsets[name] = (offset, field.ctype)
+        offset += struct.calcsize(ctype)
+    return offsets
+
+
+_HEADER_FIELD_OFFSETS = _header_field_offsets()
+PAGE_HEADER_SIZE = PageHeader.size()
+
+
+class BufferedPageHeader:
+    """The same layout as `PageHeader`, but all fields live in the page buffer."""
+    lsn = _HeaderField(*_HEADER_FIELD_OFFSETS['lsn'])
+    checksum = _HeaderField(*_HEADER_FIELD_OFFSETS['checksum'])
+    flags = _HeaderField(*_HEADER_FIELD_OFFSETS['flags'])
+    reserved = _HeaderField(*_HEADER_FIELD_OFFSETS['reserved'])
+    lower = _HeaderField(*_HEADER_FIELD_OFFSETS['lower'])
+    upper = _HeaderField(*_HEADER_FIELD_OFFSETS['upper'])
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    @staticmethod
+    def size():
+        return PAGE_HEADER_SIZE
+
+    def pack(self):
+        return bytes(self.buffer[:PAGE_HEADER_SIZE])
+
+    def __eq__(self, other):
+        if not isinstance(other, (BufferedPageHeader, PageHeader)):
+            return False
+        return self.pack() == other.pack()
+
+    def __hash__(self):
+        return hash(self.pack())
+
+    def __repr__(self):
+        return (f'PageHeader(lsn={self.lsn}, flags={self.flags}, lower={self.lower}, '
+                f'upper={self.upper}, checksum={self.checksum})')
+
+
+# lower and upper are adjacent, so we can read or write both at a time
+_LOWER_UPPER = struct.Struct(CTYPE_BIG_ENDIAN + 'II')
+_LOWER_OFFSET = _HEADER_FIELD_OFFSETS['lower'][0]
+assert _HEADER_FIELD_OFFSETS['upper'][0] == _LOWER_OFFSET + 4
+_ITEM_ID = struct.Struct(CTYPE_BIG_ENDIAN + 'I')
 
-    class Inner:
-        @staticmethod
-        def pack(uint4_list):
-            # CString doesn't receive an array contains one element, so we should
-            # covert `uint4_list` to adapt this scenario.
-            if length == 0:
-                return bytes()
-            if length == 1 and is_array_like(uint4_list):
-                obj.item_ids = uint4_list[0]
-            else:
-                obj.item_ids = uint4_list
-            return obj.pack()
 
-        @staticmethod
-        def unpack(data):
-            if len(data) == 0:
-                return []
-            obj.unpack(data)
-            # CString doesn't receive an array contains one element, so we should
-            # wrap `item_ids` using a list.
-            if length == 1:
-                return [obj.item_ids]
-            return obj.item_ids
+def _encode_item_id(offset, flag, length):
+    return ((offset << ItemIdData.OFFSET_SHIFT) |
+            (flag << ItemIdData.FLAGS_SHIFT) |
+            (length << ItemIdData.LENGTH_SHIFT))
 
-    return Inner()
+
+def _decode_item_id(value):
+    return ((value >> ItemIdData.OFFSET_SHIFT) & MASKER_15BITS,
+            (value >> ItemIdData.FLAGS_SHIFT) & MASKER_2BITS,
+            (value >> ItemIdData.LENGTH_SHIFT) & MASKER_15BITS)
+
+
+class ItemIdArray:
+    """A read-only, list-like view of the slot array of a page. Each
+    element is a snapshot `ItemIdData`, modifying it doesn't modify the page."""
+
+    def __init__(self, page):
+        self._page = page
+
+    def __len__(self):
+        return self._page.item_count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        count = len(self)
+        if idx < 0:
+            idx += count
+        if not (0 <= idx < count):
+            raise IndexError('item id index out of range')
+        return ItemIdData(*self._page.get_item_id(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __eq__(self, other):
+        if not isinstance(other, (ItemIdArray, list, tuple)):
+            return False
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class SlotPage:
-    def __init__(self):
+    def __init__(self, buffer=None):
         """The page structure likes below:
 
         -----------------------------------------------------------
         lsn | checksum | flags | lower | upper | ... item_ids ... |
         ... free space ... | itemN |     .........      | item0  |
         ---------------------------------------------------------
+
+        The whole page lives in one `PAGE_SIZE` buffer (e.g., a bytearray or
+        an aligned buffer from the buffer manager). Header fields and item ids
+        are read and written in place through `struct`, hence inserting
+        an item only copies the item data itself.
         """
-        self.header = PageHeader()
-        self.item_ids = []  # array of ItemIdData
-        # Here, we use bytearray instead of bytes since bytearray is mutable but
-        # bytes is immutable. That means, if we use bytes, we have to copy-on-write.
-        # This copy-on-write operation will introduce lots of overhead.
-        self.items = bytearray()
+        if buffer is None:
+            buffer = bytearray(PAGE_SIZE)
+        assert len(buffer) == PAGE_SIZE
+        self.buffer = buffer
+        self._view = memoryview(buffer)
+        self.header = BufferedPageHeader(buffer)
+        self.item_ids = ItemIdArray(self)
+        # whether there may be unused item ids to reuse, None means unknown.
+        # It is not kept in the header since index pages use the flags field.
+        self._has_unused_items = None
+
+    def _get_lower_upper(self):
+        return _LOWER_UPPER.unpack_from(self.buffer, _LOWER_OFFSET)
+
+    def _set_lower_upper(self, lower, upper):
+        _LOWER_UPPER.pack_into(self.buffer, _LOWER_OFFSET, lower, upper)
+
+    def get_item_id(self, item_idx):
+        """Return the tuple (offset, flag, length) of an item id. The caller
+        should check the boundary."""
+        return _decode_item_id(
+            _ITEM_ID.unpack_from(self.buffer, PAGE_HEADER_SIZE + item_idx * ItemIdData.BYTES)[0]
+        )
+
+    def _set_item_id(self, item_idx, offset, flag, length):
+        _ITEM_ID.pack_into(self.buffer, PAGE_HEADER_SIZE + item_idx * ItemIdData.BYTES,
+                           _encode_item_id(offset, flag, length))
+
+    def _set_item_flag(self, item_idx, flag):
+        offset, _, length = self.get_item_id(item_idx)
+        self._set_item_id(item_idx, offset, flag, length)
+
+    def _zero(self, start, end):
+        if end > start:
+            self.buffer[start:end] = bytes(end - start)
+
+    @property
+    def items(self):
+        return bytes(self._view[self.header.upper:])
 
     def item_data_size(self):
-        return len(self.items)
+        return PAGE_SIZE - self.header.upper
 
     def item_ids_size(self):
         # naturally byte-aligned
-        return len(self.item_ids) * ItemIdData.BYTES
+        return self.item_count * ItemIdData.BYTES
 
     def free_space_size(self):
-        return (PAGE_SIZE - self.header.size() -
-                self.item_ids_size() - self.item_data_size())
+        lower, upper = self._get_lower_upper()
+        return upper - lower
 
     def can_put_item(self, data: bytes):
         """Validate current free space can accommodate an item data
@@ -153,24 +272,43 @@ class SlotPage:
         :param data: item data, bytes
         :return: item pointer, int. If it failed, return INVALID_ITEM_ID.
         """
-        if len(data) == 0 or not self.can_put_item(data):
-            return INVALID_ITEM_ID
-
         length = len(data)
-        offset = self.header.upper - length
-        flag = ItemIdFlags.NORMAL
+        lower, upper = self._get_lower_upper()
+        if length == 0:
+            return INVALID_ITEM_ID
+        if self._has_unused_items is not False:
+            item_idx = self._find_unused_item()
+            if item_idx != INVALID_ITEM_ID:
+                # reuse the item id, so only the data takes free space
+                if length > upper - lower:
+                    return INVALID_ITEM_ID
+                offset = upper - length
+                self.buffer[offset:upper] = data
+                self._set_item_id(item_idx, offset, ItemIdFlags.NORMAL, length)
+                self.header.lsn = lsn
+                self.header.checksum = 0  #TODO: unset
+                self._set_lower_upper(lower, offset)
+                return item_idx
+        if length > (upper - lower - ItemIdData.BYTES):
+            return INVALID_ITEM_ID
 
-        # allocate new ItemId
-        self.item_ids.append(ItemIdData(offset=offset, flags=flag, length=length))
-        # then, put the data into the items array
-        self.items = bytearray(data) + self.items  # put into the first place
+        offset = upper - length
+        # put the data into the free space directly, then allocate new ItemId
+        self.buffer[offset:upper] = data
+        _ITEM_ID.pack_into(self.buffer, lower, _encode_item_id(offset, ItemIdFlags.NORMAL, length))
         # finally, update some fields
         self.header.lsn = lsn
         self.header.checksum = 0  #TODO: unset
-        self.header.lower = self.header.size() + self.item_ids_size()
-        self.header.upper = PAGE_SIZE - self.item_data_size()
+        self._set_lower_upper(lower + ItemIdData.BYTES, offset)
         # return just put index of the whole item_ids list
-        return len(self.item_ids) - 1
+        return (lower - PAGE_HEADER_SIZE) // ItemIdData.BYTES
+
+    def _find_unused_item(self):
+        for i in range(self.item_count):
+            if self.get_item_id(i)[1] == ItemIdFlags.UNUSED:
+                return i
+        self._has_unused_items = False
+        return INVALID_ITEM_ID
 
     def delete(self, lsn: int, item_idx: int) -> bool:
         """We employ mark-and-sweep method to delete an item.
@@ -178,70 +316,62 @@ class SlotPage:
         :param item_idx: the index of `self.item_ids` list
         :return: if it is successful, returns true, otherwise, return false.
         """
-        if not (0 <= item_idx < len(self.item_ids)):
+        if not (0 <= item_idx < self.item_count):
             return False
-        item_id: ItemIdData = self.item_ids[item_idx]
+        offset, flag, length = self.get_item_id(item_idx)
         # we only can delete valid (normal) item
-        if item_id.flag != ItemIdFlags.NORMAL:
-            logging.error(f'cannot delete item {item_idx} in page, item flag is {item_id.flag}')
+        if flag != ItemIdFlags.NORMAL:
+            logging.error(f'cannot delete item {item_idx} in page, item flag is {flag}')
             return False
 
         self.header.lsn = lsn
-        item_id.flag = ItemIdFlags.DEAD
+        self._set_item_id(item_idx, offset, ItemIdFlags.DEAD, length)
         self.header.checksum = 0  #TODO: unset
         return True
-    
+
     def delete_inplace(self, lsn: int, item_idx: int) -> bool:
-        if not (0 <= item_idx < len(self.item_ids)):
+        item_count = self.item_count
+        if not (0 <= item_idx < item_count):
             return False
 
-        item_id: ItemIdData = self.item_ids[item_idx]
+        removed_offset, flag, removed_length = self.get_item_id(item_idx)
         # we only can delete valid (normal) item
-        if item_id.flag != ItemIdFlags.NORMAL:
-            logging.error(f'cannot inplace delete item {item_idx} in page, item flag is {item_id.flag}')
+        if flag != ItemIdFlags.NORMAL:
+            logging.error(f'cannot inplace delete item {item_idx} in page, item flag is {flag}')
             return False
 
-        # we need to keep the order of item_ids and reorganize items
-        new_item_ids = list()
-        # first, pick up
-        for i, item_id in enumerate(self.item_ids):
-            if i != item_idx:
-                new_item_ids.append(item_id)
-
-        new_data = bytes()
-        new_upper = PAGE_SIZE
-        for item_id in new_item_ids:
-            offset = item_id.offset
-            length = item_id.length
-            offset_of_items = self.item_data_size() - (PAGE_SIZE - offset)
-            item_data = self.items[offset_of_items: (offset_of_items + length)]
-            new_data = item_data + new_data
-            # Okay, data have been recorded. Later, we should to update the ID information.
-            item_id.offset = new_upper - length
-            new_upper = item_id.offset
-        # finally, we should switch old `self.items` to new one.
+        lower, upper = self._get_lower_upper()
+        buffer = self.buffer
         # === the following will be a critical section if it is in concurrency scenario ===
         #TODO: spin lock
-        self.item_ids = new_item_ids
-        self.items = new_data
+        # first, move the items below the deleted one up to fill the hole
+        # (slicing copies, so the overlapping regions are safe)
+        buffer[upper + removed_length: removed_offset + removed_length] = buffer[upper: removed_offset]
+        self._zero(upper, upper + removed_length)
+        # then, we need to keep the order of item_ids, so shift the following ones
+        start = PAGE_HEADER_SIZE + item_idx * ItemIdData.BYTES
+        buffer[start: lower - ItemIdData.BYTES] = buffer[start + ItemIdData.BYTES: lower]
+        self._zero(lower - ItemIdData.BYTES, lower)
+        for i in range(item_count - 1):
+            offset, flag, length = self.get_item_id(i)
+            if offset < removed_offset:
+                self._set_item_id(i, offset + removed_length, flag, length)
         self.header.lsn = lsn
         self.header.checksum = 0  #TODO: unset
-        self.header.upper = new_upper
-        self.header.lower = self.header.size() + self.item_ids_size()
+        self._set_lower_upper(lower - ItemIdData.BYTES, upper + removed_length)
         # === end critical section ===
         return True
 
-
     def rollback_delete(self, old_lsn: int, item_idx: int) -> bool:
-        if not (0 <= item_idx < len(self.item_ids)):
+        if not (0 <= item_idx < self.item_count):
             return False
-        item_id: ItemIdData = self.item_ids[item_idx]
+        offset, flag, length = self.get_item_id(item_idx)
         # we only can delete valid (normal) item
-        if item_id.flag != ItemIdFlags.DEAD:
+        if flag != ItemIdFlags.DEAD:
             return False
 
         self.header.lsn = old_lsn
-        item_id.flag = ItemIdFlags.NORMAL
+        self._set_item_id(item_idx, offset, ItemIdFlags.NORMAL, length)
         self.header.checksum = 0  #TODO: unset
         return True
 
@@ -251,20 +381,20 @@ class SlotPage:
         :return: if it is successful, returns item bytes, otherwise,
           returns INVALID_BYTES.
         """
-        if not (0 <= item_idx < len(self.item_ids)):
-            return INVALID_BYTES
-        item_id: ItemIdData = self.item_ids[item_idx]
-        if item_id.flag != ItemIdFlags.NORMAL:
+        data = self.select_view(item_idx)
+        if data is None:
             return INVALID_BYTES
-        offset = item_id.offset
-        length = item_id.length
-
-        # the offset we record is relative to the entire page,
-        # but we need to convert the offset in the filed `self.items`.
-        # this is a small formula to get data bytes
-        offset_of_items = self.item_data_size() - (PAGE_SIZE - offset)
-        item_data = bytes(self.items[offset_of_items: (offset_of_items + length)])
-        return item_data
+        return bytes(data)
+
+    def select_view(self, item_idx: int):
+        """The same as `select()` but return a memoryview over the page buffer
+        instead of a copy. Return None if the item is not valid."""
+        if not (0 <= item_idx < self.item_count):
+            return None
+        offset, flag, length = self.get_item_id(item_idx)
+        if flag != ItemIdFlags.NORMAL:
+            return None
+        return self._view[offset: offset + length]
 
     def update(self, lsn: int, item_idx: int, data: bytes) -> int:
         """We employ both inplace-update and append-only. If the data size is the same,
@@ -273,20 +403,16 @@ class SlotPage:
         :param item_idx: the index of `self.item_ids` list
         :param data: new item data
         """
-        if not (0 <= item_idx < len(self.item_ids)):
+        if not (0 <= item_idx < self.item_count):
             return INVALID_ITEM_ID
-        item_id: ItemIdData = self.item_ids[item_idx]
+        offset, flag, length = self.get_item_id(item_idx)
         # we only can update valid (normal) item
-        if item_id.flag != ItemIdFlags.NORMAL:
+        if flag != ItemIdFlags.NORMAL:
             return INVALID_ITEM_ID
 
-        length = item_id.length
         if len(data) == length:
             # use inplace-update
-            offset = item_id.offset
-            offset_of_items = self.item_data_size() - (PAGE_SIZE - offset)
-            # The following is bytearray's benefit.
-            self.items[offset_of_items: (offset_of_items + length)] = data
+            self.buffer[offset: offset + length] = data
             self.header.lsn = lsn
             self.header.checksum = 0  #TODO: unset
             return item_idx
@@ -305,90 +431,146 @@ class SlotPage:
                 return new_item_idx
         return INVALID_ITEM_ID
 
+    def overwrite(self, lsn: int, item_idx: int, data: bytes) -> bool:
+        """Replace the data of a normal item but keep its item id, so pointers
+        to the item (e.g., index entries) are still valid. Unlike `update()`,
+        a longer data is put into the free space and the item id points to it,
+        and the page is compacted if the free space is not enough.
+        :param lsn: LSN for overwriting
+        :param item_idx: the index of `self.item_ids` list
+        :param data: new item data
+        :return: if the page cannot hold the new data, return false.
+        """
+        if not (0 <= item_idx < self.item_count):
+            return False
+        offset, flag, length = self.get_item_id(item_idx)
+        # we only can overwrite valid (normal) item
+        if flag != ItemIdFlags.NORMAL:
+            return False
+        new_length = len(data)
+        if new_length == 0:
+            return False
+
+        # === the following will be a critical section if it is in concurrency scenario ===
+        #TODO: spin lock
+        if new_length <= length:
+            # the tail becomes a hole until the page is compacted
+            self.buffer[offset: offset + new_length] = data
+            self._zero(offset + new_length, offset + length)
+            self._set_item_id(item_idx, offset, flag, new_length)
+        else:
+            lower, upper = self._get_lower_upper()
+            if upper - lower < new_length:
+                item_ids = [self.get_item_id(i) for i in range(self.item_count)]
+                used_size = sum(item_length for _, _, item_length in item_ids) - length
+                if PAGE_SIZE - lower - used_size < new_length:
+                    return False
+                # drop the old data while compacting
+                item_ids[item_idx] = (offset, flag, 0)
+                self._lay_out_items(item_ids)
+                lower, upper = self._get_lower_upper()
+            else:
+                self._zero(offset, offset + length)
+            new_offset = upper - new_length
+            self.buffer[new_offset: upper] = data
+            self._set_item_id(item_idx, new_offset, flag, new_length)
+            self._set_lower_upper(lower, new_offset)
+        self.header.lsn = lsn
+        self.header.checksum = 0  #TODO: unset
+        # === end critical section ===
+        return True
+
+    def _lay_out_items(self, item_ids):
+        """Move item data together from the end of the page in the order of `item_ids`,
+        and let `item_ids` be the item ids of the page."""
+        # We take one copy of the item data area and lay items out again.
+        lower, upper = self._get_lower_upper()
+        old_items = bytes(self._view[upper:])
+        new_upper = PAGE_SIZE
+        for i, (offset, flag, length) in enumerate(item_ids):
+            new_upper -= length
+            self.buffer[new_upper: new_upper + length] = old_items[offset - upper: offset - upper + length]
+            # Okay, data have been recorded. Later, we should to update the ID information.
+            self._set_item_id(i, new_upper if length else 0, flag, length)
+        new_lower = PAGE_HEADER_SIZE + len(item_ids) * ItemIdData.BYTES
+        self._zero(new_lower, new_upper)
+        self._set_lower_upper(new_lower, new_upper)
+
     def vacuum(self, lsn: int):
         """Clean up dead items, aka, reorganize"""
-        new_item_ids = list()
         # first, pick up
-        for item_id in self.item_ids:
-            if item_id.flag != ItemIdFlags.DEAD:
-                new_item_ids.append(item_id)
-        # then, move normal items together and replace old one
-        # although, the following implementation is not inplace modification for
-        # the item data list. It is easy to implement and friendly to concurrency and
-        # performance may be higher due to underlying implementation?
-        new_data = bytes()
-        new_upper = PAGE_SIZE
-        for item_id in new_item_ids:
-            offset = item_id.offset
-            length = item_id.length
-            offset_of_items = self.item_data_size() - (PAGE_SIZE - offset)
-            item_data = self.items[offset_of_items: (offset_of_items + length)]
-            new_data = item_data + new_data
-            # Okay, data have been recorded. Later, we should to update the ID information.
-            item_id.offset = new_upper - length
-            new_upper = item_id.offset
-        # finally, we should switch old `self.items` to new one.
+        live_item_ids = []
+        for i in range(self.item_count):
+            offset, flag, length = self.get_item_id(i)
+            if flag != ItemIdFlags.DEAD:
+                live_item_ids.append((offset, flag, length))
+        # then, move normal items together and replace old one.
         # === the following will be a critical section if it is in concurrency scenario ===
         #TODO: spin lock
-        self.item_ids = new_item_ids
-        self.items = new_data
+        self._lay_out_items(live_item_ids)
         self.header.lsn = lsn
         self.header.checksum = 0  #TODO: unset
-        self.header.upper = new_upper
-        self.header.lower = self.header.size() + self.item_ids_size()
         # === end critical section ===
 
+    def prune(self, lsn: int) -> int:
+        """Reclaim the space of dead items. Unlike `vacuum()`, the other items keep
+        their item ids, so it is safe even if indexes point to this page. Dead item
+        ids become unused ones that `insert()` can reuse, and unused ones at the end
+        are truncated.
+        :return: the number of reclaimed dead items
+        """
+        item_ids = []
+        pruned_count = 0
+        for i in range(self.item_count):
+            offset, flag, length = self.get_item_id(i)
+            if flag == ItemIdFlags.DEAD:
+                pruned_count += 1
+                item_ids.append((0, ItemIdFlags.UNUSED, 0))
+            elif flag == ItemIdFlags.UNUSED:
+                item_ids.append((0, ItemIdFlags.UNUSED, 0))
+            else:
+                item_ids.append((offset, flag, length))
+        while item_ids and item_ids[-1][1] == ItemIdFlags.UNUSED:
+            item_ids.pop()
+        # === the following will be a critical section if it is in concurrency scenario ===
+        #TODO: spin lock
+        self._lay_out_items(item_ids)
+        self._has_unused_items = any(flag == ItemIdFlags.UNUSED for _, flag, _ in item_ids)
+        self.header.lsn = lsn
+        self.header.checksum = 0  #TODO: unset
+        # === end critical section ===
+        return pruned_count
+
+    def dead_item_count(self):
+        return sum(1 for i in range(self.item_count) if self.get_item_id(i)[1] == ItemIdFlags.DEAD)
+
     def reset(self, lsn: int):
         """Reset the page likes delete all items."""
-        self.item_ids.clear()
-        self.items = bytes()
+        self._zero(PAGE_HEADER_SIZE, PAGE_SIZE)
 
         self.header.lsn = lsn
-        self.header.lower = self.header.size() + self.item_ids_size()
-        self.header.upper = PAGE_SIZE
+        self._has_unused_items = False
+        self._set_lower_upper(PAGE_HEADER_SIZE, PAGE_SIZE)
         self.header.checksum = 0  #TODO: unset
 
     def pack(self) -> bytes:
         """Serialize the class to bytes."""
-        serialized_data = self.header.pack()
-        serialized_data += _get_item_ids_parser(len(self.item_ids)).pack(
-            [item_id.to_uint4() for item_id in self.item_ids]
-        )
-        serialized_data += bytes(self.free_space_size())
-        serialized_data += self.items
-
-        assert len(serialized_data) == PAGE_SIZE
-        return serialized_data
+        return bytes(self.buffer)
 
     @staticmethod
     def unpack(data: bytes):
         """Deserialize bytes to a class."""
-        page = SlotPage()
-        deserialized_position = 0
-        # parse header
-        page_header_size = page.header.size()
-        chunk = data[deserialized_position: (deserialized_position + page_header_size)]
-        page.header.unpack(chunk)
-        deserialized_position += len(chunk)
-        # parse item ids
-        item_ids_size = page.header.lower - page_header_size
-        chunk = data[deserialized_position: (deserialized_position + item_ids_size)]
-        for id_uint4 in _get_item_ids_parser(len(chunk) // ItemIdData.BYTES).unpack(chunk):
-            item_id = ItemIdData()
-            item_id.set_uint4(id_uint4)
-            page.item_ids.append(item_id)
-        # parse item data
-        page.items = data[page.header.upper:]
-        return page
+        assert len(data) == PAGE_SIZE
+        return SlotPage(bytearray(data))
 
     @staticmethod
-    def allocate(lsn=0):
-        page = SlotPage()
+    def allocate(lsn=0, buffer=None):
+        page = SlotPage(buffer)
         page.header.lsn = lsn
         page.header.flags = 0
-        page.header.lower = page.header.size() + page.item_ids_size()
-        page.header.upper = PAGE_SIZE
+        page._set_lower_upper(PAGE_HEADER_SIZE, PAGE_SIZE)
         page.header.checksum = 0  #TODO: unset
+        page._has_unused_items = False
         return page
 
     def __eq__(self, other):
@@ -403,8 +585,7 @@ class SlotPage:
 
     @property
     def item_count(self):
-        return len(self.item_ids)
+        return max(0, (self.header.lower - PAGE_HEADER_SIZE) // ItemIdData.BYTES)
 
     def __repr__(self):
         return f"SlotPage(header={self.header}, item_ids={self.item_ids}, items={self.items})"
-
@@ -1,12 +1,16 @@
 import os
+import struct
+import threading
+import time
 
 from andb.common.cstructure import CStructure, Integer4Field, Integer8Field
-from andb.common.file_operation import directio_file_open, file_close, file_tell, file_extend, file_write, file_read, \
-    file_lseek
+from andb.common.file_operation import directio_file_open, file_close, file_pwrite, file_preadinto, \
+    aligned_buffer
 from andb.constants.filename import WAL_DIR
 from andb.constants.values import WAL_SEGMENT_SIZE, WAL_PAGE_SIZE
 from andb.errno.errors import WALError
-from andb.runtime.global_vars import wal_buffer_size
+from andb.runtime import global_vars
+from andb.storage.engines.heap.walsegment import WALSegmentManager, segment_filename
 from andb.storage.lock.lwlock import LWLockName, lwlock_release, lwlock_acquire
 
 
@@ -23,6 +27,10 @@ class WALAction:
     BTREE_INSERT = 9
     BTREE_DELETE = 10
     BTREE_UPDATE = 11
+    HEAP_VACUUM = 12
+    HEAP_MULTI_INSERT = 13  # tuples inserted into one page
+    UNDO = 14  # compensation record, its payload is the undo record applied
+    BTREE_DELETE_VALUE = 15  # removes one tuple pointer of the key
 
 
 class WALRecord:
@@ -49,6 +57,8 @@ class WALRecord:
 
         # there is some padding bytes follows the tuple due to align
         self._header.padding_size = 0
+        # where the record ends in WAL, only set by replay
+        self.lsn = 0
 
     def pack(self):
         return self._header.pack() + self.data
@@ -172,13 +182,22 @@ class WALPage:
         return o
 
 
+# pack headers into the WAL buffer directly, the same layouts as the CStructures
+_RECORD_HEADER = struct.Struct(WALRecord.Header.__cformat__)
+_PAGE_HEADER = struct.Struct(WALPage.Header.__cformat__)
+# a record is split once at most, so the data of a record this size always fits
+# even if the current page only has room for a record header
+MAX_RECORD_DATA_SIZE = WAL_PAGE_SIZE - _PAGE_HEADER.size - _RECORD_HEADER.size
+_ZERO_PAGE = bytes(WAL_PAGE_SIZE)
+
+
 def lsn_to_filename(lsn):
     """LSN is a 64bit-length integer, but WAL files organize by segments.
     In order to directly locate which file the corresponding log content
     is in according to the LSN, we can generate the corresponding WAL file name
     according to the LSN according to a conversion algorithm.
     """
-    return '%016X' % (lsn // WAL_SEGMENT_SIZE)
+    return segment_filename(lsn // WAL_SEGMENT_SIZE)
 
 
 class WALManager:
@@ -186,135 +205,187 @@ class WALManager:
         self.write_lsn = 0
         self.flush_lsn = 0
 
-        self.wal_buffer = []  # contains WALPage
+        # The WAL buffer is a ring of pages, the page of an LSN is at
+        # slot (lsn // WAL_PAGE_SIZE) % buffer_pages. The memory is aligned,
+        # so slices of it can be written with O_DIRECT.
+        # A split record needs two pages at least.
+        self.buffer_pages = max(2, global_vars.wal_buffer_size)
+        self.wal_buffer = aligned_buffer(self.buffer_pages * WAL_PAGE_SIZE)
+        self._buffer_view = memoryview(self.wal_buffer)
 
         self.current_wal_fd = None
+        self.segment_manager = WALSegmentManager(WAL_DIR)
+        # keeps the next segments ready, see walsegment.py
+        self.wal_preallocator = None
+
+        # group commit: committers wait on the condition, and one of them
+        # (the leader) flushes for all of them
+        self._flush_cond = threading.Condition()
+        self._flushing = False
+        self._flush_waiters = 0
+        self.group_flushes = 0
+
+        # flushes asynchronous commits, see walwriter.py
+        self.wal_writer = None
 
     def max_lsn(self):
         return self.write_lsn
 
-    def write_record(self, record: WALRecord):
+    def set_lsn(self, lsn):
+        """Continue writing from `lsn` (e.g., the end of WAL files). It is rounded up
+        to a page boundary, since a flush rewrites the whole last page."""
+        if lsn % WAL_PAGE_SIZE != 0:
+            lsn += WAL_PAGE_SIZE - lsn % WAL_PAGE_SIZE
+        self.write_lsn = lsn
+        self.flush_lsn = lsn
+
+    def _buffer_offset(self, lsn):
+        return (lsn // WAL_PAGE_SIZE) % self.buffer_pages * WAL_PAGE_SIZE + lsn % WAL_PAGE_SIZE
+
+    def _begin_page(self, last_page_written_size):
+        assert self.write_lsn % WAL_PAGE_SIZE == 0
+        # the slot is still held by an unflushed page
+        if self.write_lsn - self.flush_lsn > (self.buffer_pages - 1) * WAL_PAGE_SIZE:
+            self.wal_buffer_flush()
+        offset = self._buffer_offset(self.write_lsn)
+        # a flush writes whole pages, so clear the tail
+        self.wal_buffer[offset: offset + WAL_PAGE_SIZE] = _ZERO_PAGE
+        _PAGE_HEADER.pack_into(self.wal_buffer, offset, self.write_lsn, last_page_written_size)
+        self.write_lsn += _PAGE_HEADER.size
+
+    def _put_record(self, header, action, data):
+        """Copy a record into the current page, it must fit in."""
+        offset = self._buffer_offset(self.write_lsn)
+        total_size = _RECORD_HEADER.size + len(data)
+        remaining = WAL_PAGE_SIZE - offset % WAL_PAGE_SIZE - total_size
+        assert remaining >= 0
+        # if the remaining space cannot contain a record header,
+        # pad the page with blank bytes
+        padding_size = remaining if remaining <= _RECORD_HEADER.size else 0
+        _RECORD_HEADER.pack_into(self.wal_buffer, offset, total_size, padding_size,
+                                 header.xid, header.oid, header.pageno, header.tid, action)
+        self.wal_buffer[offset + _RECORD_HEADER.size: offset + total_size] = data
+        self.write_lsn += total_size + padding_size
+        return padding_size
+
+    def write_record(self, record: WALRecord, asynchronous=False):
         """
         Write a record to the WAL buffer.
         If the record is too large for the current page:
         1. Split it into two records
         2. Write the first part with TO_BE_CONTINUED flag
         3. Create a new page for the remaining part
-        """
-        lwlock_acquire(LWLockName.WAL_WRITE)
-
-        # Create new WAL page if buffer is empty
-        if len(self.wal_buffer) == 0:
-            wal_page = WALPage(self.max_lsn(), 0)
-            self.write_lsn += WALPage.Header.size()
-            self.wal_buffer.append(wal_page)
 
-        # Find first non-full WAL page
-        wal_page = None
-        i = 0
-        while i < len(self.wal_buffer):
-            p = self.wal_buffer[i]
-            if not p.is_full():
-                wal_page = p
-                break
-            i += 1
-
-        if i != len(self.wal_buffer):
-            assert not wal_page.is_full()
-
-        # Create new page if all pages are full
-        if wal_page is None:
-            wal_page = WALPage(self.max_lsn(), 0)
-            assert len(wal_page.pack()) == WALPage.Header.size()
-            self.write_lsn += WALPage.Header.size()
-            self.wal_buffer.append(wal_page)
-
-        # Handle record splitting if it doesn't fit in current page
-        if not wal_page.append_record(record):
-            remaining = wal_page.calc_remaining_size(record)
-            if remaining >= (WAL_PAGE_SIZE - WALPage.Header.size() - WALRecord.Header.size()):
-                #TODO: release locks if ...
-                lwlock_release(LWLockName.WAL_WRITE)
-                # xxx: this is a critical section!! Rollback above allocation?
-                raise WALError('Not supported huge WAL record.')
-
-            # Split record into two parts
-            written_size = record._header.total_size - WALRecord.Header.size() - remaining
-            written_record = WALRecord(record._header.xid, record._header.oid, record._header.pageno, record._header.tid, WALAction.TO_BE_CONTINUED, record.data[:written_size])
-            remaining_record = WALRecord(record._header.xid, record._header.oid, record._header.pageno, record._header.tid, record._header.action, record.data[written_size:])
-            
-            success = wal_page.append_record(written_record)
-            assert success
-            assert WAL_PAGE_SIZE == len(wal_page.pack())
-            # we already increased the size of header
-            self.write_lsn += written_record._header.total_size
-
-            wal_page = WALPage(self.max_lsn(), written_size)
-            assert len(wal_page.pack()) == WALPage.Header.size()
-            self.write_lsn += WALPage.Header.size()
-            self.wal_buffer.append(wal_page)
-            wal_page.append_record(remaining_record)
-            record = remaining_record
-
-        self.write_lsn += record._header.total_size
-        self.write_lsn += record._header.padding_size  # if has
-
-        # Flush buffer on commit/abort or when buffer is full
-        if (record._header.action == WALAction.COMMIT or
-                record._header.action == WALAction.ABORT or
-                len(self.wal_buffer) >= wal_buffer_size):
-            self.wal_buffer_flush()
+        A commit/abort record is flushed before returning, unless it is
+        `asynchronous`, which leaves it to the WAL writer.
 
-        lwlock_release(LWLockName.WAL_WRITE)
+        Return the LSN of the end of the record.
+        """
+        header = record._header
+        data = memoryview(record.data)
+        lwlock_acquire(LWLockName.WAL_WRITE)
+        try:
+            if self.write_lsn % WAL_PAGE_SIZE == 0:
+                self._begin_page(0)
 
-    def wal_buffer_flush(self):
-        i = 0
-        while i < len(self.wal_buffer):
-            wal_page: WALPage = self.wal_buffer[i]
-            filename = lsn_to_filename(wal_page.header.lsn)
-            if self.current_wal_fd is None:
-                self.current_wal_fd = directio_file_open(
-                    os.path.join(WAL_DIR, filename),
-                    os.O_RDWR | os.O_CREAT
-                )
-            elif filename != os.path.basename(self.current_wal_fd.filepath):
-                file_close(self.current_wal_fd)
-                self.current_wal_fd = directio_file_open(
-                    os.path.join(WAL_DIR, filename),
-                    os.O_RDWR | os.O_CREAT
-                )
-                # pre-allocate
-                file_extend(self.current_wal_fd, size=WAL_SEGMENT_SIZE)
-
-            flush_location = self.flush_lsn % WAL_SEGMENT_SIZE
-            write_location = self.write_lsn % WAL_SEGMENT_SIZE
-            if write_location < flush_location:
-                # this is because they are in the different segments
-                write_location += WAL_PAGE_SIZE  # adjustment
-
-            # determine if write_location and flush_location in a same page
-            n = flush_location // WAL_PAGE_SIZE
-            in_a_same_page = n * WAL_PAGE_SIZE <= flush_location <= write_location < (n + 1) * WAL_PAGE_SIZE
-            if in_a_same_page:
-                data = wal_page.pack()[ - (write_location % WAL_PAGE_SIZE - flush_location % WAL_PAGE_SIZE):]
-                assert len(data) == write_location % WAL_PAGE_SIZE - flush_location % WAL_PAGE_SIZE
+            available = WAL_PAGE_SIZE - self.write_lsn % WAL_PAGE_SIZE
+            if header.total_size <= available:
+                header.padding_size = self._put_record(header, header.action, data)
+            else:
+                remaining = header.total_size - available
+                if remaining >= (WAL_PAGE_SIZE - WALPage.Header.size() - WALRecord.Header.size()):
+                    raise WALError('Not supported huge WAL record.')
+                # Split record into two parts, the first one fills up the page
+                written_size = available - WALRecord.Header.size()
+                self._put_record(header, WALAction.TO_BE_CONTINUED, data[:written_size])
+                self._begin_page(written_size)
+                header.padding_size = self._put_record(header, header.action, data[written_size:])
+            record_end_lsn = self.write_lsn
+        finally:
+            lwlock_release(LWLockName.WAL_WRITE)
+
+        if (header.action == WALAction.COMMIT or
+                header.action == WALAction.ABORT):
+            if asynchronous and self.wal_writer is not None:
+                self.wal_writer.notify()
             else:
-                assert wal_page.is_full()
-                assert len(wal_page.pack()) == WAL_PAGE_SIZE
-                data = wal_page.pack()[flush_location % WAL_PAGE_SIZE:]
+                self.flush(record_end_lsn)
+        return record_end_lsn
 
-            file_write(self.current_wal_fd, data, sync=True)
-            self.flush_lsn += len(data)  # don't forget it!
-            assert wal_page.header.lsn <= self.write_lsn
+    def flush(self, lsn):
+        """Make sure the WAL is durable up to `lsn`. It is used by committers
+        and by data pages before being written (WAL-before-data).
 
-            # evict worthless page
-            if wal_page.is_full():
-                self.wal_buffer.pop(i)
-                assert wal_page.header.lsn <= self.flush_lsn
-                assert i == 0
-                i -= 1
+        Group commit: if someone is flushing, wait for it and check again,
+        otherwise, become the leader and flush everything written so far,
+        which usually covers the other waiters too.
+        """
+        if self.flush_lsn >= lsn:
+            return
+        with self._flush_cond:
+            self._flush_waiters += 1
+            try:
+                while self._flushing and self.flush_lsn < lsn:
+                    self._flush_cond.wait()
+                if self.flush_lsn >= lsn:
+                    return
+                self._flushing = True
+                siblings = self._flush_waiters - 1
+            finally:
+                self._flush_waiters -= 1
+
+        try:
+            # like commit_delay of PostgreSQL, wait a moment for more
+            # records to join this flush if there are enough concurrent
+            # committers
+            if global_vars.commit_delay > 0 and siblings >= global_vars.commit_siblings:
+                time.sleep(global_vars.commit_delay / 1000000)
+            lwlock_acquire(LWLockName.WAL_WRITE)
+            try:
+                self.wal_buffer_flush()
+                self.group_flushes += 1
+            finally:
+                lwlock_release(LWLockName.WAL_WRITE)
+        finally:
+            with self._flush_cond:
+                self._flushing = False
+                self._flush_cond.notify_all()
 
-            i += 1
+    def wal_buffer_flush(self):
+        """Write [flush_lsn, write_lsn) of the WAL buffer and fsync, the caller
+        should hold WAL_WRITE. Writes are rounded out to whole pages, which
+        O_DIRECT requires, so the last page may be written again next time."""
+        start = self.flush_lsn - self.flush_lsn % WAL_PAGE_SIZE
+        end = self.write_lsn
+        while start < end:
+            segment_end = start - start % WAL_SEGMENT_SIZE + WAL_SEGMENT_SIZE
+            offset = self._buffer_offset(start)
+            # stop at the end of the segment or the ring
+            stop = min(end, segment_end, start + len(self.wal_buffer) - offset)
+            size = stop - start
+            if size % WAL_PAGE_SIZE != 0:
+                size += WAL_PAGE_SIZE - size % WAL_PAGE_SIZE
+
+            wal_fd = self._open_segment(start)
+            file_pwrite(wal_fd, self._buffer_view[offset: offset + size], start % WAL_SEGMENT_SIZE,
+                        sync=(stop == end or stop == segment_end))
+            start = stop
+        self.flush_lsn = end
+
+    def _open_segment(self, lsn):
+        filepath = os.path.join(WAL_DIR, lsn_to_filename(lsn))
+        if self.current_wal_fd is not None and self.current_wal_fd.filepath != filepath:
+            file_close(self.current_wal_fd)
+            # moved to a new segment, prepare the ones after it
+            if self.wal_preallocator is not None:
+                self.wal_preallocator.notify()
+        # always go through the fd cache, since others (e.g., replay)
+        # may have closed it
+        self.current_wal_fd = self.segment_manager.open_segment(lsn // WAL_SEGMENT_SIZE)
+        return self.current_wal_fd
+
+    def segment_usage(self):
+        return self.segment_manager.usage(self.write_lsn // WAL_SEGMENT_SIZE)
 
     @staticmethod
     def replay(lsn):
@@ -323,6 +394,7 @@ class WALManager:
 
         current_lsn = lsn
         hold_incomplete_record = None
+        page_buffer = aligned_buffer(WAL_PAGE_SIZE)
         while True:
             filename = os.path.join(WAL_DIR, lsn_to_filename(current_lsn))
             if not os.path.exists(filename):
@@ -342,15 +414,23 @@ class WALManager:
                 # align to page size
                 lsn_segment -= lsn_segment % WAL_PAGE_SIZE
 
-            file_lseek(wal_fd, lsn_segment)
-            page_bytes = file_read(wal_fd, WAL_PAGE_SIZE)
+            # O_DIRECT needs an aligned buffer
+            n = file_preadinto(wal_fd, page_buffer, lsn_segment)
             # break if the remaining bytes is empty
-            if len(page_bytes) == 0:
+            if not n:
                 break
-            wal_page = WALPage.unpack(page_bytes)
+            if n < _PAGE_HEADER.size or \
+                    _PAGE_HEADER.unpack_from(page_buffer)[0] != current_lsn - current_lsn % WAL_PAGE_SIZE:
+                # a zero-filled page or an old page of a recycled segment,
+                # so it is the end of WAL
+                break
+            wal_page = WALPage.unpack(page_buffer[:n])
 
             i = 0
             while i < len(wal_page.records):
+                if len(wal_page.records) - i < WALRecord.Header.size():
+                    # padding bytes at the end of the page
+                    break
                 record_size = WALRecord.parse_record_size(wal_page.records[i: i + WALRecord.Header.size()])
                 if record_size == 0:
                     # reach padding empty bytes
@@ -369,6 +449,7 @@ class WALManager:
                                             action=record.action, data=data)
                     # skip gotten record
                     if i + record_size > current_lsn % WAL_PAGE_SIZE:
+                        record.lsn = wal_page.header.lsn + WALPage.Header.size() + i + record_size
                         yield record
                 i += record_size
 
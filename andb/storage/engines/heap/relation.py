@@ -1,58 +1,181 @@
 import logging
 import os
+import threading
 
 from andb.catalog.class_ import RelationKinds
 from andb.catalog.oid import OID_DATABASE_ANDB, INVALID_OID
-from andb.catalog.syscache import CATALOG_ANDB_CLASS, CATALOG_ANDB_TYPE, CATALOG_ANDB_ATTRIBUTE, CATALOG_ANDB_DATABASE, \
+from andb.catalog.syscache import CATALOG_ANDB_CLASS, CATALOG_ANDB_ATTRIBUTE, CATALOG_ANDB_DATABASE, \
     CATALOG_ANDB_INDEX
-from andb.catalog.type import VARIABLE_LENGTH, VARIABLE_TYPE_HEADER_LENGTH, VarcharType
-from andb.common.file_operation import directio_file_open, file_touch, file_size, file_close, file_write, file_open, \
-    file_remove, file_read, file_lseek
+from andb.common.file_operation import directio_file_open, file_touch, file_size, file_close, file_open, \
+    file_remove, file_pread, file_pwrite
 from andb.common.utils import filesize_to_pageno
 from andb.constants.filename import BASE_DIR
-from andb.constants.strings import BIG_END
-from andb.constants.values import MAX_TABLE_COLUMNS, PAGE_SIZE
+from andb.constants.macros import INVALID_XID
+from andb.constants.values import PAGE_SIZE
 from andb.errno.errors import RollbackError, DDLException
 from andb.runtime import global_vars
 from andb.storage.engines.heap.page import INVALID_BYTES
-from andb.storage.engines.heap.page import INVALID_ITEM_ID
-from andb.storage.engines.heap.bptree import BPlusTree, TuplePointer, create_node
-from andb.storage.engines.heap.redo import WALAction, WALRecord
+from andb.storage.engines.heap.page import INVALID_ITEM_ID, ItemIdData
+from andb.storage.engines.heap.bptree import BPlusTree, InternalNode, TuplePointer, create_node
+from andb.storage.engines.heap.codec import get_tuple_codec
+from andb.storage.engines.heap.fsm import INVALID_PAGENO, get_fsm, drop_fsm
+from andb.storage.engines.heap.mvcc import form_heap_tuple, heap_tuple_header, heap_tuple_data, \
+    set_heap_tuple_xmax, visible_version, check_write_conflict, HEAP_TUPLE_HEADER_SIZE
+from andb.storage.engines.heap.redo import WALAction, WALRecord, MAX_RECORD_DATA_SIZE
 from andb.storage.engines.heap.undo import UndoOperation, UndoRecord
+from andb.storage.engines.heap.vacuum import dead_item_tracker, report_dead_items
 from andb.storage.lock import rlock
-from andb.storage.utils import easy_tuple_serialize
+from andb.storage.lock.lwlock import SharedExclusiveLatch
+from andb.storage.engines.heap.walpayload import encode_btree_entry, encode_btree_key, encode_tid_list, \
+    encode_multi_insert, encode_tuple_list, multi_insert_size
 
 
 class BufferedBPTree(BPlusTree):
-    def __init__(self, relation):
-        file_lseek(relation.fd, offset=0)
-        header_size = BPlusTree.Header.size()
-        root_pageno = self.deserialize_header(file_read(relation.fd, header_size)).root_pageno
-        assert root_pageno >= 0
-        buffer_page = global_vars.buffer_manager.get_page(relation, root_pageno)
-        global_vars.buffer_manager.pin_page(buffer_page)
-
-        super().__init__(root_node=buffer_page.page)
+    """The B+ tree of an index relation, whose nodes are pages in the buffer
+    pool. The pages used by an operation are pinned until `release()`, so the
+    nodes in hand are never evicted and read again as other objects.
+
+    The tree is latched until `release()` as well, exclusively by default, or
+    shared if `shared` is True and the operation only reads the tree."""
+
+    def __init__(self, relation, shared=False):
         self.relation = relation
+        self._pinned = []
+        self._latch = _bt_latch(relation.oid)
+        self._shared = shared
+        if shared:
+            self._latch.acquire_shared()
+        else:
+            self._latch.acquire()
+        try:
+            header_size = BPlusTree.Header.size()
+            root_pageno = self.deserialize_header(file_pread(relation.fd, header_size, 0)).root_pageno
+            assert root_pageno >= 0
+            super().__init__(root_node=self._get_buffer_page(root_pageno).page)
+        except BaseException:
+            self.release()
+            raise
         self.dirty_pageno = []
 
+    def _get_buffer_page(self, pageno):
+        buffer_page = global_vars.buffer_manager.get_page(self.relation, pageno, pin=True)
+        self._pinned.append(buffer_page)
+        return buffer_page
+
+    def release(self):
+        if self._latch is None:
+            return
+        for buffer_page in self._pinned:
+            global_vars.buffer_manager.unpin_page(buffer_page)
+        self._pinned = []
+        if self._shared:
+            self._latch.release_shared()
+        else:
+            self._latch.release()
+        self._latch = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
     def load_page(self, pageno):
-        node = global_vars.buffer_manager.get_page(self.relation, pageno).page
+        node = self._get_buffer_page(pageno).page
         assert node.get_pageno() == pageno
         return node
 
+    def _unload(self, node):
+        # unpin the node as soon as a scan goes on to the next leaf
+        pageno = node.get_pageno()
+        for i in range(len(self._pinned) - 1, -1, -1):
+            if self._pinned[i].pageno == pageno:
+                global_vars.buffer_manager.unpin_page(self._pinned.pop(i))
+                return
+
+    def _load(self, node):
+        # a node referred by its parent or left sibling may have been evicted
+        # and read again, only the one in the buffer pool is up to date
+        return self.load_page(node.get_pageno())
+
+    def mark_dirty(self, node):
+        super().mark_dirty(node)
+        # let the buffer manager know, so that the page will be written back.
+        buffer_page = global_vars.buffer_manager.lookup_page(self.relation, node.get_pageno())
+        if buffer_page is not None and buffer_page.page is node:
+            buffer_page.mark_dirty()
+
+    def _allocate_pageno(self):
+        return _bt_allocate_pageno(self.relation)
+
     def _allocate_node(self, is_leaf):
         node = super()._allocate_node(is_leaf)
-        buffer_page = global_vars.buffer_manager.create_buffer_page(self.relation, node.get_pageno(), node)
-        buffer_page.mark_dirty()  # new node must be dirty
+        self._put_node(node)
         return node
 
+    def _put_node(self, node):
+        # nodes allocated by splits live in the buffer pool like the others
+        buffer_manager = global_vars.buffer_manager
+        buffer_page = buffer_manager.create_buffer_page(self.relation, node.get_pageno(), node)
+        buffer_manager.put_page(buffer_page, pin=True)
+        self._pinned.append(buffer_page)
+        self.mark_dirty(node)
+
+    def _grow_root(self, lsn, left, right, separator):
+        # the root stays in its page, so the header never changes: the old
+        # root moves to a new page, and the root page becomes their parent
+        root_pageno = left.get_pageno()
+        left.set_pageno(self._allocate_pageno())
+        left.lsn = lsn
+        self._put_node(left)
+
+        root = InternalNode()
+        root.set_pageno(root_pageno)
+        root.lsn = lsn
+        root.keys.append(separator)
+        root.children.append(left)
+        root.children.append(right)
+        buffer_page = global_vars.buffer_manager.lookup_page(self.relation, root_pageno)
+        buffer_page.set_page(root)
+        self.root = root
+        self.mark_dirty(root)
+
     def _need_to_split(self, node):
         #TODO: user-defined load factor
         return super()._need_to_split(node)
 
 
+# latches of B-tree indexes, see `BufferedBPTree`
+_bt_latches = {}
+_bt_latches_lock = threading.Lock()
+
+
+def _bt_latch(oid):
+    with _bt_latches_lock:
+        latch = _bt_latches.get(oid)
+        if latch is None:
+            latch = _bt_latches[oid] = SharedExclusiveLatch()
+        return latch
+
+
+# the next pageno of each B-tree index, pages allocated by splits may be
+# only in the buffer pool, so the file size is not enough
+_bt_next_pageno = {}
+_bt_pageno_lock = threading.Lock()
+
+
+def _bt_allocate_pageno(relation):
+    with _bt_pageno_lock:
+        pageno = _bt_next_pageno.get(relation.oid)
+        if pageno is None:
+            pageno = -(-(file_size(relation.fd) - BPlusTree.Header.size()) // PAGE_SIZE)
+        _bt_next_pageno[relation.oid] = pageno + 1
+    return pageno
+
+
 __relcache = {}
+# sessions open and close relations concurrently
+__relcache_lock = threading.Lock()
 
 
 class Relation:
@@ -65,6 +188,7 @@ class Relation:
         self.refcount = 0
         self.kind = None
         self._last_pageno = None
+        self._codec = None
 
     @property
     def is_heap(self):
@@ -88,6 +212,23 @@ class Relation:
     def increase_last_pageno(self):
         self._last_pageno = self.last_pageno() + 1
 
+    @property
+    def codec(self):
+        # compiled once per opened relation, an index relation codes its key columns
+        if self._codec is None:
+            if self.is_heap:
+                attr_form_array = self.attrs
+            else:
+                attr_form_array = CATALOG_ANDB_INDEX.get_attr_form_array(self.oid)
+            self._codec = get_tuple_codec(attr_form_array)
+        return self._codec
+
+    def __getstate__(self):
+        # relations are pickled into undo records, the codec can be rebuilt
+        state = self.__dict__.copy()
+        state['_codec'] = None
+        return state
+
     def __repr__(self):
         if self.oid == INVALID_OID:
             return '<InvalidRelation>'
@@ -111,55 +252,11 @@ class TupleData:
         return str(self.python_tuple)
 
     def to_bytes(self, andb_attr_form_array):
-        assert len(andb_attr_form_array) == len(self.python_tuple)
-        nulls = 0x0000000000000000
-
-        byte_array = bytearray()
-        for i, form in enumerate(andb_attr_form_array):
-            datum = self.python_tuple[i]
-            if datum is None:
-                # update nulls
-                if form.notnull:
-                    raise RollbackError(f'the field {form.name} cannot be null.')
-
-                assert i < MAX_TABLE_COLUMNS
-                nulls |= (1 << i)
-            else:
-                # as varchar is fixed length, we should truncate it here
-                if form.type_oid == VarcharType.oid:
-                    datum = datum[:form.length]
-                bytes_ = CATALOG_ANDB_TYPE.cast_datum_to_bytes(
-                    CATALOG_ANDB_TYPE.get_type_name(form.type_oid),
-                    datum)
-                byte_array.extend(bytes_)
-
-        # concatenate nulls and data
-        nulls_bytes = int.to_bytes(nulls, length=self.NULLS_BYTES, byteorder=BIG_END)
-        return nulls_bytes + bytes(byte_array)
+        return get_tuple_codec(andb_attr_form_array).encode(self.python_tuple)
 
     @classmethod
     def from_bytes(cls, data, andb_attr_form_array):
-        if len(data) < cls.NULLS_BYTES:
-            raise RollbackError('the data corrupt')
-        nulls = int.from_bytes(data[:cls.NULLS_BYTES], byteorder=BIG_END)
-        values = []
-        bytes_cursor = cls.NULLS_BYTES  # starts from real data
-        for i, attr_form in enumerate(andb_attr_form_array):
-            if nulls & (1 << i) == (1 << i):
-                values.append(None)
-            else:
-                type_name = CATALOG_ANDB_TYPE.get_type_name(attr_form.type_oid)
-                type_form = CATALOG_ANDB_TYPE.get_type_form(type_name)
-                length = attr_form.length
-                if length == VARIABLE_LENGTH:
-                    length = type_form.bytes_length(
-                        data[bytes_cursor: bytes_cursor + VARIABLE_TYPE_HEADER_LENGTH]) + VARIABLE_TYPE_HEADER_LENGTH
-                value = CATALOG_ANDB_TYPE.cast_bytes_to_datum(
-                    type_name, data[bytes_cursor: bytes_cursor + length]
-                )
-                values.append(value)
-                bytes_cursor += length
-        return cls(tuple(values))
+        return cls(get_tuple_codec(andb_attr_form_array).decode(data))
 
 
 # def search_relation(relation_name, database_name, kind):
@@ -182,27 +279,33 @@ class TupleData:
 
 
 def open_relation(oid, lock_mode=rlock.ACCESS_SHARE_LOCK):
-    if oid in __relcache:
-        relation = __relcache[oid]
-    else:
-        results = CATALOG_ANDB_CLASS.search(lambda r: r.oid == oid)
-        if len(results) != 1:
-            return None
-
-        class_meta = results[0]
-        relation = Relation(
-            oid=oid, database_oid=class_meta.database_oid, name=class_meta.name
-        )
-        relation.attrs = CATALOG_ANDB_ATTRIBUTE.search(lambda r: r.class_oid == oid)
-        relation.kind = class_meta.kind
-        __relcache[oid] = relation
-
-    # try to get lock
+    # lock it first, since the relation may be dropped while waiting for the lock
     if lock_mode != rlock.NO_LOCK:
-        if rlock.lock_acquire(oid, lock_mode, False, 0) == rlock.LOCK_NOT_AVAILABLE:
+        rc = rlock.lock_acquire(oid, lock_mode, False, global_vars.lock_timeout / 1000)
+        if rc == rlock.LOCK_DEADLOCK:
+            raise RollbackError('deadlock detected.')
+        if rc == rlock.LOCK_NOT_AVAILABLE:
             return None
 
-    relation.refcount += 1
+    with __relcache_lock:
+        if oid in __relcache:
+            relation = __relcache[oid]
+        else:
+            results = CATALOG_ANDB_CLASS.search(lambda r: r.oid == oid)
+            if len(results) != 1:
+                if lock_mode != rlock.NO_LOCK:
+                    rlock.lock_release(oid, lock_mode)
+                return None
+
+            class_meta = results[0]
+            relation = Relation(
+                oid=oid, database_oid=class_meta.database_oid, name=class_meta.name
+            )
+            relation.attrs = CATALOG_ANDB_ATTRIBUTE.search(lambda r: r.class_oid == oid)
+            relation.kind = class_meta.kind
+            __relcache[oid] = relation
+
+        relation.refcount += 1
     return relation
 
 
@@ -211,10 +314,21 @@ def close_relation(oid, lock_mode=rlock.ACCESS_SHARE_LOCK):
     if lock_mode != rlock.NO_LOCK:
         if not rlock.lock_release(relation.oid, lock_mode):
             raise RollbackError('cannot release lock')
-    relation.refcount -= 1
-    if relation.refcount == 0:
-        relation.opened = False
-        del __relcache[oid]
+    with __relcache_lock:
+        relation.refcount -= 1
+        if relation.refcount == 0:
+            relation.opened = False
+            del __relcache[oid]
+
+
+def _open_relation_to_drop(oid):
+    relation = open_relation(oid, rlock.ACCESS_EXCLUSIVE_LOCK)
+    if relation and relation.refcount > 1:
+        # other sessions wait for the lock, but this one does not wait for
+        # itself, the relation is still open by its own scans
+        close_relation(oid, rlock.ACCESS_EXCLUSIVE_LOCK)
+        return None
+    return relation
 
 
 def hot_create_table(table_name, fields, database_oid=OID_DATABASE_ANDB):
@@ -244,11 +358,13 @@ def hot_drop_table(table_name, database_oid=OID_DATABASE_ANDB):
     if len(results) > 0:
         raise DDLException('there are indexes associated with the table.')
 
-    relation = open_relation(oid, rlock.ACCESS_EXCLUSIVE_LOCK)
+    relation = _open_relation_to_drop(oid)
     if not relation:
         raise DDLException('cannot drop the table because the table is in use.')
     file_close(relation.fd)
     os.unlink(os.path.join(BASE_DIR, str(database_oid), str(oid)))
+    drop_fsm(relation)
+    dead_item_tracker.forget(oid)
     CATALOG_ANDB_ATTRIBUTE.delete(lambda r: r.class_oid == oid)
     CATALOG_ANDB_CLASS.delete(lambda r: r.oid == oid)
 
@@ -258,69 +374,51 @@ def hot_drop_table(table_name, database_oid=OID_DATABASE_ANDB):
     return True
 
 
+def _insert_candidates(relation: Relation, fsm, size):
+    # try the page that fsm suggests first, then the last page, finally
+    # a new page
+    candidates = []
+    fsm_pageno = fsm.get_page_with_free_space(size + ItemIdData.BYTES)
+    if fsm_pageno != INVALID_PAGENO:
+        candidates.append(fsm_pageno)
+    last_pageno = relation.last_pageno()
+    candidates.extend(pageno for pageno in (last_pageno, last_pageno + 1) if pageno != fsm_pageno)
+    return candidates
+
+
 def hot_simple_insert(relation: Relation, python_tuple, lsn=None):
     # no redo and undo log here, only update cached page
-    #TODO: find from fsm first
-    pageno = relation.last_pageno()
-    buffer_page = global_vars.buffer_manager.get_page(relation, pageno)
     xid = global_vars.xact_manager.get_xid()
     wip_lsn = 0  # work in progress LSN
-    tuple_bytes = TupleData(python_tuple).to_bytes(relation.attrs)
-    tid = buffer_page.page.insert(wip_lsn, tuple_bytes)
-    if tid == INVALID_ITEM_ID:
-        # maybe the page is full, get next pageno
-        buffer_page = global_vars.buffer_manager.get_page(relation, pageno + 1)
+    tuple_bytes = form_heap_tuple(xid, relation.codec.encode(python_tuple))
+    fsm = get_fsm(relation)
+    candidates = _insert_candidates(relation, fsm, len(tuple_bytes))
+    for pageno in candidates:
+        # pinned until the modification is done, see below
+        buffer_page = global_vars.buffer_manager.get_page(relation, pageno, pin=True)
+        buffer_page.content_lock.acquire()
         tid = buffer_page.page.insert(wip_lsn, tuple_bytes)
-        if tid == INVALID_ITEM_ID:
-            # still be error? raise the error
-            raise RollbackError('cannot insert the tuple')
-    buffer_page.mark_dirty()
-    
-    # write logs
-    undo_record = UndoRecord(xid,
-                             UndoOperation.HEAP_INSERT,
-                             relation, (pageno, tid),
-                             b'')
-    redo_record = WALRecord(
-        xid, relation.oid, pageno, tid, WALAction.HEAP_INSERT, tuple_bytes
-    )
-    global_vars.xact_manager.undo_manager.write_record(undo_record)
-    global_vars.xact_manager.wal_manager.write_record(redo_record)
-
-    # update page header LSN
-    if lsn is None:
-        lsn = global_vars.xact_manager.max_lsn()
-    buffer_page.page.header.lsn = lsn
-
-    return buffer_page.pageno, tid
-
-
-def hot_simple_update(relation: Relation, pageno, tid, python_tuple):
-    # use a same LSN
-    lsn = global_vars.xact_manager.max_lsn()
-    if hot_simple_delete(relation, pageno, tid, lsn=lsn):
-        return hot_simple_insert(relation, python_tuple, lsn=lsn)
-
-
-def hot_simple_delete(relation: Relation, pageno, tid, lsn=None):
-    #TODO: update fsm? or only reorganize?
-    buffer_page = global_vars.buffer_manager.get_page(relation, pageno)
-    xid = global_vars.xact_manager.get_xid()
-    old_tuple_bytes = buffer_page.page.select(tid)
-    if old_tuple_bytes == INVALID_BYTES:
-        return False
+        fsm.record_free_space(pageno, buffer_page.page.free_space_size())
+        if tid != INVALID_ITEM_ID:
+            break
+        buffer_page.content_lock.release()
+        global_vars.buffer_manager.unpin_page(buffer_page)
+    else:
+        # still be error? raise the error
+        raise RollbackError('cannot insert the tuple')
 
-    wip_lsn = 0  # work in progress LSN
-    success = buffer_page.page.delete_inplace(wip_lsn, tid)
-    if success:
+    # hold the content lock until the page LSN is set, otherwise the page
+    # could be written out before its WAL record
+    try:
         buffer_page.mark_dirty()
+
         # write logs
         undo_record = UndoRecord(xid,
-                                UndoOperation.HEAP_DELETE,
-                                relation, (pageno, tid),
-                                old_tuple_bytes)
+                                 UndoOperation.HEAP_INSERT,
+                                 relation, (buffer_page.pageno, tid),
+                                 b'')
         redo_record = WALRecord(
-            xid, relation.oid, pageno, tid, WALAction.HEAP_DELETE, b''
+            xid, relation.oid, buffer_page.pageno, tid, WALAction.HEAP_INSERT, tuple_bytes
         )
         global_vars.xact_manager.undo_manager.write_record(undo_record)
         global_vars.xact_manager.wal_manager.write_record(redo_record)
@@ -329,55 +427,260 @@ def hot_simple_delete(relation: Relation, pageno, tid, lsn=None):
         if lsn is None:
             lsn = global_vars.xact_manager.max_lsn()
         buffer_page.page.header.lsn = lsn
-    return success
+    finally:
+        buffer_page.content_lock.release()
+        global_vars.buffer_manager.unpin_page(buffer_page)
+
+    return buffer_page.pageno, tid
 
-def hot_batch_delete(relation: Relation, pageno, tid_list):
-    # using mark-and-vacuum to delete
-    buffer_page = global_vars.buffer_manager.get_page(relation, pageno)
-    xid = global_vars.xact_manager.get_xid()
-    array_of_old_tuple_bytes = [buffer_page.page.select(tid) for tid in tid_list]
-    if any(old_tuple_bytes == INVALID_BYTES for old_tuple_bytes in array_of_old_tuple_bytes):
-        return False
 
+def hot_multi_insert(relation: Relation, python_tuples):
+    """Insert tuples by filling pages one by one, each page gets one undo record
+    and one HEAP_MULTI_INSERT WAL record with all its tuples, rather than one
+    per tuple. Return the locations [(pageno, tid), ...] in the same order."""
+    xid = global_vars.xact_manager.get_xid()
     wip_lsn = 0  # work in progress LSN
-    for tid in tid_list:
-        success = buffer_page.page.delete(wip_lsn, tid)
-        if not success:
+    codec = relation.codec
+    tuples_bytes = [form_heap_tuple(xid, codec.encode(python_tuple)) for python_tuple in python_tuples]
+    fsm = get_fsm(relation)
+    locations = []
+    i = 0
+    while i < len(tuples_bytes):
+        for pageno in _insert_candidates(relation, fsm, len(tuples_bytes[i])):
+            buffer_page = global_vars.buffer_manager.get_page(relation, pageno, pin=True)
+            buffer_page.content_lock.acquire()
+            items = []
+            payload_size = 1  # the version byte
+            # a WAL record must not be too large, the rest goes to the next record
+            while (i + len(items) < len(tuples_bytes) and
+                   payload_size + multi_insert_size(tuples_bytes[i + len(items)]) <= MAX_RECORD_DATA_SIZE):
+                tuple_bytes = tuples_bytes[i + len(items)]
+                tid = buffer_page.page.insert(wip_lsn, tuple_bytes)
+                if tid == INVALID_ITEM_ID:
+                    break
+                items.append((tid, tuple_bytes))
+                payload_size += multi_insert_size(tuple_bytes)
+            fsm.record_free_space(pageno, buffer_page.page.free_space_size())
+            if items:
+                break
+            buffer_page.content_lock.release()
+            global_vars.buffer_manager.unpin_page(buffer_page)
+        else:
+            raise RollbackError('cannot insert the tuple')
+
+        # the same as hot_simple_insert(), hold the content lock until the page LSN is set
+        try:
+            buffer_page.mark_dirty()
+            tid_list = [tid for tid, _ in items]
+            undo_record = UndoRecord(xid,
+                                     UndoOperation.HEAP_MULTI_INSERT,
+                                     relation, (buffer_page.pageno, tid_list),
+                                     b'')
+            redo_record = WALRecord(
+                xid, relation.oid, buffer_page.pageno, tid_list[0], WALAction.HEAP_MULTI_INSERT,
+                encode_multi_insert([tuple_bytes for _, tuple_bytes in items])
+            )
+            global_vars.xact_manager.undo_manager.write_record(undo_record)
+            global_vars.xact_manager.wal_manager.write_record(redo_record)
+            buffer_page.page.header.lsn = global_vars.xact_manager.max_lsn()
+        finally:
+            buffer_page.content_lock.release()
+            global_vars.buffer_manager.unpin_page(buffer_page)
+
+        locations.extend((buffer_page.pageno, tid) for tid in tid_list)
+        i += len(items)
+    return locations
+
+
+def hot_simple_update(relation: Relation, pageno, tid, python_tuple, heap_only=True):
+    """Update the tuple in its page and keep the tid if the page can hold the new
+    version (heap-only update), otherwise, move it by delete and insert.
+    An update that changes index keys is never heap-only (`heap_only` is
+    false), so an index entry always points to tuples of the same key.
+    Return the new location (pageno, tid)."""
+    buffer_page = global_vars.buffer_manager.get_page(relation, pageno, pin=True)
+    # pinned, the page must not be evicted while being modified
+    try:
+        xid = global_vars.xact_manager.get_xid()
+        # wait for the transaction that is changing the tuple, then check
+        # what it has done
+        global_vars.xact_manager.lock_tuple(xid, relation.oid, pageno, tid)
+        with buffer_page.content_lock.shared():
+            old_tuple_bytes = buffer_page.page.select(tid)
+        if old_tuple_bytes == INVALID_BYTES:
+            return None
+        if not check_write_conflict(global_vars.xact_manager.get_snapshot(), xid, old_tuple_bytes):
+            return None
+
+        wip_lsn = 0  # work in progress LSN
+        tuple_bytes = form_heap_tuple(xid, relation.codec.encode(python_tuple))
+        with buffer_page.content_lock:
+            if heap_only and buffer_page.page.overwrite(wip_lsn, tid, tuple_bytes):
+                buffer_page.mark_dirty()
+                get_fsm(relation).record_free_space(pageno, buffer_page.page.free_space_size())
+                # write logs, the undo record keeps the old version for readers
+                undo_record = UndoRecord(xid,
+                                         UndoOperation.HEAP_UPDATE,
+                                         relation, (pageno, tid),
+                                         old_tuple_bytes)
+                redo_record = WALRecord(
+                    xid, relation.oid, pageno, tid, WALAction.HEAP_UPDATE, tuple_bytes
+                )
+                global_vars.xact_manager.undo_manager.write_record(undo_record)
+                global_vars.xact_manager.wal_manager.write_record(redo_record)
+
+                # update page header LSN
+                buffer_page.page.header.lsn = global_vars.xact_manager.max_lsn()
+                return pageno, tid
+
+        # each page takes the LSN of its own record, so that the page
+        # is never written before the record. The old version stays in its
+        # page for readers until vacuum removes it
+        if hot_simple_delete(relation, pageno, tid):
+            return hot_simple_insert(relation, python_tuple)
+    finally:
+        global_vars.buffer_manager.unpin_page(buffer_page)
+
+
+def hot_simple_delete(relation: Relation, pageno, tid, lsn=None):
+    """Delete the tuple by setting its xmax, the tuple is removed by vacuum
+    once no snapshot can see it."""
+    buffer_page = global_vars.buffer_manager.get_page(relation, pageno, pin=True)
+    # pinned, the page must not be evicted while being modified
+    try:
+        xid = global_vars.xact_manager.get_xid()
+        global_vars.xact_manager.lock_tuple(xid, relation.oid, pageno, tid)
+        with buffer_page.content_lock.shared():
+            old_tuple_bytes = buffer_page.page.select(tid)
+        if old_tuple_bytes == INVALID_BYTES:
+            return False
+        if not check_write_conflict(global_vars.xact_manager.get_snapshot(), xid, old_tuple_bytes):
             return False
-    if success:
-        buffer_page.mark_dirty()
-        # write logs
-        undo_record = UndoRecord(xid,
-                                UndoOperation.HEAP_BATCH_DELETE,
-                                relation, (pageno, tid_list),
-                                easy_tuple_serialize(array_of_old_tuple_bytes))
-        redo_record = WALRecord(
-            xid, relation.oid, pageno, 0, WALAction.HEAP_BATCH_DELETE, easy_tuple_serialize(tid_list)
-        )
-        global_vars.xact_manager.undo_manager.write_record(undo_record)
-        global_vars.xact_manager.wal_manager.write_record(redo_record)
 
-        # update page header LSN
-        lsn = global_vars.xact_manager.max_lsn()
-        buffer_page.page.header.lsn = lsn
-    return success
+        with buffer_page.content_lock:
+            success = set_heap_tuple_xmax(buffer_page.page, tid, xid)
+            if success:
+                buffer_page.mark_dirty()
+                report_dead_items(relation, pageno, 1, xid)
+                # write logs
+                undo_record = UndoRecord(xid,
+                                        UndoOperation.HEAP_DELETE,
+                                        relation, (pageno, tid),
+                                        old_tuple_bytes)
+                redo_record = WALRecord(
+                    xid, relation.oid, pageno, tid, WALAction.HEAP_DELETE, b''
+                )
+                global_vars.xact_manager.undo_manager.write_record(undo_record)
+                global_vars.xact_manager.wal_manager.write_record(redo_record)
+
+                # update page header LSN
+                if lsn is None:
+                    lsn = global_vars.xact_manager.max_lsn()
+                buffer_page.page.header.lsn = lsn
+        return success
+    finally:
+        global_vars.buffer_manager.unpin_page(buffer_page)
 
+def hot_batch_delete(relation: Relation, pageno, tid_list):
+    # using mark-and-vacuum to delete
+    buffer_page = global_vars.buffer_manager.get_page(relation, pageno, pin=True)
+    # pinned, the page must not be evicted while being modified
+    try:
+        xid = global_vars.xact_manager.get_xid()
+        for tid in sorted(tid_list):
+            global_vars.xact_manager.lock_tuple(xid, relation.oid, pageno, tid)
+        with buffer_page.content_lock.shared():
+            array_of_old_tuple_bytes = [buffer_page.page.select(tid) for tid in tid_list]
+        if any(old_tuple_bytes == INVALID_BYTES for old_tuple_bytes in array_of_old_tuple_bytes):
+            return False
+        snapshot = global_vars.xact_manager.get_snapshot()
+        if not all(check_write_conflict(snapshot, xid, old_tuple_bytes)
+                   for old_tuple_bytes in array_of_old_tuple_bytes):
+            return False
 
-def hot_simple_select(relation: Relation, pageno, tid):
+        with buffer_page.content_lock:
+            for tid in tid_list:
+                success = set_heap_tuple_xmax(buffer_page.page, tid, xid)
+                if not success:
+                    return False
+            if success:
+                buffer_page.mark_dirty()
+                report_dead_items(relation, pageno, len(tid_list), xid)
+                # write logs
+                undo_record = UndoRecord(xid,
+                                        UndoOperation.HEAP_BATCH_DELETE,
+                                        relation, (pageno, tid_list),
+                                        encode_tuple_list(array_of_old_tuple_bytes))
+                redo_record = WALRecord(
+                    xid, relation.oid, pageno, 0, WALAction.HEAP_BATCH_DELETE, encode_tid_list(tid_list)
+                )
+                global_vars.xact_manager.undo_manager.write_record(undo_record)
+                global_vars.xact_manager.wal_manager.write_record(redo_record)
+
+                # update page header LSN
+                lsn = global_vars.xact_manager.max_lsn()
+                buffer_page.page.header.lsn = lsn
+        return success
+    finally:
+        global_vars.buffer_manager.unpin_page(buffer_page)
+
+
+def hot_simple_select(relation: Relation, pageno, tid, snapshot=None):
+    """Return the version of the tuple that `snapshot` sees, None means the
+    snapshot of the running statement."""
     buffer_page = global_vars.buffer_manager.get_page(relation, pageno)
-    data = buffer_page.page.select(tid)
+    with buffer_page.content_lock.shared():
+        data = buffer_page.page.select(tid)
     if data == INVALID_BYTES:
         return ()
-    return TupleData.from_bytes(data, relation.attrs).python_tuple
+    if snapshot is None:
+        snapshot = global_vars.xact_manager.get_snapshot()
+    data = visible_version(snapshot, relation.oid, pageno, tid, data)
+    if data is None:
+        return ()
+    return relation.codec.decode(heap_tuple_data(data))
 
 def hot_simple_select_all(relation: Relation):
+    snapshot = global_vars.xact_manager.get_snapshot()
     for pageno in range(relation.last_pageno() + 1):
         buffer_page = global_vars.buffer_manager.get_page(relation, pageno)
         for tid in range(buffer_page.page.item_count):
-            tuple_ = hot_simple_select(relation, pageno, tid)
+            tuple_ = hot_simple_select(relation, pageno, tid, snapshot)
             if tuple_ != ():
                 yield tuple_
 
+
+def hot_page_decode(relation: Relation, buffer_page, attr_idx=None, snapshot=None):
+    """Yield (tid, tuple) for each tuple of the page that `snapshot` sees (None
+    means the snapshot of the running statement). Only the attributes in
+    `attr_idx` are decoded (in that order), None means all attributes.
+
+    Items are read straight from the page buffer when the iteration reaches them,
+    so the caller should pin the page for the whole iteration."""
+    page = buffer_page.page
+    codec = relation.codec
+    if attr_idx is None:
+        decode = codec.decode
+    else:
+        attr_idx = tuple(attr_idx)
+
+        def decode(data):
+            return codec.decode_columns(data, attr_idx)
+
+    if snapshot is None:
+        snapshot = global_vars.xact_manager.get_snapshot()
+    for tid in range(page.item_count):
+        # not held across yield, the caller may change the page meanwhile
+        with buffer_page.content_lock.shared():
+            data = page.select_view(tid)
+            if data is None:
+                continue
+            data = visible_version(snapshot, relation.oid, buffer_page.pageno, tid, data)
+            if data is None:
+                continue
+            tuple_ = decode(data[HEAP_TUPLE_HEADER_SIZE:])
+        yield tid, tuple_
+
 def bt_create_index(index_name, table_name, fields, database_oid=OID_DATABASE_ANDB):
     table_oid = CATALOG_ANDB_CLASS.get_relation_oid(table_name, database_oid, kind=RelationKinds.HEAP_TABLE)
     # only get index columns
@@ -405,22 +708,27 @@ def bt_create_index_internal(index_name, table_oid, attr_form_array, index_attr_
     CATALOG_ANDB_INDEX.define_index_fields(name=index_name, index_oid=index_oid,
                                            table_oid=table_oid, table_attr_forms=index_attr_form_array)
 
+    table_codec = get_tuple_codec(attr_form_array)
+    key_codec = get_tuple_codec(index_attr_form_array)
     tree = BPlusTree()
     #TODO: fix this lsn
     lsn = global_vars.xact_manager.max_lsn()
     last_pageno = table_relation.last_pageno()
     # iteration includes the last pageno
     for pageno in range(0, last_pageno + 1):
-        buffer_page = global_vars.buffer_manager.get_page(table_relation, pageno)
-        global_vars.buffer_manager.pin_page(buffer_page)
+        buffer_page = global_vars.buffer_manager.get_page(table_relation, pageno, pin=True)
         hot_page = buffer_page.page
         for idx in range(len(hot_page.item_ids)):
             tuple_data = hot_page.select(idx)
             if tuple_data == INVALID_BYTES:
                 continue
-            heap_tuple = TupleData.from_bytes(tuple_data, attr_form_array).python_tuple
+            # a deleted tuple is not indexed unless the delete may roll back
+            xmax = heap_tuple_header(tuple_data)[1]
+            if xmax != INVALID_XID and not global_vars.xact_manager.is_active(xmax):
+                continue
+            heap_tuple = table_codec.decode(heap_tuple_data(tuple_data))
             key_tuple = tuple(heap_tuple[attr.num] for attr in index_attr_form_array)
-            key_data = TupleData(python_tuple=key_tuple).to_bytes(index_attr_form_array)
+            key_data = key_codec.encode(key_tuple)
             tuple_pointer = TuplePointer(pageno, idx)
             tree.insert(lsn, key_data, tuple_pointer)
         global_vars.buffer_manager.unpin_page(buffer_page)
@@ -428,7 +736,7 @@ def bt_create_index_internal(index_name, table_oid, attr_form_array, index_attr_
     close_relation(table_oid, lock_mode=rlock.SHARE_LOCK)
     fd = file_open(os.path.join(BASE_DIR, str(database_oid), str(index_oid)),
                    flags=os.O_RDWR | os.O_CREAT)
-    file_write(fd, data=tree.serialize(), sync=True)
+    file_pwrite(fd, tree.serialize(), 0, sync=True)
     return index_oid
 
 
@@ -439,7 +747,7 @@ def bt_drop_index(index_name, database_oid=OID_DATABASE_ANDB):
 
     class_form = results[0]
     index_oid = class_form.oid
-    relation = open_relation(index_oid, rlock.ACCESS_EXCLUSIVE_LOCK)
+    relation = _open_relation_to_drop(index_oid)
     if not relation:
         raise DDLException('cannot drop the index because the index is in use.')
 
@@ -448,103 +756,133 @@ def bt_drop_index(index_name, database_oid=OID_DATABASE_ANDB):
 
     file_remove(relation.fd)
     global_vars.buffer_manager.evict_relation(relation)
+    with _bt_pageno_lock:
+        _bt_next_pageno.pop(index_oid, None)
+    with _bt_latches_lock:
+        _bt_latches.pop(index_oid, None)
     close_relation(index_oid, rlock.ACCESS_EXCLUSIVE_LOCK)
 
 
-def _bt_key_tuple_to_data(key_tuple, index_attr_form_array):
-    key_data = TupleData(python_tuple=key_tuple).to_bytes(index_attr_form_array)
+def _bt_key_tuple_to_data(key_tuple, key_codec):
+    key_data = key_codec.encode(key_tuple)
     return key_data
 
 
-def _bt_data_to_key_tuple(data, index_attr_form_array):
-    key_tuple = TupleData.from_bytes(data, index_attr_form_array).python_tuple
+def _bt_data_to_key_tuple(data, key_codec):
+    key_tuple = key_codec.decode(data)
     return key_tuple
 
 
 def bt_simple_insert(relation: Relation, key, tuple_pointer):
-    tree = BufferedBPTree(relation)
     xid = global_vars.xact_manager.get_xid()
-    attrs = CATALOG_ANDB_INDEX.get_attr_form_array(relation.oid)
-    key_data = _bt_key_tuple_to_data(key, attrs)
+    key_data = _bt_key_tuple_to_data(key, relation.codec)
 
     global_vars.xact_manager.wal_manager.write_record(
-        WALRecord(xid, relation.oid, 0, 0, WALAction.BTREE_INSERT, easy_tuple_serialize((key_data, tuple_pointer.to_bytes()))))
+        WALRecord(xid, relation.oid, 0, 0, WALAction.BTREE_INSERT, encode_btree_entry(key_data, tuple_pointer)))
     # for delete (the reverse of insert), we need to know the key and the specific value
     global_vars.xact_manager.undo_manager.write_record(
         UndoRecord(xid, UndoOperation.BTREE_INSERT, relation, (key_data, tuple_pointer),
                     b''))
 
     lsn = global_vars.xact_manager.max_lsn()
-    tree.insert(lsn, key_data, tuple_pointer)
+    with BufferedBPTree(relation) as tree:
+        tree.insert(lsn, key_data, tuple_pointer)
 
 
 
 
 def bt_update(relation: Relation, key, tuple_pointer):
-    tree = BufferedBPTree(relation)
-    xid = global_vars.xact_manager.get_xid()
-    attrs = CATALOG_ANDB_INDEX.get_attr_form_array(relation.oid)
-    key_data = _bt_key_tuple_to_data(key, attrs)
-    global_vars.xact_manager.wal_manager.write_record(
-        WALRecord(xid, relation.oid, 0, 0, WALAction.BTREE_UPDATE, 
-                  easy_tuple_serialize((key_data, tuple_pointer.to_bytes()))))
-    # for update, we need to know the key and value, and let
-    # the location be the tuple of key and value
-    # the old value is a list of tuple pointer
-    old_tuple_pointer = tree.search(key_data)
-    global_vars.xact_manager.undo_manager.write_record(
-        UndoRecord(xid, UndoOperation.BTREE_UPDATE, relation, (key_data, old_tuple_pointer),
-                    b''))
+    with BufferedBPTree(relation) as tree:
+        xid = global_vars.xact_manager.get_xid()
+        key_data = _bt_key_tuple_to_data(key, relation.codec)
+        global_vars.xact_manager.wal_manager.write_record(
+            WALRecord(xid, relation.oid, 0, 0, WALAction.BTREE_UPDATE, encode_btree_entry(key_data, tuple_pointer)))
+        # for update, we need to know the key and value, and let
+        # the location be the tuple of key and value
+        # the old value is a list of tuple pointer
+        old_tuple_pointer = tree.search(key_data)
+        global_vars.xact_manager.undo_manager.write_record(
+            UndoRecord(xid, UndoOperation.BTREE_UPDATE, relation, (key_data, old_tuple_pointer),
+                        b''))
 
-    lsn = global_vars.xact_manager.max_lsn()
-    tree.delete(lsn, key_data)
-    tree.insert(lsn, key_data, tuple_pointer)
+        lsn = global_vars.xact_manager.max_lsn()
+        tree.delete(lsn, key_data)
+        tree.insert(lsn, key_data, tuple_pointer)
 
 
 def bt_delete(relation: Relation, key):
-    tree = BufferedBPTree(relation)
-    xid = global_vars.xact_manager.get_xid()
-    attrs = CATALOG_ANDB_INDEX.get_attr_form_array(relation.oid)
-    key_data = _bt_key_tuple_to_data(key, attrs)
-    global_vars.xact_manager.wal_manager.write_record(
-        WALRecord(xid, relation.oid, 0, 0, WALAction.BTREE_DELETE, key_data))
-    # for insert (the reverse of delete), we need to know the key and values
-    old_tuple_pointer = tree.search(key_data)
-    global_vars.xact_manager.undo_manager.write_record(
-        UndoRecord(xid, UndoOperation.BTREE_DELETE, relation, (key_data, old_tuple_pointer),
-                    b''))
+    with BufferedBPTree(relation) as tree:
+        xid = global_vars.xact_manager.get_xid()
+        key_data = _bt_key_tuple_to_data(key, relation.codec)
+        global_vars.xact_manager.wal_manager.write_record(
+            WALRecord(xid, relation.oid, 0, 0, WALAction.BTREE_DELETE, encode_btree_key(key_data)))
+        # for insert (the reverse of delete), we need to know the key and values
+        old_tuple_pointer = tree.search(key_data)
+        global_vars.xact_manager.undo_manager.write_record(
+            UndoRecord(xid, UndoOperation.BTREE_DELETE, relation, (key_data, old_tuple_pointer),
+                        b''))
 
-    lsn = global_vars.xact_manager.max_lsn()
+        lsn = global_vars.xact_manager.max_lsn()
 
-    tree.delete(lsn, key_data)
+        tree.delete(lsn, key_data)
+
+
+def bt_remove_heap_tuples(relation: Relation, pageno, tuples):
+    """Remove the index entries of heap tuples that vacuum removes, `tuples`
+    is [(tid, tuple bytes)]. Like vacuum, it belongs to no transaction."""
+    if not tuples:
+        return
+    indexes = {}
+    for form in CATALOG_ANDB_INDEX.search(lambda r: r.table_oid == relation.oid):
+        indexes.setdefault(form.oid, []).append(form)
+    python_tuples = [(tid, relation.codec.decode(heap_tuple_data(tuple_bytes))) for tid, tuple_bytes in tuples]
+    for index_oid, index_forms in indexes.items():
+        index_forms.sort(key=lambda form: form.index_num)
+        index_relation = open_relation(index_oid, rlock.ROW_EXCLUSIVE_LOCK)
+        if not index_relation:
+            continue
+        try:
+            with BufferedBPTree(index_relation) as tree:
+                for tid, python_tuple in python_tuples:
+                    key = [python_tuple[form.attr_num] for form in index_forms]
+                    key_data = _bt_key_tuple_to_data(key, index_relation.codec)
+                    tuple_pointer = TuplePointer(pageno, tid)
+                    lsn = global_vars.xact_manager.wal_manager.write_record(
+                        WALRecord(INVALID_XID, index_oid, 0, 0, WALAction.BTREE_DELETE_VALUE,
+                                  encode_btree_entry(key_data, tuple_pointer)))
+                    tree.delete_value(lsn, key_data, tuple_pointer)
+        finally:
+            close_relation(index_oid, rlock.ROW_EXCLUSIVE_LOCK)
 
 
 def bt_search(relation: Relation, key):
     """Allow leftmost prefix rule"""
-    tree = BufferedBPTree(relation)
-    attrs = CATALOG_ANDB_INDEX.get_attr_form_array(relation.oid)
-    assert len(key) <= len(attrs)
-    key_data = _bt_key_tuple_to_data(key, attrs[:len(key)])
-    results = tree.search(key_data)
+    key_codec = relation.codec
+    assert len(key) <= key_codec.natts
+    key_data = _bt_key_tuple_to_data(key, key_codec.prefix(len(key)))
+    with BufferedBPTree(relation, shared=True) as tree:
+        # copy, the lists of the tree may change once the latch is released
+        results = list(tree.search(key_data))
     return results
 
 
 def bt_search_range(relation: Relation, start_key, end_key):
     """Allow leftmost prefix rule"""
-    tree = BufferedBPTree(relation)
-    attrs = CATALOG_ANDB_INDEX.get_attr_form_array(relation.oid)
-    assert len(start_key) <= len(attrs)
-    assert len(end_key) <= len(attrs)
-
-    start_key_data = _bt_key_tuple_to_data(start_key, attrs[:len(attrs)])
-    end_key_data = _bt_key_tuple_to_data(end_key, attrs[:len(attrs)])
-    results = tree.search_range(start_key_data, end_key_data)
+    key_codec = relation.codec
+    assert len(start_key) <= key_codec.natts
+    assert len(end_key) <= key_codec.natts
+
+    start_key_data = _bt_key_tuple_to_data(start_key, key_codec)
+    end_key_data = _bt_key_tuple_to_data(end_key, key_codec)
+    with BufferedBPTree(relation, shared=True) as tree:
+        results = [list(values) for values in tree.search_range(start_key_data, end_key_data)]
     return results
 
 
 def bt_scan_all_keys(relation: Relation):
-    tree = BufferedBPTree(relation)
-    attrs = CATALOG_ANDB_INDEX.get_attr_form_array(relation.oid)
-    for key_data in tree.all_keys():
-        yield _bt_data_to_key_tuple(key_data, attrs)
-
+    key_codec = relation.codec
+    # don't hold the latch while the caller consumes the keys
+    with BufferedBPTree(relation, shared=True) as tree:
+        keys = list(tree.all_keys())
+    for key_data in keys:
+        yield _bt_data_to_key_tuple(key_data, key_codec)
@@ -1,9 +1,15 @@
 import os
+import struct
+import threading
 
+from andb.catalog.oid import INVALID_OID
+from andb.common.cstructure import CTYPE_BIG_ENDIAN
+from andb.common.file_operation import file_open, file_pwrite, file_size, file_unlink
 from andb.constants.filename import UNDO_DIR
-from andb.storage.utils import easy_tuple_serialize, easy_tuple_deserialize
+from andb.constants.values import UNDO_SEGMENT_SIZE
+from andb.errno.errors import UndoError
+from andb.storage.engines.heap.bptree import TuplePointer
 
-LITTLE_ENDIAN = 'little'
 
 class UndoOperation:
     BEGIN = 0
@@ -16,8 +22,72 @@ class UndoOperation:
     BTREE_INSERT = 7
     BTREE_DELETE = 8
     BTREE_UPDATE = 9
+    HEAP_MULTI_INSERT = 10
     # Additional operations can be added as needed, e.g, schema change
 
+
+# total size, xid, operation, relation oid, location size, followed by
+# the location and the data
+_HEADER = struct.Struct(CTYPE_BIG_ENDIAN + 'IQBQH')
+_PAGENO = struct.Struct(CTYPE_BIG_ENDIAN + 'I')
+_HEAP_LOCATION = struct.Struct(CTYPE_BIG_ENDIAN + 'II')
+_KEY_SIZE = struct.Struct(CTYPE_BIG_ENDIAN + 'H')
+_TUPLE_POINTER = struct.Struct(CTYPE_BIG_ENDIAN + 'II')
+
+
+def _encode_tid_list(location):
+    pageno, tid_list = location
+    return _PAGENO.pack(pageno) + struct.pack('%s%dH' % (CTYPE_BIG_ENDIAN, len(tid_list)), *tid_list)
+
+
+def _decode_tid_list(data):
+    pageno, = _PAGENO.unpack_from(data)
+    return pageno, list(struct.unpack_from('%s%dH' % (CTYPE_BIG_ENDIAN, (len(data) - _PAGENO.size) // 2),
+                                           data, _PAGENO.size))
+
+
+def _encode_btree_location(location):
+    # the value is a tuple pointer for an insert, or the list of
+    # tuple pointers that the key had before an update or a delete
+    key_data, value = location
+    if isinstance(value, TuplePointer):
+        value = [value]
+    return b''.join([_KEY_SIZE.pack(len(key_data)), key_data] +
+                    [_TUPLE_POINTER.pack(p.pageno, p.tid) for p in value])
+
+
+def _decode_btree_location(data):
+    key_size, = _KEY_SIZE.unpack_from(data)
+    key_data = bytes(data[_KEY_SIZE.size: _KEY_SIZE.size + key_size])
+    pointers = [TuplePointer(pageno, tid) for pageno, tid in
+                _TUPLE_POINTER.iter_unpack(data[_KEY_SIZE.size + key_size:])]
+    return key_data, pointers
+
+
+def _decode_btree_insert_location(data):
+    key_data, pointers = _decode_btree_location(data)
+    return key_data, pointers[0]
+
+
+# operation -> (encode, decode) of the location
+_LOCATION_CODECS = {
+    UndoOperation.HEAP_INSERT: (lambda location: _HEAP_LOCATION.pack(*location),
+                                lambda data: _HEAP_LOCATION.unpack(data)),
+    UndoOperation.HEAP_DELETE: (lambda location: _HEAP_LOCATION.pack(*location),
+                                lambda data: _HEAP_LOCATION.unpack(data)),
+    UndoOperation.HEAP_UPDATE: (lambda location: _HEAP_LOCATION.pack(*location),
+                                lambda data: _HEAP_LOCATION.unpack(data)),
+    UndoOperation.HEAP_BATCH_DELETE: (_encode_tid_list, _decode_tid_list),
+    UndoOperation.HEAP_MULTI_INSERT: (_encode_tid_list, _decode_tid_list),
+    UndoOperation.BTREE_INSERT: (_encode_btree_location, _decode_btree_insert_location),
+    UndoOperation.BTREE_DELETE: (_encode_btree_location, _decode_btree_location),
+    UndoOperation.BTREE_UPDATE: (_encode_btree_location, _decode_btree_location),
+}
+
+
+_BTREE_OPERATIONS = (UndoOperation.BTREE_INSERT, UndoOperation.BTREE_DELETE, UndoOperation.BTREE_UPDATE)
+
+
 class UndoRecord:
     def __init__(self, xid, operation, relation, location, data: bytes):
         """
@@ -26,63 +96,190 @@ class UndoRecord:
         - T: Transaction ID that modified the data
         - X: Database element that was changed
         - v: Previous value before the change
-        
+
         The tuple must be written to disk before the new value is written.
         The undo commit information should only be written after all necessary data is on disk.
+
+        `relation` is a relation object or its oid, only the oid is logged, so
+        a record read back from the log has the oid as its relation.
         """
         self.xid = xid
         self.operation = operation
         self.relation = relation
         self.location = location
         self.data = data
-        self._bytes = easy_tuple_serialize((xid, operation, relation, location, data))
+
+    @property
+    def relation_oid(self):
+        if self.relation is None:
+            return INVALID_OID
+        if isinstance(self.relation, int):
+            return self.relation
+        return self.relation.oid
 
     def to_bytes(self):
         """
-        Serialize the record with a fixed-size header indicating content size.
-        The content_size is fixed at 8 bytes to indicate the length of the corresponding buffer.
-        This is necessary to properly parse multiple serialized records.
+        Serialize the record with a fixed-size header, which has the size of the
+        whole record, so records can be parsed one after another.
         """
-        content_size = len(self._bytes)
-        return int.to_bytes(content_size, 8, LITTLE_ENDIAN, signed=False) + self._bytes
+        codec = _LOCATION_CODECS.get(self.operation)
+        location_data = codec[0](self.location) if codec and self.location is not None else b''
+        return _HEADER.pack(_HEADER.size + len(location_data) + len(self.data), self.xid, self.operation,
+                            self.relation_oid, len(location_data)) + location_data + self.data
 
     @staticmethod
     def from_bytes(buff):
-        content_size = int.from_bytes(buff[:8], LITTLE_ENDIAN, signed=False)
-        data = buff[8:8+content_size]
-        xid, operation, relation, location, data = easy_tuple_deserialize(data)
-        return UndoRecord(xid, operation, relation, location, data)
+        total_size, xid, operation, relation_oid, location_size = _HEADER.unpack_from(buff)
+        location_data = buff[_HEADER.size: _HEADER.size + location_size]
+        codec = _LOCATION_CODECS.get(operation)
+        location = codec[1](location_data) if codec and location_size else None
+        data = bytes(buff[_HEADER.size + location_size: total_size])
+        return UndoRecord(xid, operation, relation_oid if relation_oid != INVALID_OID else None, location, data)
 
     def __len__(self):
-        return 8 + len(self._bytes)
+        return len(self.to_bytes())
 
     def __repr__(self):
         return f'<UndoRecord xid={self.xid} operation={self.operation}>'
 
+
+def segment_filename(segno):
+    return '%016X' % segno
+
+
 class UndoManager:
+    """Undo records of all transactions are appended to segment files in the
+    undo directory. Records of a transaction are buffered in memory until
+    `flush()`, which writes them with one write and one fsync.
+
+    A segment that is older than the first segment of every active transaction
+    is not needed anymore, `truncate()` (run by bgwriter) removes it.
+
+    Records must be on disk before the pages they undo (undo-before-data), so
+    the buffer manager calls `flush_page_writers()` before writing a page.
+
+    HEAP_UPDATE records are also kept in memory by the tuple location, they
+    have the older versions of tuples that are updated in place, which MVCC
+    readers walk through (`tuple_versions()`). They are dropped once every
+    snapshot sees the newer version (`prune_versions()`).
+    """
+
     def __init__(self, file_directory=UNDO_DIR):
         self.file_directory = file_directory
         self.active_transactions = {}
+        # xid -> [(segno, offset, size), ...] written by the transaction
+        self._written_ranges = {}
+        # xid -> the segment that its first record goes to, at the earliest
+        self._first_segnos = {}
+        # (relation oid, pageno) -> xids that have records of the page not
+        # flushed yet, B-tree records are logical, so their pageno is None
+        self._unflushed_pages = {}
+        # xid -> keys of `_unflushed_pages` that it is in
+        self._unflushed_keys = {}
+        self._lock = threading.Lock()
+        self._segno = None
+        self._offset = 0
+        self.truncated_segments = 0
+        # (relation oid, pageno, tid) -> HEAP_UPDATE records, the newest last
+        self._versions = {}
+        # xid -> locations that the transaction has versions of
+        self._version_locations = {}
+
+    def _segment_path(self, segno):
+        return os.path.join(self.file_directory, segment_filename(segno))
+
+    def list_segments(self):
+        if not os.path.exists(self.file_directory):
+            return []
+        segments = []
+        for filename in os.listdir(self.file_directory):
+            try:
+                segments.append(int(filename, 16))
+            except ValueError:
+                continue
+        segments.sort()
+        return segments
+
+    def _open_current_segment(self):
+        if self._segno is None or not os.path.exists(self._segment_path(self._segno)):
+            # the first flush after starting (or the files are removed),
+            # go on with the last segment
+            os.makedirs(self.file_directory, exist_ok=True)
+            segments = self.list_segments()
+            self._segno = segments[-1] if segments else (self._segno or 0)
+            self._offset = None
+        elif self._offset >= UNDO_SEGMENT_SIZE:
+            # a flush is never split, so a segment may be a bit larger
+            self._segno += 1
+            self._offset = 0
+        fd = file_open(self._segment_path(self._segno), os.O_RDWR | os.O_CREAT)
+        if self._offset is None:
+            self._offset = file_size(fd)
+        return fd
+
+    def _current_segno(self):
+        if self._segno is not None:
+            return self._segno
+        segments = self.list_segments()
+        return segments[-1] if segments else 0
 
     def write_record(self, record: UndoRecord):
         xid = record.xid
         assert xid in self.active_transactions
-        self.active_transactions[xid].append(record)
+        if record.relation is None:
+            self.active_transactions[xid].append(record)
+            return
+        if record.operation in _BTREE_OPERATIONS:
+            key = (record.relation_oid, None)
+        else:
+            key = (record.relation_oid, record.location[0])
+        with self._lock:
+            self.active_transactions[xid].append(record)
+            self._unflushed_pages.setdefault(key, set()).add(xid)
+            self._unflushed_keys.setdefault(xid, set()).add(key)
+            if record.operation == UndoOperation.HEAP_UPDATE:
+                location = (record.relation_oid,) + tuple(record.location)
+                self._versions.setdefault(location, []).append(record)
+                self._version_locations.setdefault(xid, set()).add(location)
 
     def flush(self, xid):
-        if not os.path.exists(self.file_directory):
-            os.makedirs(self.file_directory)
-        filename = os.path.join(self.file_directory, str(xid))
-        with open(filename, 'ab') as f:
-            #TODO: batch write
-            for record in self.active_transactions[xid]:
-                f.write(record.to_bytes())
-            f.flush()  # Flush internal buffers
-            os.fsync(f.fileno())  # Ensure data is written to disk
-        self.active_transactions[xid].clear()
+        """Write the buffered records of the transaction. Other threads can
+        flush it too (e.g., checkpoint), while the transaction appends records."""
+        with self._lock:
+            records = self.active_transactions.get(xid)
+            if not records:
+                return
+            count = len(records)
+            data = b''.join(record.to_bytes() for record in records[:count])
+            fd = self._open_current_segment()
+            file_pwrite(fd, data, self._offset, sync=True)
+            self._written_ranges.setdefault(xid, []).append((self._segno, self._offset, len(data)))
+            self._offset += len(data)
+            del records[:count]
+            if not records:
+                self._forget_unflushed(xid)
+
+    def _forget_unflushed(self, xid):
+        for key in self._unflushed_keys.pop(xid, ()):
+            xids = self._unflushed_pages.get(key)
+            if xids is not None:
+                xids.discard(xid)
+                if not xids:
+                    del self._unflushed_pages[key]
+
+    def flush_page_writers(self, relation_oid, pageno):
+        """Flush records of the transactions that have changed the page and
+        not flushed them yet, before the page is written."""
+        with self._lock:
+            xids = self._unflushed_pages.get((relation_oid, pageno), set()) | \
+                self._unflushed_pages.get((relation_oid, None), set())
+        for xid in xids:
+            self.flush(xid)
 
     def begin_transaction(self, xid):
-        self.active_transactions[xid] = []
+        with self._lock:
+            self.active_transactions[xid] = []
+            self._first_segnos[xid] = self._current_segno()
         undo_record = UndoRecord(
             xid=xid,
             operation=UndoOperation.BEGIN,
@@ -102,7 +299,7 @@ class UndoManager:
         )
         self.write_record(undo_record)
         self.flush(xid)
-        del self.active_transactions[xid]
+        self._end_transaction(xid)
 
     def abort_transaction(self, xid):
         undo_record = UndoRecord(
@@ -114,22 +311,89 @@ class UndoManager:
         )
         self.write_record(undo_record)
         self.flush(xid)
-        del self.active_transactions[xid]
+        self._end_transaction(xid)
+        # the tuples have their old versions back, nobody reads these ones
+        with self._lock:
+            self._drop_versions(xid)
+
+    def _end_transaction(self, xid):
+        with self._lock:
+            del self.active_transactions[xid]
+            self._written_ranges.pop(xid, None)
+            self._first_segnos.pop(xid, None)
+            self._forget_unflushed(xid)
+
+    def tuple_versions(self, relation_oid, pageno, tid):
+        """Return HEAP_UPDATE records of the tuple, the newest first."""
+        with self._lock:
+            records = self._versions.get((relation_oid, pageno, tid))
+            return list(reversed(records)) if records else []
+
+    def _drop_versions(self, xid):
+        for location in self._version_locations.pop(xid, ()):
+            records = [record for record in self._versions.get(location, ()) if record.xid != xid]
+            if records:
+                self._versions[location] = records
+            else:
+                self._versions.pop(location, None)
+
+    def prune_versions(self, horizon):
+        """Drop versions replaced by transactions before `horizon`, which all
+        snapshots see. Return how many transactions' versions are dropped."""
+        with self._lock:
+            xids = [xid for xid in self._version_locations
+                    if xid < horizon and xid not in self.active_transactions]
+            for xid in xids:
+                self._drop_versions(xid)
+            return len(xids)
+
+    def truncate(self):
+        """Remove segments that no active transaction has records in.
+        Return how many segments are removed."""
+        with self._lock:
+            if self._segno is None:
+                return 0
+            # a transaction may not have flushed anything yet, its records
+            # go to the segment that was current when it began or later ones
+            keep_segno = min([self._segno] + list(self._first_segnos.values()))
+            removed = 0
+            for segno in self.list_segments():
+                if segno >= keep_segno:
+                    break
+                file_unlink(self._segment_path(segno))
+                removed += 1
+            self.truncated_segments += removed
+            return removed
+
+    @staticmethod
+    def _parse_records(data, xid):
+        i = 0
+        while i + _HEADER.size <= len(data):
+            total_size, record_xid = _HEADER.unpack_from(data, i)[:2]
+            if total_size < _HEADER.size:
+                raise UndoError('Bad undo record size %d.' % total_size)
+            if record_xid == xid:
+                yield UndoRecord.from_bytes(data[i: i + total_size])
+            i += total_size
+
+    def _read_segment(self, segno, offset=0, size=-1):
+        with open(self._segment_path(segno), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
 
     def parse_record(self, xid):
-        filename = os.path.join(self.file_directory, str(xid))
-        if not os.path.exists(filename):
-            return []
+        """Return records of the transaction, the latest one first. They are
+        read from the ranges it wrote if it is running, otherwise (e.g., in
+        recovery), all segments are scanned."""
         undo_records = []
-        with open(filename, 'rb') as f:
-            while True:
-                size_data = f.read(8)
-                if not size_data:
-                    break
-                content_size = int.from_bytes(size_data, LITTLE_ENDIAN, signed=False)
-                record_data = f.read(content_size)
-                undo_record = UndoRecord.from_bytes(size_data + record_data)
-                undo_records.append(undo_record)
+        with self._lock:
+            ranges = list(self._written_ranges.get(xid, ()))
+        if ranges:
+            for segno, offset, size in ranges:
+                undo_records.extend(self._parse_records(self._read_segment(segno, offset, size), xid))
+        else:
+            for segno in self.list_segments():
+                undo_records.extend(self._parse_records(self._read_segment(segno), xid))
         # Reverse the records for undo operations
         # e.g., [1,2,3] --> [3,2,1]
         undo_records.reverse()
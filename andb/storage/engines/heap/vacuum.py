@@ -0,0 +1,156 @@
+import threading
+
+from andb.constants.macros import INVALID_XID
+from andb.runtime import global_vars
+from andb.storage.engines.heap.fsm import get_fsm
+from andb.storage.engines.heap.mvcc import deleted_tuples
+from andb.storage.engines.heap.redo import WALAction, WALRecord
+from andb.storage.engines.heap.walpayload import encode_tid_list
+
+
+class VacuumStats:
+    """Counters of (auto)vacuum, they are only accumulated in memory."""
+
+    def __init__(self):
+        self.runs = 0
+        self.vacuumed_pages = 0
+        self.removed_dead_items = 0
+        self.reclaimed_bytes = 0
+        self.skipped_pinned_pages = 0
+        self.skipped_active_pages = 0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+vacuum_stats = VacuumStats()
+
+
+class DeadItemTracker:
+    """Tracks how many dead items (including deleted tuples) each heap page has
+    and the newest transaction that produced them. A page can be vacuumed only
+    after no snapshot can see that transaction running, otherwise its rollback
+    or the snapshot could not find the deleted tuples any more."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {relation oid: {pageno: [dead item count, newest xid]}}
+        self._dead_items = {}
+
+    def report(self, relation_oid, pageno, count, xid=INVALID_XID):
+        with self._lock:
+            pages = self._dead_items.setdefault(relation_oid, {})
+            entry = pages.setdefault(pageno, [0, INVALID_XID])
+            entry[0] += count
+            entry[1] = max(entry[1], xid)
+
+    def forget(self, relation_oid, pageno=None):
+        with self._lock:
+            if pageno is None:
+                self._dead_items.pop(relation_oid, None)
+                return
+            pages = self._dead_items.get(relation_oid)
+            if pages is not None:
+                pages.pop(pageno, None)
+                if not pages:
+                    del self._dead_items[relation_oid]
+
+    def get_dead_item_count(self, relation_oid, pageno=None):
+        with self._lock:
+            pages = self._dead_items.get(relation_oid, {})
+            if pageno is not None:
+                entry = pages.get(pageno)
+                return entry[0] if entry else 0
+            return sum(entry[0] for entry in pages.values())
+
+    def relations_over_threshold(self, threshold):
+        with self._lock:
+            return [oid for oid, pages in self._dead_items.items()
+                    if sum(entry[0] for entry in pages.values()) >= threshold]
+
+    def pages(self, relation_oid):
+        """Return [(pageno, newest xid)] of the relation in pageno order."""
+        with self._lock:
+            pages = self._dead_items.get(relation_oid, {})
+            return sorted((pageno, entry[1]) for pageno, entry in pages.items())
+
+
+dead_item_tracker = DeadItemTracker()
+
+
+def report_dead_items(relation, pageno, count, xid=INVALID_XID):
+    if count > 0:
+        dead_item_tracker.report(relation.oid, pageno, count, xid)
+
+
+def hot_vacuum_page(relation, pageno, horizon=None):
+    """Reclaim the dead items of one heap page in place, see `SlotPage.prune()`,
+    as well as the tuples deleted before `horizon` (see
+    `TransactionManager.oldest_xmin()`), which no snapshot can see.
+    The page is skipped if someone pins it, the caller can try it later.
+    :return: the number of removed dead items, or -1 if the page was skipped
+    """
+    # relation imports this module
+    from andb.storage.engines.heap.relation import bt_remove_heap_tuples
+
+    if horizon is None:
+        horizon = global_vars.xact_manager.oldest_xmin()
+    buffer_manager = global_vars.buffer_manager
+    buffer_page = buffer_manager.get_page(relation, pageno, pin=True)
+    try:
+        # pinned by others, the page may be scanned right now, whose item data cannot be moved
+        if buffer_page.pin_count > 1:
+            vacuum_stats.skipped_pinned_pages += 1
+            return -1
+        with buffer_page.content_lock:
+            page = buffer_page.page
+            removable = []
+            remaining = []
+            for tid, xmax in deleted_tuples(page):
+                (removable if xmax < horizon else remaining).append((tid, xmax))
+            if not removable and page.dead_item_count() == 0:
+                return 0
+            free_space_size = page.free_space_size()
+            # index entries are kept until the heap tuples go away
+            bt_remove_heap_tuples(relation, pageno, [(tid, page.select(tid)) for tid, _ in removable])
+            # vacuum does not belong to any transaction, just like checkpoint
+            global_vars.xact_manager.wal_manager.write_record(
+                WALRecord(INVALID_XID, relation.oid, pageno, 0, WALAction.HEAP_VACUUM,
+                          encode_tid_list([tid for tid, _ in removable]))
+            )
+            lsn = global_vars.xact_manager.max_lsn()
+            for tid, _ in removable:
+                page.delete(lsn, tid)
+            removed = page.prune(lsn)
+            buffer_page.mark_dirty()
+            get_fsm(relation).record_free_space(pageno, page.free_space_size())
+            dead_item_tracker.forget(relation.oid, pageno)
+            # the rest are still visible to someone, try them next time
+            for tid, xmax in remaining:
+                dead_item_tracker.report(relation.oid, pageno, 1, xmax)
+    finally:
+        buffer_manager.unpin_page(buffer_page)
+
+    vacuum_stats.vacuumed_pages += 1
+    vacuum_stats.removed_dead_items += removed
+    vacuum_stats.reclaimed_bytes += page.free_space_size() - free_space_size
+    return removed
+
+
+def vacuum_relation(relation, active_xids=()):
+    """Vacuum the pages of the relation that have tracked dead items. Pages whose
+    dead items come from an active transaction, or one that a snapshot may
+    see running, are left for the next run."""
+    vacuum_stats.runs += 1
+    horizon = global_vars.xact_manager.oldest_xmin()
+    removed = 0
+    for pageno, xid in dead_item_tracker.pages(relation.oid):
+        if xid != INVALID_XID and (xid in active_xids or xid >= horizon):
+            vacuum_stats.skipped_active_pages += 1
+            continue
+        removed += max(0, hot_vacuum_page(relation, pageno, horizon))
+    return removed
+
+
+def get_vacuum_stats():
+    return vacuum_stats.to_dict()
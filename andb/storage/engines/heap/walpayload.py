@@ -0,0 +1,167 @@
+"""Binary layouts of WAL record payloads.
+
+A structured payload starts with a version byte, so the layout can change
+later without breaking old WAL files. Heap tuple payloads (HEAP_INSERT and
+HEAP_UPDATE) are the tuple bytes as they are, and their layout is owned
+by `TupleCodec` behind the MVCC header. HEAP_MULTI_INSERT has a list of them,
+so does the undo record of HEAP_BATCH_DELETE, see `encode_tuple_list()`.
+HEAP_DELETE has no payload, it sets xmax of the tuple to the xid of the record.
+"""
+import struct
+
+from andb.common.cstructure import CTYPE_BIG_ENDIAN
+from andb.constants.macros import INVALID_XID
+from andb.errno.errors import WALError
+from andb.storage.engines.heap.bptree import TuplePointer
+from andb.storage.engines.heap.redo import WALAction
+
+WAL_PAYLOAD_VERSION = 1
+
+_VERSION = struct.Struct(CTYPE_BIG_ENDIAN + 'B')
+# version, tuple pointer (pageno, tid), followed by the key
+_BTREE_ENTRY = struct.Struct(CTYPE_BIG_ENDIAN + 'BII')
+# version, redo LSN
+_CHECKPOINT = struct.Struct(CTYPE_BIG_ENDIAN + 'BQ')
+# followed by the latest xid, records of older versions don't have it
+_CHECKPOINT_XID = struct.Struct(CTYPE_BIG_ENDIAN + 'Q')
+# and then xids of running transactions
+_XID = struct.Struct(CTYPE_BIG_ENDIAN + 'Q')
+_TID = struct.Struct(CTYPE_BIG_ENDIAN + 'H')
+# length of a tuple image, followed by the tuple
+_TUPLE_IMAGE = struct.Struct(CTYPE_BIG_ENDIAN + 'H')
+_VERSION_BYTE = _VERSION.pack(WAL_PAYLOAD_VERSION)
+
+
+def _check_version(data):
+    if not data or data[0] != WAL_PAYLOAD_VERSION:
+        raise WALError('Unknown WAL payload version %s.' % (data[0] if data else None))
+
+
+def encode_btree_entry(key_data, tuple_pointer: TuplePointer):
+    return _BTREE_ENTRY.pack(WAL_PAYLOAD_VERSION, tuple_pointer.pageno, tuple_pointer.tid) + key_data
+
+
+def decode_btree_entry(data):
+    """Return (key_data, tuple_pointer)."""
+    _check_version(data)
+    _, pageno, tid = _BTREE_ENTRY.unpack_from(data)
+    return bytes(data[_BTREE_ENTRY.size:]), TuplePointer(pageno, tid)
+
+
+def encode_btree_key(key_data):
+    return _VERSION_BYTE + key_data
+
+
+def decode_btree_key(data):
+    _check_version(data)
+    return bytes(data[_VERSION.size:])
+
+
+def encode_tid_list(tid_list):
+    # tids are slot numbers of a page, two bytes are enough
+    return _VERSION_BYTE + struct.pack('%s%dH' % (CTYPE_BIG_ENDIAN, len(tid_list)), *tid_list)
+
+
+def decode_tid_list(data):
+    _check_version(data)
+    return list(struct.unpack_from('%s%dH' % (CTYPE_BIG_ENDIAN, (len(data) - _VERSION.size) // _TID.size),
+                                   data, _VERSION.size))
+
+
+def multi_insert_size(tuple_bytes):
+    """Size that a tuple takes in a HEAP_MULTI_INSERT payload."""
+    return _TUPLE_IMAGE.size + len(tuple_bytes)
+
+
+def encode_tuple_list(tuples_bytes):
+    """Tuple images, each one after its length."""
+    chunks = [_VERSION_BYTE]
+    for tuple_bytes in tuples_bytes:
+        chunks.append(_TUPLE_IMAGE.pack(len(tuple_bytes)))
+        chunks.append(tuple_bytes)
+    return b''.join(chunks)
+
+
+def decode_tuple_list(data):
+    _check_version(data)
+    tuples_bytes = []
+    i = _VERSION.size
+    while i < len(data):
+        length, = _TUPLE_IMAGE.unpack_from(data, i)
+        i += _TUPLE_IMAGE.size
+        tuples_bytes.append(bytes(data[i: i + length]))
+        i += length
+    return tuples_bytes
+
+
+def encode_multi_insert(tuples_bytes):
+    """Tuples inserted into one page in order. Tids are not logged, since redo
+    inserts them in the same order and gets the same tids, as HEAP_INSERT does.
+    So a page full of tuples always fits in one record."""
+    return encode_tuple_list(tuples_bytes)
+
+
+def decode_multi_insert(data):
+    return decode_tuple_list(data)
+
+
+def encode_checkpoint(redo_lsn, latest_xid=INVALID_XID, running_xids=()):
+    return (_CHECKPOINT.pack(WAL_PAYLOAD_VERSION, redo_lsn) + _CHECKPOINT_XID.pack(latest_xid) +
+            struct.pack('%s%dQ' % (CTYPE_BIG_ENDIAN, len(running_xids)), *running_xids))
+
+
+def decode_checkpoint(data):
+    """Return the redo LSN, or None if the record has no payload."""
+    if not data:
+        return None
+    _check_version(data)
+    return _CHECKPOINT.unpack_from(data)[1]
+
+
+def decode_checkpoint_xid(data):
+    """Return the latest xid allocated before the checkpoint, so that
+    xids are not reused after restarting. None if it is not logged."""
+    if len(data) < _CHECKPOINT.size + _CHECKPOINT_XID.size:
+        return None
+    _check_version(data)
+    return _CHECKPOINT_XID.unpack_from(data, _CHECKPOINT.size)[0]
+
+
+def decode_checkpoint_running_xids(data):
+    """Return xids of transactions that were running at the redo point,
+    their BEGIN records are older than it."""
+    offset = _CHECKPOINT.size + _CHECKPOINT_XID.size
+    if len(data) <= offset:
+        return []
+    _check_version(data)
+    return list(struct.unpack_from('%s%dQ' % (CTYPE_BIG_ENDIAN, (len(data) - offset) // _XID.size),
+                                   data, offset))
+
+
+def decode_vacuum(data):
+    """Return the tids of deleted tuples that vacuum removes, besides the
+    items that are marked dead already."""
+    if not data:
+        return []
+    return decode_tid_list(data)
+
+
+_DECODERS = {
+    WALAction.BTREE_INSERT: decode_btree_entry,
+    WALAction.BTREE_UPDATE: decode_btree_entry,
+    WALAction.BTREE_DELETE_VALUE: decode_btree_entry,
+    WALAction.BTREE_DELETE: decode_btree_key,
+    WALAction.HEAP_BATCH_DELETE: decode_tid_list,
+    WALAction.HEAP_MULTI_INSERT: decode_multi_insert,
+    WALAction.HEAP_VACUUM: decode_vacuum,
+    WALAction.CHECKPOINT: decode_checkpoint,
+}
+
+
+def decode_payload(action, data):
+    """Decode the payload of a record for replay, actions that have no
+    structured payload get their data back."""
+    decoder = _DECODERS.get(action)
+    if decoder is None:
+        return data
+    return decoder(data)
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+
+from andb.common.file_operation import file_rename, file_touch, file_unlink, directio_file_open
+from andb.constants.values import WAL_SEGMENT_SIZE
+from andb.runtime import global_vars
+
+TEMP_SUFFIX = '.tmp'
+
+
+def segment_filename(segno):
+    return '%016X' % segno
+
+
+def _parse_segno(filename):
+    if len(filename) != 16:
+        return None
+    try:
+        return int(filename, 16)
+    except ValueError:
+        return None
+
+
+class WALSegmentManager:
+    """Manages WAL segment files, so that the WAL writer rarely creates one
+    in the commit path.
+
+    Segments after the one being written are zero-filled ahead of time
+    (`preallocate()`), and segments made obsolete by a checkpoint are renamed
+    to future segments (`recycle()`) rather than removed. A recycled segment
+    still has old records, which replay tells apart by the page LSN.
+
+    A segment file is only put in place by renaming a complete one, and the
+    WAL writer opens segments under the same lock, so it never writes into
+    a file that is replaced later.
+    """
+
+    def __init__(self, wal_dir):
+        self.wal_dir = wal_dir
+        self._lock = threading.Lock()
+        self.created_segments = 0
+        self.recycled_segments = 0
+        self.removed_segments = 0
+
+    def segment_path(self, segno):
+        return os.path.join(self.wal_dir, segment_filename(segno))
+
+    def list_segments(self):
+        """Return segment numbers in order."""
+        if not os.path.exists(self.wal_dir):
+            return []
+        segments = []
+        for filename in os.listdir(self.wal_dir):
+            segno = _parse_segno(filename)
+            if segno is not None:
+                segments.append(segno)
+        segments.sort()
+        return segments
+
+    def remove_temp_files(self):
+        """Remove half-created segments of a crash."""
+        if not os.path.exists(self.wal_dir):
+            return
+        for filename in os.listdir(self.wal_dir):
+            if filename.endswith(TEMP_SUFFIX):
+                file_unlink(os.path.join(self.wal_dir, filename))
+
+    def open_segment(self, segno):
+        with self._lock:
+            # the segment is created here if it is not ready, the file
+            # just grows with writes then
+            return directio_file_open(self.segment_path(segno), os.O_RDWR | os.O_CREAT)
+
+    def _install(self, filepath, segno):
+        """Rename `filepath` to segment `segno` unless it exists."""
+        with self._lock:
+            target = self.segment_path(segno)
+            if os.path.exists(target):
+                return False
+            file_rename(filepath, target)
+            return True
+
+    def preallocate(self, current_segno, count):
+        """Make sure the `count` segments after `current_segno` exist.
+        Return how many segments are created."""
+        created = 0
+        for segno in range(current_segno + 1, current_segno + count + 1):
+            if os.path.exists(self.segment_path(segno)):
+                continue
+            # zero-fill a temporary file first, so a half-filled
+            # segment never shows up
+            temp_path = self.segment_path(segno) + TEMP_SUFFIX
+            file_touch(temp_path, startup_size=WAL_SEGMENT_SIZE)
+            if self._install(temp_path, segno):
+                created += 1
+            else:
+                file_unlink(temp_path)
+        self.created_segments += created
+        return created
+
+    def recycle(self, redo_lsn, current_segno, max_future_segments):
+        """Segments before the one of `redo_lsn` are not needed by recovery
+        anymore. Rename them to future segments while there are fewer than
+        `max_future_segments` of them, and remove the others."""
+        redo_segno = redo_lsn // WAL_SEGMENT_SIZE
+        segments = self.list_segments()
+        future_segno = max(segments + [current_segno])
+        future_segments = sum(1 for segno in segments if segno > current_segno)
+        for segno in segments:
+            if segno >= redo_segno or segno >= current_segno:
+                break
+            filepath = self.segment_path(segno)
+            if future_segments < max_future_segments:
+                future_segno += 1
+                if self._install(filepath, future_segno):
+                    future_segments += 1
+                    self.recycled_segments += 1
+                    continue
+            file_unlink(filepath)
+            self.removed_segments += 1
+
+    def usage(self, current_segno=None):
+        segments = self.list_segments()
+        disk_usage = 0
+        for segno in segments:
+            try:
+                disk_usage += os.stat(self.segment_path(segno)).st_size
+            except FileNotFoundError:
+                pass
+        stats = {
+            'segments': len(segments),
+            'disk_usage': disk_usage,
+            'created_segments': self.created_segments,
+            'recycled_segments': self.recycled_segments,
+            'removed_segments': self.removed_segments,
+        }
+        if current_segno is not None:
+            stats['current_segment'] = current_segno
+            stats['future_segments'] = sum(1 for segno in segments if segno > current_segno)
+        return stats
+
+
+class WALPreallocator(threading.Thread):
+    """Keeps `wal_prealloc_segments` segments ready ahead of the WAL writer.
+    It wakes up every `delay` seconds, or when the WAL moves to a new segment."""
+
+    def __init__(self, wal_manager, delay, segments):
+        super().__init__(name='walprealloc', daemon=True)
+        self.wal_manager = wal_manager
+        self.delay = delay
+        self.segments = segments
+        self._wakeup_event = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.preallocate_once()
+            except Exception as e:
+                logging.error(f'WAL preallocation failed: {e}')
+            self._wakeup_event.wait(self.delay)
+            self._wakeup_event.clear()
+
+    def preallocate_once(self):
+        current_segno = self.wal_manager.write_lsn // WAL_SEGMENT_SIZE
+        return self.wal_manager.segment_manager.preallocate(current_segno, self.segments)
+
+    def notify(self):
+        self._wakeup_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def start_wal_preallocator():
+    if global_vars.wal_preallocator_worker is not None:
+        return global_vars.wal_preallocator_worker
+    wal_manager = global_vars.xact_manager.wal_manager
+    worker = WALPreallocator(wal_manager, delay=global_vars.wal_prealloc_delay / 1000,
+                             segments=global_vars.wal_prealloc_segments)
+    worker.start()
+    wal_manager.wal_preallocator = worker
+    global_vars.wal_preallocator_worker = worker
+    return worker
+
+
+def stop_wal_preallocator():
+    if global_vars.wal_preallocator_worker is None:
+        return
+    worker = global_vars.wal_preallocator_worker
+    worker.wal_manager.wal_preallocator = None
+    worker.stop()
+    global_vars.wal_preallocator_worker = None
@@ -0,0 +1,74 @@
+import logging
+import threading
+
+from andb.runtime import global_vars
+
+
+class WALWriter(threading.Thread):
+    """Flushes the WAL in the background for asynchronous commits.
+
+    It flushes every `delay` seconds, or as soon as `flush_after` bytes of
+    WAL are waiting to be flushed. Hence, an asynchronous commit is lost
+    after a crash only if it was written in the last `delay` seconds."""
+
+    def __init__(self, wal_manager, delay, flush_after):
+        super().__init__(name='walwriter', daemon=True)
+        self.wal_manager = wal_manager
+        self.delay = delay
+        self.flush_after = flush_after
+        self.flushes = 0
+        self._wakeup_event = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wakeup_event.wait(self.delay)
+            self._wakeup_event.clear()
+            try:
+                self.flush_once()
+            except Exception as e:
+                logging.error(f'walwriter failed: {e}')
+
+    def flush_once(self):
+        write_lsn = self.wal_manager.write_lsn
+        if self.wal_manager.flush_lsn >= write_lsn:
+            return False
+        self.wal_manager.flush(write_lsn)
+        self.flushes += 1
+        return True
+
+    def notify(self):
+        """Called after an asynchronous commit, wake up if there is
+        enough WAL to flush."""
+        if self.wal_manager.write_lsn - self.wal_manager.flush_lsn >= self.flush_after:
+            self._wakeup_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup_event.set()
+        if self.is_alive():
+            self.join()
+        # flush what is left, so a clean shutdown loses nothing
+        self.flush_once()
+
+
+def start_walwriter():
+    if global_vars.walwriter_worker is not None:
+        return global_vars.walwriter_worker
+    wal_manager = global_vars.xact_manager.wal_manager
+    worker = WALWriter(wal_manager,
+                       delay=global_vars.wal_writer_delay / 1000,
+                       flush_after=global_vars.wal_writer_flush_after * 1024)
+    worker.start()
+    wal_manager.wal_writer = worker
+    global_vars.walwriter_worker = worker
+    return worker
+
+
+def stop_walwriter():
+    if global_vars.walwriter_worker is None:
+        return
+    worker = global_vars.walwriter_worker
+    worker.wal_manager.wal_writer = None
+    worker.stop()
+    global_vars.walwriter_worker = None
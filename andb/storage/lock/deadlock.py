@@ -0,0 +1,45 @@
+import logging
+import threading
+
+from andb.runtime import global_vars
+from andb.storage.lock import rlock
+
+
+class DeadlockDetector(threading.Thread):
+    """Checks the wait-for graph of relation locks every `interval` seconds.
+    A waiter in a cycle gets LOCK_DEADLOCK, and the others go on after its
+    statement rolls back and releases the locks."""
+
+    def __init__(self, interval):
+        super().__init__(name='deadlock detector', daemon=True)
+        self.interval = interval
+        self.deadlocks = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.deadlocks += rlock.check_deadlock()
+            except Exception as e:
+                logging.error(f'deadlock detector failed: {e}')
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def start_deadlock_detector():
+    if global_vars.deadlock_detector_worker is not None:
+        return global_vars.deadlock_detector_worker
+    worker = DeadlockDetector(interval=global_vars.deadlock_timeout / 1000)
+    worker.start()
+    global_vars.deadlock_detector_worker = worker
+    return worker
+
+
+def stop_deadlock_detector():
+    if global_vars.deadlock_detector_worker is None:
+        return
+    global_vars.deadlock_detector_worker.stop()
+    global_vars.deadlock_detector_worker = None
@@ -1,9 +1,9 @@
+from contextlib import contextmanager
 from enum import Enum
 import threading
 
 
 class LWLockName(Enum):
-    BUFFER_UPDATE = 1
     WAL_WRITE = 2
 
 _lwlock_instances = {}
@@ -21,6 +21,97 @@ class LWLock:
         return self._lock.release()
 
 
+class SharedExclusiveLatch:
+    """A latch held by many readers (shared) or one writer (exclusive).
+
+    `acquire()`/`release()` and the with statement take it exclusively, and the
+    writer may take it again in either mode. A reader may take it again as
+    well, but it cannot upgrade to exclusive. Writers are preferred, a new
+    reader waits while a writer is waiting."""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._exclusive_depth = 0
+        self._exclusive_waiters = 0
+        # reader thread -> depth
+        self._readers = {}
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._exclusive_depth += 1
+                return True
+            assert me not in self._readers, 'cannot upgrade a shared latch'
+            def free():
+                return self._owner is None and not self._readers
+
+            self._exclusive_waiters += 1
+            try:
+                if blocking:
+                    acquired = self._cond.wait_for(free, timeout if timeout >= 0 else None)
+                else:
+                    acquired = free()
+            finally:
+                self._exclusive_waiters -= 1
+            if not acquired:
+                # the readers held back by this writer can go on
+                self._cond.notify_all()
+                return False
+            self._owner = me
+            self._exclusive_depth = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            assert self._owner == threading.get_ident()
+            self._exclusive_depth -= 1
+            if self._exclusive_depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def acquire_shared(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._exclusive_depth += 1
+                return
+            if me not in self._readers:
+                self._cond.wait_for(lambda: self._owner is None and not self._exclusive_waiters)
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_shared(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._exclusive_depth -= 1
+                if self._exclusive_depth == 0:
+                    self._owner = None
+                    self._cond.notify_all()
+                return
+            self._readers[me] -= 1
+            if self._readers[me] == 0:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
 def init_lwlock():
     for lock_name in LWLockName:
         _lwlock_instances[lock_name.value] = LWLock()
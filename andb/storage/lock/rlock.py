@@ -1,10 +1,11 @@
+import collections
 import threading
 import time
 
 NO_LOCK = 0
 ACCESS_SHARE_LOCK = 1  # SELECT
-ROW_SHARE_LOCK = 2  # SELECT FOR UPDATE/FOR SHARE
-ROW_EXCLUSIVE_LOCK = 3  # INSERT, UPDATE, DELETE
+ROW_SHARE_LOCK = 2  # SELECT FOR UPDATE/FOR SHARE, intention share
+ROW_EXCLUSIVE_LOCK = 3  # INSERT, UPDATE, DELETE, intention exclusive, rows are locked one by one
 SHARE_UPDATE_EXCLUSIVE_LOCK = 4  # ANALYZE
 SHARE_LOCK = 5  # CREATE INDEX
 SHARE_ROW_EXCLUSIVE_LOCK = 6  # EXCLUSIVE MODE
@@ -15,53 +16,258 @@ MAX_LOCK_MODE = ACCESS_EXCLUSIVE_LOCK
 LOCK_NOT_AVAILABLE = 0
 LOCK_OK = 1
 LOCK_ALREADY_HELD = 2
+LOCK_DEADLOCK = 3
 
-_lock_table = {}
+NUM_LOCK_PARTITIONS = 16
+
+
+def _mask(*modes):
+    bits = 0
+    for mode in modes:
+        bits |= 1 << mode
+    return bits
+
+
+# modes that conflict with each mode, the same as PostgreSQL's
+_CONFLICTS = [
+    _mask(),
+    _mask(ACCESS_EXCLUSIVE_LOCK),
+    _mask(EXCLUSIVE_LOCK, ACCESS_EXCLUSIVE_LOCK),
+    _mask(SHARE_LOCK, SHARE_ROW_EXCLUSIVE_LOCK, EXCLUSIVE_LOCK, ACCESS_EXCLUSIVE_LOCK),
+    _mask(SHARE_UPDATE_EXCLUSIVE_LOCK, SHARE_LOCK, SHARE_ROW_EXCLUSIVE_LOCK, EXCLUSIVE_LOCK,
+          ACCESS_EXCLUSIVE_LOCK),
+    _mask(ROW_EXCLUSIVE_LOCK, SHARE_UPDATE_EXCLUSIVE_LOCK, SHARE_ROW_EXCLUSIVE_LOCK, EXCLUSIVE_LOCK,
+          ACCESS_EXCLUSIVE_LOCK),
+    _mask(ROW_EXCLUSIVE_LOCK, SHARE_UPDATE_EXCLUSIVE_LOCK, SHARE_LOCK, SHARE_ROW_EXCLUSIVE_LOCK,
+          EXCLUSIVE_LOCK, ACCESS_EXCLUSIVE_LOCK),
+    _mask(ROW_SHARE_LOCK, ROW_EXCLUSIVE_LOCK, SHARE_UPDATE_EXCLUSIVE_LOCK, SHARE_LOCK,
+          SHARE_ROW_EXCLUSIVE_LOCK, EXCLUSIVE_LOCK, ACCESS_EXCLUSIVE_LOCK),
+    _mask(ACCESS_SHARE_LOCK, ROW_SHARE_LOCK, ROW_EXCLUSIVE_LOCK, SHARE_UPDATE_EXCLUSIVE_LOCK, SHARE_LOCK,
+          SHARE_ROW_EXCLUSIVE_LOCK, EXCLUSIVE_LOCK, ACCESS_EXCLUSIVE_LOCK),
+]
+
+
+def lock_conflicts(mode1, mode2):
+    return bool(_CONFLICTS[mode1] & (1 << mode2))
+
+
+# status of a LockRequest
+WAITING = 0
+GRANTED = 1
+CANCELED = 2
+
+
+class LockRequest:
+    def __init__(self, owner, mode):
+        self.owner = owner
+        self.mode = mode
+        self.status = WAITING
+        self.wait_start = time.monotonic()
 
 
 class LockEntry:
+    """The lock of a tag. A lock owner (thread) is not blocked by the modes
+    it holds itself, so it can take a stronger mode later."""
+
     def __init__(self, tag):
         self.tag = tag
-        self.holders = set()
-        self.mode = NO_LOCK
+        # owner -> held count of each mode
+        self.holders = {}
+        # held count of each mode by all owners
+        self.granted = [0] * (MAX_LOCK_MODE + 1)
+        # requests in arrival order
+        self.waiters = collections.deque()
 
+    def conflicts_with_holders(self, owner, mode):
+        own = self.holders.get(owner)
+        for held_mode in range(1, MAX_LOCK_MODE + 1):
+            others = self.granted[held_mode] - (own[held_mode] if own else 0)
+            if others > 0 and lock_conflicts(mode, held_mode):
+                return True
+        return False
 
-def lock_acquire(tag, lock_mode, dont_wait, wait_seconds):
-    if tag not in _lock_table:
-        _lock_table[tag] = LockEntry(tag)
+    def blockers(self, request):
+        """Owners that `request` waits for: the holders of conflicting modes
+        and, as the queue is FIFO, the conflicting requests ahead of it."""
+        blockers = set()
+        for owner, counts in self.holders.items():
+            if owner != request.owner and any(
+                    counts[mode] and lock_conflicts(request.mode, mode) for mode in range(1, MAX_LOCK_MODE + 1)):
+                blockers.add(owner)
+        for ahead in self.waiters:
+            if ahead is request:
+                break
+            if ahead.owner != request.owner and lock_conflicts(request.mode, ahead.mode):
+                blockers.add(ahead.owner)
+        return blockers
+
+    def grantable(self, request):
+        if self.conflicts_with_holders(request.owner, request.mode):
+            return False
+        if request.owner in self.holders:
+            # jumping the queue, otherwise it waits for the waiters that wait for it
+            return True
+        for ahead in self.waiters:
+            if ahead is request:
+                break
+            if lock_conflicts(request.mode, ahead.mode):
+                return False
+        return True
 
-    entry = _lock_table[tag]
+    def grant(self, owner, mode):
+        counts = self.holders.setdefault(owner, [0] * (MAX_LOCK_MODE + 1))
+        counts[mode] += 1
+        self.granted[mode] += 1
 
-    # if threading.get_ident() in entry.holders:
-    #     #TODO: not support lock upgrade directly
-    #     return LOCK_ALREADY_HELD
+    def is_free(self):
+        return not self.holders and not self.waiters
 
-    if entry.mode + lock_mode <= MAX_LOCK_MODE:
-        entry.mode += lock_mode
-        entry.holders.add(threading.get_ident())
-        return LOCK_OK
 
-    if not dont_wait:
-        time.sleep(wait_seconds)
+class LockPartition:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # waiters of all tags in the partition wait on it
+        self.cond = threading.Condition(self.mutex)
+        self.entries = {}
 
-    if entry.mode + lock_mode <= MAX_LOCK_MODE:
-        entry.mode += lock_mode
-        entry.holders.add(threading.get_ident())
-        return LOCK_OK
-    else:
-        return LOCK_NOT_AVAILABLE
 
+_partitions = [LockPartition() for _ in range(NUM_LOCK_PARTITIONS)]
 
-def lock_release(tag, lock_mode):
-    assert tag in _lock_table
 
-    entry = _lock_table[tag]
+def _get_partition(tag):
+    return _partitions[hash(tag) % NUM_LOCK_PARTITIONS]
+
+
+def lock_acquire(tag, lock_mode, dont_wait, wait_seconds):
+    """Acquire the lock of `tag` in `lock_mode` for the current thread.
+    Conflicting requests wait in FIFO order for at most `wait_seconds`
+    (forever if it is not positive), unless the deadlock detector cancels
+    the wait, see `check_deadlock()`."""
+    owner = threading.get_ident()
+    partition = _get_partition(tag)
+    with partition.cond:
+        entry = partition.entries.get(tag)
+        if entry is None:
+            entry = partition.entries[tag] = LockEntry(tag)
+        request = LockRequest(owner, lock_mode)
+        if entry.grantable(request):
+            entry.grant(owner, lock_mode)
+            return LOCK_OK
+        if dont_wait:
+            if entry.is_free():
+                del partition.entries[tag]
+            return LOCK_NOT_AVAILABLE
+
+        entry.waiters.append(request)
+        deadline = time.monotonic() + wait_seconds if wait_seconds > 0 else None
+        while True:
+            if request.status == CANCELED:
+                rv = LOCK_DEADLOCK
+                break
+            if entry.grantable(request):
+                request.status = GRANTED
+                entry.grant(owner, lock_mode)
+                rv = LOCK_OK
+                break
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    rv = LOCK_NOT_AVAILABLE
+                    break
+            partition.cond.wait(timeout)
+
+        entry.waiters.remove(request)
+        if entry.is_free():
+            del partition.entries[tag]
+        # the ones behind may be able to go now
+        partition.cond.notify_all()
+        return rv
 
-    if threading.get_ident() in entry.holders:
-        entry.holders.remove(threading.get_ident())
 
-    if entry.mode - lock_mode >= NO_LOCK:
-        entry.mode -= lock_mode
+def lock_release(tag, lock_mode):
+    owner = threading.get_ident()
+    partition = _get_partition(tag)
+    with partition.cond:
+        entry = partition.entries.get(tag)
+        if entry is None:
+            return False
+        counts = entry.holders.get(owner)
+        if counts is None or counts[lock_mode] == 0:
+            return False
+        counts[lock_mode] -= 1
+        entry.granted[lock_mode] -= 1
+        if not any(counts):
+            del entry.holders[owner]
+        if entry.is_free():
+            del partition.entries[tag]
+        elif entry.waiters:
+            partition.cond.notify_all()
         return True
 
-    return False
+
+def check_deadlock():
+    """Look for cycles in the wait-for graph and cancel the wait of one
+    request in each cycle, the one that has waited the shortest.
+    :return: the number of canceled requests
+    """
+    # take all partitions in order to see a consistent graph
+    for partition in _partitions:
+        partition.mutex.acquire()
+    try:
+        # an owner (thread) waits for at most one request
+        waiting = {}
+        edges = {}
+        for partition in _partitions:
+            for entry in partition.entries.values():
+                for request in entry.waiters:
+                    if request.status != WAITING:
+                        continue
+                    waiting[request.owner] = (partition, request)
+                    edges[request.owner] = entry.blockers(request)
+
+        canceled = 0
+        for cycle in _find_cycles(edges):
+            partition, victim = max((waiting[owner] for owner in cycle), key=lambda w: w[1].wait_start)
+            victim.status = CANCELED
+            partition.cond.notify_all()
+            canceled += 1
+        return canceled
+    finally:
+        for partition in reversed(_partitions):
+            partition.mutex.release()
+
+
+def _find_cycles(edges):
+    """Return disjoint cycles of the graph {node: successors}."""
+    cycles = []
+    done = set()
+    for start in edges:
+        if start in done:
+            continue
+        path = []
+        on_path = {}
+        stack = [(start, iter(edges.get(start, ())))]
+        path.append(start)
+        on_path[start] = 0
+        while stack:
+            node, successors = stack[-1]
+            for successor in successors:
+                if successor in on_path:
+                    cycles.append(path[on_path[successor]:])
+                    # one cycle per search is enough, canceling one wait of
+                    # it changes the graph anyway
+                    stack.clear()
+                    break
+                if successor not in done and successor in edges:
+                    path.append(successor)
+                    on_path[successor] = len(path) - 1
+                    stack.append((successor, iter(edges[successor])))
+                    break
+            else:
+                stack.pop()
+                done.add(path.pop())
+                del on_path[node]
+        done.update(path)
+    return cycles
+
@@ -1,25 +1,37 @@
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from andb.catalog.oid import INVALID_OID
-from andb.constants.macros import INVALID_XID, FIRST_XID, MAX_XID, XID_SIZE
+from andb.constants.macros import INVALID_XID, FIRST_XID, MAX_XID, XID_SIZE, \
+    TBLOCK_DEFAULT, TBLOCK_INPROGRESS, TBLOCK_FAILED
 from andb.constants.strings import BIG_END
-from andb.errno.errors import UndoError
+from andb.errno.errors import UndoError, RollbackError
 from andb.runtime import global_vars, session_vars
-from andb.storage.engines.heap.bptree import TuplePointer
 from andb.storage.engines.heap.page import INVALID_ITEM_ID
 from andb.storage.engines.heap.redo import WALManager, WALRecord, WALAction, WAL_SEGMENT_SIZE
 from andb.constants.filename import CHECKPOINT_FILE, WAL_DIR
 from andb.storage.engines.heap.relation import BufferedBPTree, bt_delete, bt_simple_insert, open_relation, close_relation
-from andb.storage.engines.heap.undo import UndoManager, UndoOperation
-from andb.storage.lock import slock
-from andb.storage.utils import easy_tuple_deserialize
+from andb.storage.engines.heap.undo import UndoManager, UndoOperation, UndoRecord
+from andb.storage.engines.heap.vacuum import report_dead_items
+from andb.storage.engines.heap.mvcc import set_heap_tuple_xmax
+from andb.storage.engines.heap.walpayload import decode_payload, decode_checkpoint, encode_checkpoint, \
+    decode_checkpoint_xid, decode_checkpoint_running_xids
+from andb.storage.lock import slock, rlock
+from andb.storage.xact.snapshot import Snapshot
 
 STATUS_ACTIVE = 0
 STATUS_COMMITTED = 1
 STATUS_ABORTED = 2
 
+# undo operations whose location starts with the pageno of a heap page
+_HEAP_UNDO_OPERATIONS = (UndoOperation.HEAP_INSERT, UndoOperation.HEAP_MULTI_INSERT, UndoOperation.HEAP_DELETE,
+                         UndoOperation.HEAP_UPDATE, UndoOperation.HEAP_BATCH_DELETE)
+_HEAP_REDO_ACTIONS = (WALAction.HEAP_INSERT, WALAction.HEAP_MULTI_INSERT, WALAction.HEAP_DELETE,
+                      WALAction.HEAP_UPDATE, WALAction.HEAP_BATCH_DELETE, WALAction.HEAP_VACUUM)
+
 def xid_to_bytes(xid):
     return int.to_bytes(xid, XID_SIZE, BIG_END, signed=False)
 
@@ -34,6 +46,10 @@ class TransactionManager:
         self._xid_lock = slock.spinlock_create()
         self._current_xid = FIRST_XID
         self.active_transactions = {}
+        # xids that are allocated but not begun, snapshots take them as running
+        self._allocated_xids = set()
+        # snapshots of running statements, id -> snapshot
+        self._snapshots = {}
 
     def begin_transaction(self, xid):
         if xid in self.active_transactions:
@@ -41,20 +57,40 @@ class TransactionManager:
         self.set_xid(xid)
         self.undo_manager.begin_transaction(xid)
         wal_record = WALRecord(xid=xid, oid=INVALID_OID, pageno=0, tid=0, action=WALAction.BEGIN, data=b'')
-        self.wal_manager.write_record(wal_record)
+        begin_lsn = self.wal_manager.write_record(wal_record)
+        slock.spinlock_aquire(self._xid_lock)
+        self._allocated_xids.discard(xid)
         self.active_transactions[xid] = {
             'status': STATUS_ACTIVE,
             'start_time': time.time(),
-            'last_lsn': self.wal_manager.max_lsn()
+            'last_lsn': begin_lsn,
+            # tags of the locked tuples, see lock_tuple()
+            'tuple_locks': set()
         }
+        slock.spinlock_release(self._xid_lock)
+
+    def begin_read_only_transaction(self):
+        """Fast path for a statement that writes nothing, e.g., SELECT. It
+        has no xid, writes no WAL or undo, and its commit (or abort) is a no-op
+        as it is not in `active_transactions`."""
+        self.set_xid(INVALID_XID)
+        return INVALID_XID
 
     def commit_transaction(self, xid):
         """
         Commit a transaction and ensure all changes are persisted.
         The order of operations is critical:
         1. Flush undo logs to disk
-        2. Ensure all dirty pages are written (redo logs)
-        3. Write commit record to WAL
+        2. Ensure all dirty pages are written (only in the force mode)
+        3. Write commit record to WAL, which also flushes WAL up to it
+
+        In the no_force mode, dirty pages are written later by bgwriter,
+        checkpoint or eviction, and a crash is covered by redo.
+
+        With synchronous_commit off, the commit record is flushed later by
+        the WAL writer, a crash may lose the latest commits but never a part
+        of a transaction. Return the commit LSN, which is durable once
+        `flushed_lsn()` reaches it.
         """
         if xid not in self.active_transactions:
             return
@@ -67,18 +103,32 @@ class TransactionManager:
         self.undo_manager.flush(xid)
         
         # Step 2: Ensure all dirty pages are written
-        global_vars.buffer_manager.sync()
+        if global_vars.commit_mode == 'force':
+            global_vars.buffer_manager.sync()
         
         # Step 3: Write commit record to WAL
         wal_record = WALRecord(xid=xid, oid=INVALID_OID, pageno=0, tid=0, action=WALAction.COMMIT, data=b'')
-        self.wal_manager.write_record(wal_record)
+        transaction['last_lsn'] = self.wal_manager.write_record(wal_record,
+                                                                asynchronous=not self.synchronous_commit())
         
         # Step 4: Commit undo transaction
         self.undo_manager.commit_transaction(xid)
-        transaction['last_lsn'] = self.wal_manager.max_lsn()
 
-        del self.active_transactions[xid]
+        # from now on, new snapshots see the changes
+        self._end_transaction(xid)
         self.set_xid(INVALID_XID)
+        return transaction['last_lsn']
+
+    @staticmethod
+    def synchronous_commit():
+        synchronous_commit = session_vars.SessionVars.synchronous_commit
+        if synchronous_commit is None:
+            synchronous_commit = global_vars.synchronous_commit
+        return synchronous_commit == 'on'
+
+    def flushed_lsn(self):
+        """Commits before this LSN survive a crash."""
+        return self.wal_manager.flush_lsn
 
     def abort_transaction(self, xid):
         if xid not in self.active_transactions:
@@ -88,27 +138,142 @@ class TransactionManager:
         assert transaction['status'] == STATUS_ACTIVE
         transaction['status'] = STATUS_ABORTED
 
-        # Write abort record to WAL
-        wal_record = WALRecord(xid=xid, oid=INVALID_OID, pageno=0, tid=0, action=WALAction.ABORT, data=xid_to_bytes(xid))
-        self.wal_manager.write_record(wal_record)
-        transaction['last_lsn'] = self.wal_manager.max_lsn()
-
         # Flush undo logs
         self.undo_manager.flush(xid)
-        # Perform undo operations
-        self.perform_undo(xid, transaction['last_lsn'])
+        # Perform undo operations, each one is logged before the abort record,
+        # so redo never brings the aborted changes back
+        self.perform_undo(xid)
+
+        # Write abort record to WAL
+        wal_record = WALRecord(xid=xid, oid=INVALID_OID, pageno=0, tid=0, action=WALAction.ABORT, data=xid_to_bytes(xid))
+        transaction['last_lsn'] = self.wal_manager.write_record(wal_record)
         # Abort undo transaction
         self.undo_manager.abort_transaction(xid)
 
-        del self.active_transactions[xid]
+        self._end_transaction(xid)
         self.set_xid(INVALID_XID)
 
+    def _end_transaction(self, xid):
+        slock.spinlock_aquire(self._xid_lock)
+        transaction = self.active_transactions.pop(xid)
+        slock.spinlock_release(self._xid_lock)
+        # the waiters go on after the transaction has ended
+        for tag in transaction['tuple_locks']:
+            rlock.lock_release(tag, rlock.EXCLUSIVE_LOCK)
+
+    def lock_tuple(self, xid, relation_oid, pageno, tid):
+        """Lock a tuple before updating or deleting it, until the transaction
+        ends. Writers of the same tuple queue up here, while writers of different
+        tuples run in parallel since they only hold ROW_EXCLUSIVE_LOCK (the
+        intention mode) on the table."""
+        transaction = self.active_transactions.get(xid)
+        if transaction is None:
+            return
+        tag = ('tuple', relation_oid, pageno, tid)
+        if tag in transaction['tuple_locks']:
+            return
+        rc = rlock.lock_acquire(tag, rlock.EXCLUSIVE_LOCK, False, global_vars.lock_timeout / 1000)
+        if rc == rlock.LOCK_DEADLOCK:
+            raise RollbackError('deadlock detected.')
+        if rc != rlock.LOCK_OK:
+            raise RollbackError('canceling statement due to lock timeout.')
+        transaction['tuple_locks'].add(tag)
+
+    def is_active(self, xid):
+        return xid in self.active_transactions
+
+    def _build_snapshot(self):
+        slock.spinlock_aquire(self._xid_lock)
+        xmax = self._current_xid + 1
+        xip = frozenset(xid for xid in list(self.active_transactions) + list(self._allocated_xids)
+                        if xid >= FIRST_XID)
+        slock.spinlock_release(self._xid_lock)
+        return Snapshot(min(xip, default=xmax), xmax, xip, self.get_xid())
+
+    def take_snapshot(self):
+        """Take the snapshot of the statement that is going to run. Each
+        statement sees what is committed before it starts (read committed),
+        so readers never wait for writers."""
+        snapshot = self._build_snapshot()
+        slock.spinlock_aquire(self._xid_lock)
+        self._snapshots[id(snapshot)] = snapshot
+        slock.spinlock_release(self._xid_lock)
+        session_vars.SessionVars.snapshot = snapshot
+        return snapshot
+
+    def release_snapshot(self):
+        snapshot = session_vars.SessionVars.snapshot
+        if snapshot is None:
+            return
+        session_vars.SessionVars.snapshot = None
+        slock.spinlock_aquire(self._xid_lock)
+        self._snapshots.pop(id(snapshot), None)
+        slock.spinlock_release(self._xid_lock)
+
+    def get_snapshot(self):
+        """Return the snapshot of the running statement, or a new one
+        out of a statement."""
+        snapshot = session_vars.SessionVars.snapshot
+        if snapshot is None:
+            snapshot = self._build_snapshot()
+        return snapshot
+
+    def oldest_xmin(self):
+        """Transactions before it are seen by every running and future
+        snapshot, so the versions they replaced are not needed anymore."""
+        slock.spinlock_aquire(self._xid_lock)
+        horizon = self._current_xid + 1
+        for xid in self.active_transactions:
+            if xid >= FIRST_XID:
+                horizon = min(horizon, xid)
+        for snapshot in self._snapshots.values():
+            horizon = min(horizon, snapshot.xmin)
+        slock.spinlock_release(self._xid_lock)
+        return horizon
+
+    @staticmethod
+    def transaction_block_state():
+        return session_vars.SessionVars.transaction_block
+
+    def begin_transaction_block(self):
+        """BEGIN, statements of the session run in one transaction until COMMIT
+        or ROLLBACK, so they share one commit (and one WAL flush).
+        Return the xid, or INVALID_XID if the session is in a block already."""
+        if self.transaction_block_state() != TBLOCK_DEFAULT:
+            return INVALID_XID
+        xid = self.allocate_xid()
+        self.begin_transaction(xid)
+        session_vars.SessionVars.transaction_block = TBLOCK_INPROGRESS
+        return xid
+
+    def fail_transaction_block(self):
+        """A statement in the block failed, roll back what the block has done.
+        Later statements are refused until the block ends."""
+        assert self.transaction_block_state() == TBLOCK_INPROGRESS
+        self.abort_transaction(self.get_xid())
+        session_vars.SessionVars.transaction_block = TBLOCK_FAILED
+
+    def end_transaction_block(self, commit=True):
+        """COMMIT (or ROLLBACK if `commit` is false). A failed block is only
+        rolled back. Return whether the transaction is committed."""
+        state = self.transaction_block_state()
+        if state == TBLOCK_DEFAULT:
+            return False
+        committed = commit and state == TBLOCK_INPROGRESS
+        if committed:
+            self.commit_transaction(self.get_xid())
+        elif state == TBLOCK_INPROGRESS:
+            self.abort_transaction(self.get_xid())
+        session_vars.SessionVars.transaction_block = TBLOCK_DEFAULT
+        return committed
+
     def allocate_xid(self):
         slock.spinlock_aquire(self._xid_lock)
         self._current_xid += 1
         xid = self._current_xid
         #TODO: we don't need to wraparound xid now
         assert xid <= MAX_XID
+        self._allocated_xids.add(xid)
         slock.spinlock_release(self._xid_lock)
         return xid
 
@@ -118,175 +283,350 @@ class TransactionManager:
     def recovery(self):
         """
         Recovery process to replay WAL records and undo uncommitted transactions.
+
+        WAL is read only once from the checkpoint, transactions are analyzed and
+        redo records are grouped by (relation, pageno) in the same pass. Then,
+        groups are replayed by a pool of workers, see `parallel_redo()`.
         """
-        if not os.path.exists(WAL_DIR):
-            flush_lsn = 0
-        else:
-            wal_files = os.listdir(WAL_DIR)
-            if not wal_files:
-                flush_lsn = 0
-            else:
-                # remove checkpoint file from the list
-                if CHECKPOINT_FILE in wal_files:
-                    wal_files.remove(CHECKPOINT_FILE)
-                wal_files.sort()
-                last_wal_file = wal_files[-1]
-                last_segment_number = int(last_wal_file, 16)
-                last_segment_path = os.path.join(WAL_DIR, last_wal_file)
-                last_segment_size = os.stat(last_segment_path).st_size
-                flush_lsn = (last_segment_number * WAL_SEGMENT_SIZE) + last_segment_size
-
-        self.wal_manager.flush_lsn = flush_lsn
-        self.wal_manager.write_lsn = flush_lsn
-
-        # 2. 读取上次的checkpoint位置
+        # 1. 读取上次的checkpoint位置
         checkpoint_lsn = self.read_checkpoint_lsn()
-        replay_lsn = checkpoint_lsn
-        transactions = set()
-
-        # First pass: Identify the checkpoint and gather transaction IDs
+        # segments are preallocated or recycled, so the end of WAL is
+        # where replay stops rather than the size of the last file
+        self.wal_manager.segment_manager.remove_temp_files()
+        end_lsn = checkpoint_lsn
+        # xid -> LSN of its BEGIN record
+        transactions = {}
+        # xids that have COMMIT or ABORT records
+        finished = set()
+        # (relation oid, pageno) -> redo records in LSN order
+        partitions = {}
+        # tuples keep xids, which must not be allocated again
+        latest_xid = self._current_xid
+
+        # 2. 一遍扫描: 分析事务状态, 同时按页分组redo记录
         for redo_record in self.wal_manager.replay(lsn=checkpoint_lsn):
-            replay_lsn += redo_record.total_size
-            if redo_record.action == WALAction.CHECKPOINT:
-                # 更新最新的checkpoint位置
-                checkpoint_lsn = replay_lsn
-                # 清空之前的事务集合,因为checkpoint之前的事务都已经完成
-                transactions.clear()
-            elif redo_record.action == WALAction.BEGIN:
-                transactions.add(redo_record.xid)
-            elif redo_record.action == WALAction.COMMIT:
-                transactions.discard(redo_record.xid)
-            elif redo_record.action == WALAction.ABORT:
-                transactions.discard(redo_record.xid)
-
-        # 4. 从最新的checkpoint开始重放WAL记录
-        replay_lsn = checkpoint_lsn
-        for redo_record in self.wal_manager.replay(lsn=checkpoint_lsn):
-            replay_lsn += redo_record.total_size
-            self.apply_redo(redo_record, replay_lsn)
+            end_lsn = redo_record.lsn
+            action = redo_record.action
+            latest_xid = max(latest_xid, redo_record.xid)
+            if action == WALAction.CHECKPOINT:
+                latest_xid = max(latest_xid, decode_checkpoint_xid(redo_record.data) or INVALID_XID)
+                # 更新最新的checkpoint位置, 新的checkpoint记录中带有redo位置,
+                # 因为在写脏页的过程中还有其他修改
+                checkpoint_lsn = decode_checkpoint(redo_record.data)
+                if checkpoint_lsn is None:
+                    checkpoint_lsn = redo_record.lsn
+                # redo位置之前开始的事务由checkpoint记录给出, 它们的BEGIN记录不会被扫描到
+                transactions = {xid: lsn for xid, lsn in transactions.items() if lsn >= checkpoint_lsn}
+                for xid in decode_checkpoint_running_xids(redo_record.data):
+                    if xid not in finished:
+                        transactions.setdefault(xid, checkpoint_lsn)
+                # changes before the redo point have been written by the checkpoint
+                partitions = {key: [record for record in records if record.lsn > checkpoint_lsn]
+                              for key, records in partitions.items()}
+            elif action == WALAction.BEGIN:
+                transactions[redo_record.xid] = redo_record.lsn - redo_record.total_size
+            elif action == WALAction.COMMIT or action == WALAction.ABORT:
+                transactions.pop(redo_record.xid, None)
+                finished.add(redo_record.xid)
+            else:
+                pageno, _ = redo_record.location
+                partitions.setdefault((redo_record.relation_oid, pageno), []).append(redo_record)
 
-        # 5. 对未完成的事务执行undo
-        for xid in transactions:
-            self.perform_undo(xid, replay_lsn)
+        self.wal_manager.set_lsn(end_lsn)
+        self._current_xid = latest_xid
+
+        # 3. 并行重放
+        self.parallel_redo(partitions)
 
-    def apply_redo(self, redo_record, replay_lsn):
+        # 4. 对未完成的事务执行undo, 完成后写入abort记录, 再次恢复时不再undo
+        for xid in transactions:
+            self.perform_undo(xid)
+            self.wal_manager.write_record(WALRecord(xid=xid, oid=INVALID_OID, pageno=0, tid=0,
+                                                    action=WALAction.ABORT, data=xid_to_bytes(xid)))
+
+    def parallel_redo(self, partitions, workers=None):
+        """Replay the groups of redo records by `workers` threads. A group is
+        never split, so records of a page are replayed in order. B-tree records
+        are logical and their pageno is always 0, so an index is one group."""
+        if not partitions:
+            return
+        workers = workers or global_vars.recovery_workers
+        # open each relation once rather than once per record
+        relations = {}
+        for oid, _ in partitions:
+            if oid not in relations:
+                relations[oid] = open_relation(oid)
+
+        buckets = [[] for _ in range(workers)]
+        for key, records in partitions.items():
+            buckets[hash(key) % workers].append(records)
+
+        def redo_bucket(bucket):
+            for records in bucket:
+                for redo_record in records:
+                    self.apply_redo(redo_record, redo_record.lsn, relations[redo_record.relation_oid])
+
+        try:
+            if workers == 1:
+                redo_bucket(buckets[0])
+            else:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='redo') as pool:
+                    futures = [pool.submit(redo_bucket, bucket) for bucket in buckets if bucket]
+                    for future in futures:
+                        future.result()
+        finally:
+            for oid, relation in relations.items():
+                if relation:
+                    close_relation(oid)
+
+    def apply_redo(self, redo_record, replay_lsn, relation=None):
         """
-        Apply redo log to the database.
+        Apply redo log to the database. Skip changes that the page has had
+        already (page LSN >= `replay_lsn`).
         """
-        xid = redo_record.xid
         action = redo_record.action
-        relation = open_relation(redo_record.relation_oid)
+        opened = relation is None
+        if opened:
+            relation = open_relation(redo_record.relation_oid)
+        if not relation:
+            # the relation has been dropped
+            return
         location = redo_record.location 
         data = redo_record.data
 
-        if action == WALAction.HEAP_INSERT:
-            pageno, tid = location
-            page = global_vars.buffer_manager.get_page(relation, pageno).page
-            if page.header.lsn < replay_lsn:
-                new_tid = page.insert(replay_lsn, data)
-                page.header.lsn = replay_lsn
-                assert new_tid == tid
-        elif action == WALAction.HEAP_DELETE:
-            pageno, tid = location
-            page = global_vars.buffer_manager.get_page(relation, pageno).page
-            if page.header.lsn < replay_lsn:
-                page.delete(replay_lsn, tid)
-                page.header.lsn = replay_lsn
-        elif action == WALAction.HEAP_UPDATE:
-            # now, we implement inplace update by delete and insert,
-            # so the replay processing is not in the branch
-            pageno, tid = location
-            page = global_vars.buffer_manager.get_page(relation, pageno).page
-            if page.header.lsn < replay_lsn:
-                page.update(replay_lsn, tid, data)
-                page.header.lsn = replay_lsn
+        if action in _HEAP_REDO_ACTIONS:
+            pageno = location[0]
+            buffer_manager = global_vars.buffer_manager
+            # the same as hot_simple_insert(), other redo workers may evict
+            # pages, so pin it and hold its content latch while changing it
+            buffer_page = buffer_manager.get_page(relation, pageno, pin=True)
+            try:
+                with buffer_page.content_lock:
+                    page = buffer_page.page
+                    if page.header.lsn < replay_lsn:
+                        self._redo_heap_page(relation, page, redo_record, replay_lsn)
+                        page.header.lsn = replay_lsn
+                        # commit doesn't write the page in no_force mode, the next
+                        # checkpoint must write it before moving the redo point
+                        buffer_page.mark_dirty()
+            finally:
+                buffer_manager.unpin_page(buffer_page)
         elif action == WALAction.BTREE_INSERT:
-            key_data, tuple_pointer_data = easy_tuple_deserialize(data)
-            tuple_pointer = TuplePointer()
-            tuple_pointer.unpack(tuple_pointer_data)
-            tree = BufferedBPTree(relation)
-            tree.insert(replay_lsn, key_data, tuple_pointer)
+            key_data, tuple_pointer = decode_payload(action, data)
+            with BufferedBPTree(relation) as tree:
+                # the same as heap pages, skip it if the leaf has had it
+                if tree.leaf_lsn(key_data) < replay_lsn:
+                    tree.insert(replay_lsn, key_data, tuple_pointer)
         elif action == WALAction.BTREE_DELETE:
-            key_data, tuple_pointer_data = easy_tuple_deserialize(data)
-            tuple_pointer = TuplePointer()
-            tuple_pointer.unpack(tuple_pointer_data)
-            tree = BufferedBPTree(relation)
-            tree.delete_value(replay_lsn, key_data, tuple_pointer)
+            # the same as bt_delete(), the whole key is deleted
+            key_data = decode_payload(action, data)
+            with BufferedBPTree(relation) as tree:
+                if tree.leaf_lsn(key_data) < replay_lsn:
+                    tree.delete(replay_lsn, key_data)
         elif action == WALAction.BTREE_UPDATE:
-            key_data, tuple_pointer_data = easy_tuple_deserialize(data)
-            tuple_pointer = TuplePointer()
-            tuple_pointer.unpack(tuple_pointer_data)
-            tree = BufferedBPTree(relation)
-            tree.update(replay_lsn, key_data, tuple_pointer)
+            key_data, tuple_pointer = decode_payload(action, data)
+            # the same as bt_update()
+            with BufferedBPTree(relation) as tree:
+                if tree.leaf_lsn(key_data) < replay_lsn:
+                    tree.delete(replay_lsn, key_data)
+                    tree.insert(replay_lsn, key_data, tuple_pointer)
+        elif action == WALAction.BTREE_DELETE_VALUE:
+            key_data, tuple_pointer = decode_payload(action, data)
+            with BufferedBPTree(relation) as tree:
+                if tree.leaf_lsn(key_data) < replay_lsn:
+                    tree.delete_value(replay_lsn, key_data, tuple_pointer)
+        elif action == WALAction.UNDO:
+            self.apply_undo(UndoRecord.from_bytes(data), relation, replay_lsn, replay=True)
         elif action in (WALAction.BEGIN, WALAction.COMMIT, WALAction.ABORT, WALAction.CHECKPOINT):
             pass
         else:
             raise NotImplementedError(f"WAL action {action} is not implemented")
         
-        if relation:
+        if opened:
             close_relation(relation.oid)
 
-    def perform_undo(self, xid, lsn):
+    @staticmethod
+    def _redo_heap_page(relation, page, redo_record, replay_lsn):
+        xid = redo_record.xid
+        action = redo_record.action
+        pageno, tid = redo_record.location
+        data = redo_record.data
+        if action == WALAction.HEAP_INSERT:
+            new_tid = page.insert(replay_lsn, data)
+            assert new_tid == tid
+        elif action == WALAction.HEAP_MULTI_INSERT:
+            tids = [page.insert(replay_lsn, tuple_bytes) for tuple_bytes in decode_payload(action, data)]
+            assert tids[0] == tid and INVALID_ITEM_ID not in tids
+        elif action == WALAction.HEAP_DELETE:
+            # the same as hot_simple_delete()
+            success = set_heap_tuple_xmax(page, tid, xid)
+            assert success
+            report_dead_items(relation, pageno, 1)
+        elif action == WALAction.HEAP_UPDATE:
+            # only heap-only updates are logged as this action, updates that
+            # move the tuple are logged as delete and insert
+            success = page.overwrite(replay_lsn, tid, data)
+            assert success
+        elif action == WALAction.HEAP_BATCH_DELETE:
+            tid_list = decode_payload(action, data)
+            for tid in tid_list:
+                set_heap_tuple_xmax(page, tid, xid)
+            # let autovacuum clean them up after recovery
+            report_dead_items(relation, pageno, len(tid_list))
+        elif action == WALAction.HEAP_VACUUM:
+            for tid in decode_payload(action, data):
+                page.delete(replay_lsn, tid)
+            page.prune(replay_lsn)
+
+    def perform_undo(self, xid):
         """
         Undo operations for a given transaction ID.
         """
+        # undo records only have the relation oid, open each relation once
+        relations = {}
+        try:
+            self._perform_undo(xid, relations)
+        finally:
+            for oid, relation in relations.items():
+                if relation:
+                    close_relation(oid)
+
+    def _perform_undo(self, xid, relations):
         # 这些record本身就已经是从文件尾部往前读取的了，因为做过了reverse
         for undo_record in self.undo_manager.parse_record(xid):
-            if undo_record.operation == UndoOperation.HEAP_INSERT:
-                pageno, tid = undo_record.location
-                page = global_vars.buffer_manager.get_page(undo_record.relation, pageno).page
-                success = page.delete_inplace(lsn, tid)
+            if undo_record.operation in (UndoOperation.BEGIN, UndoOperation.COMMIT, UndoOperation.ABORT):
+                continue
+            relation = None
+            if undo_record.relation is not None:
+                if undo_record.relation_oid not in relations:
+                    relations[undo_record.relation_oid] = open_relation(undo_record.relation_oid)
+                relation = relations[undo_record.relation_oid]
+                if not relation:
+                    # the relation has been dropped
+                    continue
+
+            # compensation record: redo applies the undo record again after
+            # the change it undoes, as the page may have been written before
+            pageno = undo_record.location[0] if undo_record.operation in _HEAP_UNDO_OPERATIONS else 0
+            self.wal_manager.write_record(
+                WALRecord(xid=xid, oid=undo_record.relation_oid, pageno=pageno, tid=0,
+                          action=WALAction.UNDO, data=undo_record.to_bytes()))
+            self.apply_undo(undo_record, relation, self.max_lsn())
+
+    @staticmethod
+    @contextmanager
+    def _undo_page(relation, pageno, lsn, replay):
+        """Pin the page and hold its exclusive content latch for an undo
+        action, like the DML does. None means the page has had it."""
+        buffer_manager = global_vars.buffer_manager
+        buffer_page = buffer_manager.get_page(relation, pageno, pin=True)
+        try:
+            with buffer_page.content_lock:
+                page = buffer_page.page
+                if replay and page.header.lsn >= lsn:
+                    yield None
+                    return
+                yield page
+                buffer_page.mark_dirty()
+        finally:
+            buffer_manager.unpin_page(buffer_page)
+
+    def apply_undo(self, undo_record, relation, lsn, replay=False):
+        """Apply an undo record to the relation with `lsn`, the LSN of its
+        compensation record. When `replay` is true, it is redo of that record,
+        and a page that has had it is skipped."""
+        if undo_record.operation == UndoOperation.HEAP_INSERT:
+            pageno, tid = undo_record.location
+            with self._undo_page(relation, pageno, lsn, replay) as page:
+                if page is None:
+                    return
+                # mark it dead rather than remove it, so that other tuples keep their tids
+                success = page.delete(lsn, tid)
                 if not success:
                     logging.error(f'UNDO: failed to delete item {tid} in page {pageno}, items are {page.item_ids}')
-                global_vars.buffer_manager.mark_dirty(undo_record.relation, pageno)
-            elif undo_record.operation == UndoOperation.HEAP_DELETE:
-                pageno, tid = undo_record.location
-                page = global_vars.buffer_manager.get_page(undo_record.relation, pageno).page
-                new_tid = page.insert(lsn, undo_record.data)
-                if new_tid == INVALID_ITEM_ID:
-                    logging.error(f'UNDO: failed to insert item to page {pageno}')
-                    raise UndoError(f'UNDO: failed to insert item to page {pageno}')
-                global_vars.buffer_manager.mark_dirty(undo_record.relation, pageno)
-            elif undo_record.operation == UndoOperation.HEAP_UPDATE:
-                pageno, tid = undo_record.location
-                page = global_vars.buffer_manager.get_page(undo_record.relation, pageno).page
-                item_id = page.update(lsn, tid, undo_record.data)
-                if item_id == INVALID_ITEM_ID:
+                report_dead_items(relation, pageno, 1)
+        elif undo_record.operation == UndoOperation.HEAP_MULTI_INSERT:
+            pageno, tid_list = undo_record.location
+            with self._undo_page(relation, pageno, lsn, replay) as page:
+                if page is None:
+                    return
+                for tid in tid_list:
+                    if not page.delete(lsn, tid):
+                        logging.error(f'UNDO: failed to delete item {tid} in page {pageno}, items are {page.item_ids}')
+                report_dead_items(relation, pageno, len(tid_list))
+        elif undo_record.operation == UndoOperation.HEAP_DELETE:
+            pageno, tid = undo_record.location
+            with self._undo_page(relation, pageno, lsn, replay) as page:
+                if page is None:
+                    return
+                # the old tuple has no xmax
+                success = page.overwrite(lsn, tid, undo_record.data)
+                if not success:
                     logging.error(f'UNDO: failed to find item {tid} in page {pageno}')
                     raise UndoError(f'UNDO: failed to find item {tid} in page {pageno}')
-                global_vars.buffer_manager.mark_dirty(undo_record.relation, pageno)
-            elif undo_record.operation == UndoOperation.BTREE_INSERT:
-                key_data, tuple_pointer = undo_record.location
-                tree = BufferedBPTree(undo_record.relation)
-                lsn = self.max_lsn() #TODO: is this fine?
-                # btree can mark dirty itself
-                tree.delete_value(lsn, key_data, tuple_pointer)
-            elif undo_record.operation == UndoOperation.BTREE_UPDATE:
-                key_data, old_tuple_pointer = undo_record.location
-                tree = BufferedBPTree(undo_record.relation)
-                lsn = self.max_lsn() #TODO: is this fine?
-                tree.update(lsn, key_data, old_tuple_pointer)
-            elif undo_record.operation == UndoOperation.BTREE_DELETE:
-                key_data, old_tuple_pointer = undo_record.location
-                tree = BufferedBPTree(undo_record.relation)
-                lsn = self.max_lsn() #TODO: is this fine?
-                tree.insert(lsn, key_data, old_tuple_pointer)
-            elif undo_record.operation == UndoOperation.BEGIN or \
-                    undo_record.operation == UndoOperation.COMMIT or \
-                undo_record.operation == UndoOperation.ABORT:
-                pass
-            else:
-                raise NotImplementedError(f"Undo operation {undo_record.operation} is not implemented")
+        elif undo_record.operation == UndoOperation.HEAP_UPDATE:
+            pageno, tid = undo_record.location
+            with self._undo_page(relation, pageno, lsn, replay) as page:
+                if page is None:
+                    return
+                success = page.overwrite(lsn, tid, undo_record.data)
+                if not success:
+                    logging.error(f'UNDO: failed to find item {tid} in page {pageno}')
+                    raise UndoError(f'UNDO: failed to find item {tid} in page {pageno}')
+        elif undo_record.operation == UndoOperation.HEAP_BATCH_DELETE:
+            pageno, tid_list = undo_record.location
+            with self._undo_page(relation, pageno, lsn, replay) as page:
+                if page is None:
+                    return
+                for tid in tid_list:
+                    if not set_heap_tuple_xmax(page, tid, INVALID_XID):
+                        logging.error(f'UNDO: failed to find item {tid} in page {pageno}')
+                        raise UndoError(f'UNDO: failed to find item {tid} in page {pageno}')
+        elif undo_record.operation == UndoOperation.BTREE_INSERT:
+            key_data, tuple_pointer = undo_record.location
+            # btree can mark dirty itself
+            with BufferedBPTree(relation) as tree:
+                if not (replay and tree.leaf_lsn(key_data) >= lsn):
+                    tree.delete_value(lsn, key_data, tuple_pointer)
+        elif undo_record.operation == UndoOperation.BTREE_UPDATE:
+            # the key had these tuple pointers before the update
+            key_data, old_tuple_pointers = undo_record.location
+            with BufferedBPTree(relation) as tree:
+                if not (replay and tree.leaf_lsn(key_data) >= lsn):
+                    tree.delete(lsn, key_data)
+                    for tuple_pointer in old_tuple_pointers:
+                        tree.insert(lsn, key_data, tuple_pointer)
+        elif undo_record.operation == UndoOperation.BTREE_DELETE:
+            key_data, old_tuple_pointers = undo_record.location
+            with BufferedBPTree(relation) as tree:
+                if not (replay and tree.leaf_lsn(key_data) >= lsn):
+                    for tuple_pointer in old_tuple_pointers:
+                        tree.insert(lsn, key_data, tuple_pointer)
+        elif undo_record.operation == UndoOperation.BEGIN or \
+                undo_record.operation == UndoOperation.COMMIT or \
+            undo_record.operation == UndoOperation.ABORT:
+            pass
+        else:
+            raise NotImplementedError(f"Undo operation {undo_record.operation} is not implemented")
 
-    def checkpoint(self):
+    def checkpoint(self, spread=False):
         """
         Create a checkpoint in the WAL and flush dirty pages to disk.
+        If `spread` is true, page writes are spread over `checkpoint_target_duration`
+        seconds, and other sessions can go on in the meantime.
         """
-        # 1. 确保所有脏页都写入磁盘
-        global_vars.buffer_manager.sync()
-        
-        # 2. 写入checkpoint记录到WAL
-        checkpoint_lsn = self.max_lsn()
+        # 1. 记录redo位置, 之后的修改都能从WAL中恢复
+        redo_lsn = self.max_lsn()
+        # 跨过redo位置的事务, 若之后的WAL中没有结束记录, 恢复时需要undo
+        running_xids = self._running_xids()
+
+        # 2. 确保此前的脏页都写入磁盘, 从最早修改的页开始
+        buffer_manager = global_vars.buffer_manager
+        duration = global_vars.checkpoint_target_duration if spread else 0
+        buffer_manager.flush_pages(buffer_manager.get_oldest_dirty_pages(), duration=duration)
+        buffer_manager.sync_evicted_pages()
+
+        # 3. 写入checkpoint记录到WAL, 记录中带有redo位置
         self.wal_manager.write_record(
             WALRecord(
                 xid=INVALID_XID,
@@ -294,28 +634,46 @@ class TransactionManager:
                 pageno=0,
                 tid=0,
                 action=WALAction.CHECKPOINT,
-                data=b''
+                data=encode_checkpoint(redo_lsn, self._current_xid, running_xids)
             )
         )
         
-        # 3. 刷新WAL缓冲区
-        self.wal_manager.wal_buffer_flush()
+        # 4. 刷新WAL缓冲区
+        self.wal_manager.flush(self.wal_manager.max_lsn())
         
-        # 4. 持久化checkpoint位置
-        self.write_checkpoint_lsn(checkpoint_lsn)
+        # 5. 持久化checkpoint位置
+        self.write_checkpoint_lsn(redo_lsn)
+
+        # 6. 回收不再需要的WAL段
+        self.wal_manager.segment_manager.recycle(
+            redo_lsn, self.max_lsn() // WAL_SEGMENT_SIZE,
+            max_future_segments=global_vars.wal_prealloc_segments + global_vars.wal_recycle_segments)
+
+    def _running_xids(self):
+        """Return xids of running transactions. Transactions that are committing
+        or aborting are waited for, so the COMMIT or ABORT record of every
+        returned one is written after this call."""
+        while True:
+            slock.spinlock_aquire(self._xid_lock)
+            ending = any(transaction['status'] != STATUS_ACTIVE for transaction in self.active_transactions.values())
+            running_xids = list(self.active_transactions)
+            slock.spinlock_release(self._xid_lock)
+            if not ending:
+                return running_xids
+            time.sleep(0.001)
 
     def set_xid(self, xid):
-        session_vars.session_xid = xid
+        session_vars.SessionVars.session_xid = xid
 
     def get_xid(self):
-        if session_vars.session_xid is None \
-                or session_vars.session_xid == INVALID_XID:
+        if session_vars.SessionVars.session_xid is None \
+                or session_vars.SessionVars.session_xid == INVALID_XID:
             pass
             # logging.warning(
             #     f"Session XID is None or INVALID_XID: "
-            #     f"{session_vars.session_xid}"
+            #     f"{session_vars.SessionVars.session_xid}"
             # )
-        return session_vars.session_xid
+        return session_vars.SessionVars.session_xid
 
     def write_checkpoint_lsn(self, lsn):
         """
@@ -0,0 +1,33 @@
+from andb.constants.macros import FIRST_XID
+
+
+class Snapshot:
+    """Which transactions a statement can see: the ones that committed before
+    the snapshot was taken, and its own transaction.
+
+    Transactions before `xmin` have ended, the ones from `xmax` on have not
+    started yet, and those in `xip` (in progress) were running when the
+    snapshot was taken. An aborted transaction has undone its changes
+    before it ends, hence an ended transaction is a committed one here.
+    """
+
+    def __init__(self, xmin, xmax, xip, xid):
+        self.xmin = xmin
+        self.xmax = xmax
+        self.xip = xip
+        self.xid = xid
+
+    def is_visible(self, xid):
+        if xid < FIRST_XID:
+            # e.g., DUMMY_XID, always visible
+            return True
+        if xid == self.xid:
+            return True
+        if xid >= self.xmax:
+            return False
+        if xid < self.xmin:
+            return True
+        return xid not in self.xip
+
+    def __repr__(self):
+        return f'<Snapshot xmin={self.xmin} xmax={self.xmax} xip={sorted(self.xip)}>'
@@ -1,9 +1,15 @@
+import threading
+
+import pytest
+
 from andb.catalog.class_ import RelationKinds
 from andb.catalog.oid import OID_DATABASE_ANDB
 from andb.catalog.syscache import CATALOG_ANDB_CLASS
+from andb.constants.macros import DUMMY_XID, TBLOCK_DEFAULT, TBLOCK_FAILED
 from andb.entrance import execute_simple_query
 from andb.errno.errors import InitializationStageError
 from andb.executor.operator.logical import Condition, InsertOperator, SelectionOperator, TableColumn, UpdateOperator
+from andb.executor.operator.physical import update
 from andb.executor.operator.utils import ExprOperation
 from andb.executor.portal import ExecutionPortal
 from andb.runtime import global_vars
@@ -13,7 +19,8 @@ from andb.sql.parser import andb_query_parse, get_ast_type
 from andb.sql.parser.ast.identifier import Identifier
 from andb.sql.parser.ast.misc import Constant
 from andb.sql.parser.ast.operation import BinaryOperation, Operation
-from andb.storage.engines.heap.relation import close_relation, hot_simple_select_all, open_relation
+from andb.storage.engines.heap.relation import bt_search, close_relation, hot_simple_select_all, open_relation
+from andb.storage.engines.heap.vacuum import vacuum_relation
 
 
 def test_execute_simple_query():
@@ -128,3 +135,160 @@ def test_abort_transaction():
     assert rows == old_rows
 
     close_relation(oid)
+
+
+def test_read_only_query(monkeypatch):
+    execute_simple_query('create table t_read_only (a int not null, b text)')
+    execute_simple_query("insert into t_read_only values (1, 'a1'), (2, 'b2')")
+
+    xact_manager = global_vars.xact_manager
+
+    def fail():
+        raise AssertionError('a read-only query should not sync buffers')
+
+    monkeypatch.setattr(global_vars.buffer_manager, 'sync', fail)
+    lsn = xact_manager.max_lsn()
+    xid = xact_manager.allocate_xid()
+    result = execute_simple_query('select * from t_read_only where a > 1')
+    assert result.tuples == [(2, 'b2')]
+    # no WAL, xid or undo
+    assert xact_manager.max_lsn() == lsn
+    assert xact_manager.allocate_xid() == xid + 1
+    assert not xact_manager.active_transactions
+    assert not xact_manager.undo_manager.active_transactions
+    monkeypatch.undo()
+    execute_simple_query('drop table t_read_only')
+
+
+def test_transaction_block(monkeypatch):
+    execute_simple_query('create table t_block (a int not null, b text)')
+
+    xact_manager = global_vars.xact_manager
+    commits = []
+    commit_transaction = xact_manager.commit_transaction
+
+    def counted_commit(xid):
+        if xid in xact_manager.active_transactions:
+            commits.append(xid)
+        return commit_transaction(xid)
+
+    monkeypatch.setattr(xact_manager, 'commit_transaction', counted_commit)
+
+    # several statements in one string, committed together
+    execute_simple_query("begin; insert into t_block values (1, 'a1'); insert into t_block values (2, 'b2');")
+    execute_simple_query("insert into t_block values (3, 'c3')")
+    assert not commits
+    assert execute_simple_query('select * from t_block').tuples == [(1, 'a1'), (2, 'b2'), (3, 'c3')]
+    result = execute_simple_query('commit')
+    assert result.warning is None
+    assert len(commits) == 1
+    assert not xact_manager.active_transactions
+    assert xact_manager.transaction_block_state() == TBLOCK_DEFAULT
+
+    execute_simple_query("start transaction; insert into t_block values (4, 'd4'); rollback")
+    assert execute_simple_query('select * from t_block').tuples == [(1, 'a1'), (2, 'b2'), (3, 'c3')]
+    assert len(commits) == 1
+
+    # an error rolls back the whole block, and the rest is ignored
+    execute_simple_query("begin; insert into t_block values (5, 'e5')")
+    with pytest.raises(Exception):
+        execute_simple_query('insert into t_no_such_table values (1)')
+    assert xact_manager.transaction_block_state() == TBLOCK_FAILED
+    assert execute_simple_query("insert into t_block values (6, 'f6')") is None
+    assert execute_simple_query('commit').warning == 'the transaction has been rolled back'
+    assert execute_simple_query('select * from t_block').tuples == [(1, 'a1'), (2, 'b2'), (3, 'c3')]
+    assert len(commits) == 1
+
+    assert execute_simple_query('commit').warning == 'there is no transaction in progress'
+    monkeypatch.undo()
+    execute_simple_query('drop table t_block')
+
+
+def test_utility_transaction(monkeypatch):
+    xact_manager = global_vars.xact_manager
+    xids = []
+    begin_transaction = xact_manager.begin_transaction
+
+    def recorded_begin(xid):
+        xids.append(xid)
+        return begin_transaction(xid)
+
+    monkeypatch.setattr(xact_manager, 'begin_transaction', recorded_begin)
+    execute_simple_query('create table t_utility (a int not null)')
+    execute_simple_query('drop table t_utility')
+    monkeypatch.undo()
+    # each utility statement has a transaction of its own
+    assert len(set(xids)) == 2 and DUMMY_XID not in xids
+    assert not any(xid in xact_manager.active_transactions for xid in xids)
+
+
+def test_semicolon_in_literal():
+    execute_simple_query('create table t_semicolon (a int not null, b text)')
+    # statements are split by the lexer, not at every semicolon
+    execute_simple_query("begin; insert into t_semicolon values (1, 'a;b'); -- not; a statement\ncommit")
+    assert execute_simple_query('select * from t_semicolon').tuples == [(1, 'a;b')]
+    assert global_vars.xact_manager.transaction_block_state() == TBLOCK_DEFAULT
+    execute_simple_query('drop table t_semicolon')
+
+
+def test_update_skips_gone_rows(monkeypatch):
+    execute_simple_query('create table t_update_gone (a int not null, b text)')
+    execute_simple_query("insert into t_update_gone values (1, 'a'), (2, 'b')")
+
+    hot_simple_update = update.hot_simple_update
+
+    def gone_first(relation, pageno, tid, python_tuple, heap_only=True):
+        # e.g., the transaction has deleted the tuple
+        if python_tuple[0] == 1:
+            return None
+        return hot_simple_update(relation, pageno, tid, python_tuple, heap_only)
+
+    monkeypatch.setattr(update, 'hot_simple_update', gone_first)
+    result = execute_simple_query("update t_update_gone set b = 'x' where a > 0")
+    monkeypatch.undo()
+    assert result.effect_rows == 1
+    assert execute_simple_query('select * from t_update_gone').tuples == [(1, 'a'), (2, 'x')]
+    execute_simple_query('drop table t_update_gone')
+
+
+def test_index_keeps_old_versions():
+    execute_simple_query('create table t_index_mvcc (id int not null, name text)')
+    execute_simple_query('create index t_index_mvcc_id on t_index_mvcc (id)')
+    execute_simple_query("insert into t_index_mvcc values (1, 'a'), (2, 'b')")
+
+    updated = threading.Event()
+    done = threading.Event()
+
+    def update():
+        execute_simple_query('begin; update t_index_mvcc set id = 100 where id = 1')
+        updated.set()
+        done.wait(10)
+        execute_simple_query('commit')
+
+    thread = threading.Thread(target=update)
+    thread.start()
+    try:
+        assert updated.wait(10)
+        # the uncommitted update moves the row, the index still finds the old version
+        assert execute_simple_query('select * from t_index_mvcc where id = 1').tuples == [(1, 'a')]
+        assert execute_simple_query('select * from t_index_mvcc where id = 100').tuples == []
+    finally:
+        done.set()
+        thread.join()
+    assert execute_simple_query('select * from t_index_mvcc where id = 1').tuples == []
+    assert execute_simple_query('select * from t_index_mvcc where id = 100').tuples == [(100, 'a')]
+
+    execute_simple_query('delete from t_index_mvcc where id = 2')
+    assert execute_simple_query('select * from t_index_mvcc where id = 2').tuples == []
+    # vacuum removes the old versions and their index entries
+    table_oid = CATALOG_ANDB_CLASS.get_relation_oid('t_index_mvcc', OID_DATABASE_ANDB, RelationKinds.HEAP_TABLE)
+    index_oid = CATALOG_ANDB_CLASS.get_relation_oid('t_index_mvcc_id', OID_DATABASE_ANDB, RelationKinds.BTREE_INDEX)
+    relation = open_relation(table_oid)
+    index_relation = open_relation(index_oid)
+    assert len(bt_search(index_relation, [1])) == len(bt_search(index_relation, [2])) == 1
+    assert vacuum_relation(relation) >= 2
+    assert bt_search(index_relation, [1]) == bt_search(index_relation, [2]) == []
+    assert len(bt_search(index_relation, [100])) == 1
+    close_relation(index_oid)
+    close_relation(table_oid)
+    execute_simple_query('drop table t_index_mvcc')
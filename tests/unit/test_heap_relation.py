@@ -1,11 +1,22 @@
+import threading
+import time
+
 from andb.catalog.syscache import CATALOG_ANDB_ATTRIBUTE, CATALOG_ANDB_CLASS, CATALOG_ANDB_INDEX
-from andb.storage.engines.heap.relation import TupleData, hot_batch_delete
+from andb.catalog.syscache import CATALOG_ANDB_TYPE
+from andb.catalog.type import VarcharType
+from andb.storage.engines.heap.codec import get_tuple_codec
+from andb.storage.engines.heap.relation import TupleData, hot_batch_delete, hot_page_decode, hot_multi_insert
+from andb.storage.engines.heap.redo import WALAction
+from andb.storage.engines.heap.vacuum import dead_item_tracker, vacuum_relation, get_vacuum_stats
+from andb.storage.xact.snapshot import Snapshot
+from andb.storage.buffer.bgwriter import BackgroundWriter, start_bgwriter, stop_bgwriter
 from andb.errno.errors import RollbackError, DDLException
 from andb.storage.engines.heap.relation import hot_simple_delete, hot_create_table, hot_drop_table, hot_simple_insert, \
-    hot_simple_select, hot_simple_update, close_relation, open_relation, bt_create_index, bt_drop_index, \
-    bt_simple_insert, bt_delete, bt_search, bt_search_range, bt_update, RelationKinds, TuplePointer
+    hot_simple_select, hot_simple_select_all, hot_simple_update, close_relation, open_relation, bt_create_index, \
+    bt_drop_index, bt_simple_insert, bt_delete, bt_search, bt_search_range, bt_update, RelationKinds, TuplePointer
 from andb.catalog.oid import OID_DATABASE_ANDB
-from andb.runtime import global_vars
+from andb.constants.macros import INVALID_XID
+from andb.runtime import global_vars, session_vars
 from andb.catalog.syscache import CATALOG_ANDB_DATABASE
 
 
@@ -53,6 +64,64 @@ def test_heap_tuple():
         raise AssertionError()
 
 
+def test_tuple_codec():
+    tuple_desc = (
+        ('id', 'int', True),
+        ('big', 'bigint', False),
+        ('score', 'double', False),
+        ('ratio', 'real', False),
+        ('name', 'text', False),
+        ('city', 'varchar4', False),
+    )
+    class_oid = 123457
+    CATALOG_ANDB_ATTRIBUTE.define_table_fields(class_oid=class_oid, fields=tuple_desc)
+    try:
+        attrs = CATALOG_ANDB_ATTRIBUTE.search(lambda r: r.class_oid == class_oid)
+        codec = get_tuple_codec(attrs)
+        assert codec is get_tuple_codec(attrs)
+
+        def slow_to_bytes(python_tuple):
+            nulls = 0
+            byte_array = bytearray()
+            for i, (form, datum) in enumerate(zip(attrs, python_tuple)):
+                if datum is None:
+                    nulls |= (1 << i)
+                    continue
+                if form.type_oid == VarcharType.oid:
+                    datum = datum[:form.length]
+                byte_array.extend(CATALOG_ANDB_TYPE.cast_datum_to_bytes(
+                    CATALOG_ANDB_TYPE.get_type_name(form.type_oid), datum))
+            return int.to_bytes(nulls, length=8, byteorder='big') + bytes(byte_array)
+
+        for python_tuple in ((-1, 2 ** 40, 1.5, 0.25, 'xiaoming', 'beijing'),
+                             (7, None, 3.0, None, 'hello', 'hang'),
+                             (0, -5, None, 2.0, None, None)):
+            data = codec.encode(python_tuple)
+            assert data == slow_to_bytes(python_tuple)
+            expected = tuple(v[:4] if isinstance(v, str) and i == 5 else v
+                             for i, v in enumerate(python_tuple))
+            assert codec.decode(data) == expected
+            assert codec.decode(memoryview(data)) == expected
+            assert codec.decode_columns(memoryview(data), (5, 0, 2)) == (expected[5], expected[0], expected[2])
+            assert codec.decode_columns(data, (1,)) == (expected[1],)
+
+        assert codec.prefix(2).decode(codec.prefix(2).encode((1, 2))) == (1, 2)
+        try:
+            codec.encode((None, 1, 1., 1., 'a', 'b'))
+        except RollbackError:
+            pass
+        else:
+            raise AssertionError()
+        try:
+            codec.encode(('a', 1, 1., 1., 'a', 'b'))
+        except TypeError:
+            pass
+        else:
+            raise AssertionError()
+    finally:
+        CATALOG_ANDB_ATTRIBUTE.delete(lambda r: r.class_oid == class_oid)
+
+
 def test_hot():
     fields = (
         ('id', 'int', True),
@@ -80,17 +149,37 @@ def test_hot():
     result = hot_simple_select(test_hot_relation, test_hot_relation.last_pageno(), 3)
     assert result == (4, 'xm4', 'b4')
 
+    buffer_page = global_vars.buffer_manager.get_page(test_hot_relation, test_hot_relation.last_pageno())
+    assert list(hot_page_decode(test_hot_relation, buffer_page, (2, 0))) == [
+        (0, ('be', 1)), (1, ('b2', 2)), (2, ('b3', 3)), (3, ('b4', 4))
+    ]
+
     assert hot_batch_delete(test_hot_relation, test_hot_relation.last_pageno(), [3])
     assert hot_simple_select(test_hot_relation, test_hot_relation.last_pageno(), 3) == ()
 
+    # heap-only update keeps the tid
     pageno, tid = hot_simple_update(test_hot_relation, test_hot_relation.last_pageno(), 2, (1, None, None))
-    assert hot_simple_select(test_hot_relation, test_hot_relation.last_pageno(), 2) == ()
+    assert (pageno, tid) == (test_hot_relation.last_pageno(), 2)
     assert hot_simple_select(test_hot_relation, test_hot_relation.last_pageno(), tid) == (1, None, None)
 
+    # the dead item cannot be vacuumed until the transaction ends
+    assert dead_item_tracker.get_dead_item_count(table_oid) == 1
+    assert vacuum_relation(test_hot_relation, active_xids={xid}) == 0
+    assert dead_item_tracker.get_dead_item_count(table_oid) == 1
+
+    dirty_pages = global_vars.buffer_manager.get_dirty_pages(test_hot_relation)
+    assert [buffer_page.pageno for buffer_page in dirty_pages] == [pageno]
     global_vars.buffer_manager.sync()
+    assert global_vars.buffer_manager.get_dirty_pages(test_hot_relation) == []
     global_vars.xact_manager.commit_transaction(xid)
     assert hot_simple_select(test_hot_relation, pageno, tid) == (1, None, None)
 
+    removed_dead_items = get_vacuum_stats()['removed_dead_items']
+    assert vacuum_relation(test_hot_relation) == 1
+    assert get_vacuum_stats()['removed_dead_items'] == removed_dead_items + 1
+    assert dead_item_tracker.get_dead_item_count(table_oid) == 0
+    assert hot_simple_select(test_hot_relation, pageno, tid) == (1, None, None)
+
     close_relation(table_oid)
 
     try:
@@ -237,3 +326,412 @@ def test_btree():
     global_vars.xact_manager.commit_transaction(0)
 
     #TODO: we haven't tested float byte-encoding whether support order-preserving.
+
+
+def test_btree_split():
+    xid = global_vars.xact_manager.allocate_xid()
+    global_vars.xact_manager.begin_transaction(xid)
+    hot_create_table('test_bt_split', (('id', 'int', True), ('name', 'text', False)))
+    index_oid = bt_create_index('test_bt_split_name', table_name='test_bt_split', fields=('name',))
+    index_relation = open_relation(index_oid)
+    start_lsn = global_vars.xact_manager.max_lsn()
+    # long keys split leaves and internal nodes after a few inserts
+    keys = [str(i).zfill(4) + 'x' * 1000 for i in range(300)]
+    order = list(range(len(keys)))
+    order.sort(key=lambda i: (i * 7919) % len(keys))
+    for i in order:
+        bt_simple_insert(index_relation, key=(keys[i],), tuple_pointer=TuplePointer(i, 0))
+    for i, key in enumerate(keys):
+        assert bt_search(index_relation, key=(key,)) == [TuplePointer(i, 0)]
+    global_vars.xact_manager.commit_transaction(xid)
+    close_relation(index_oid)
+
+    # the split nodes have been written out
+    global_vars.buffer_manager.sync()
+    global_vars.buffer_manager.reset()
+    index_relation = open_relation(index_oid)
+    for i, key in enumerate(keys):
+        assert bt_search(index_relation, key=(key,)) == [TuplePointer(i, 0)]
+
+    # redo skips the entries that the leaves have had
+    partitions = {}
+    for record in global_vars.xact_manager.wal_manager.replay(start_lsn):
+        if record.relation_oid == index_oid:
+            partitions.setdefault((index_oid, record.location[0]), []).append(record)
+    assert partitions
+    global_vars.xact_manager.parallel_redo(partitions)
+    for i, key in enumerate(keys):
+        assert bt_search(index_relation, key=(key,)) == [TuplePointer(i, 0)]
+    close_relation(index_oid)
+    bt_drop_index('test_bt_split_name')
+    hot_drop_table('test_bt_split')
+
+
+def test_bgwriter_and_checkpoint():
+    table_oid = hot_create_table('test_bgwriter', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xid = global_vars.xact_manager.allocate_xid()
+    global_vars.xact_manager.begin_transaction(xid)
+    relation = open_relation(table_oid)
+    for i in range(600):
+        hot_simple_insert(relation, (i, 'x' * 32))
+    buffer_manager = global_vars.buffer_manager
+    dirty_pages = buffer_manager.get_dirty_pages(relation)
+    assert len(dirty_pages) >= 3
+    oldest = buffer_manager.get_oldest_dirty_pages()
+    assert [buffer_page.lsn for buffer_page in oldest] == sorted(buffer_page.lsn for buffer_page in oldest)
+
+    # the running bgwriter would see the lowered threshold too
+    stop_bgwriter()
+    old_pct = global_vars.max_dirty_page_pct
+    global_vars.max_dirty_page_pct = 0
+    try:
+        bgwriter = BackgroundWriter(delay=1, max_pages=1)
+        assert bgwriter.write_once() == 1
+        assert len(buffer_manager.get_dirty_pages(relation)) == len(dirty_pages) - 1
+    finally:
+        global_vars.max_dirty_page_pct = old_pct
+        start_bgwriter()
+
+    # writes are spread over the duration
+    start = time.monotonic()
+    assert buffer_manager.flush_pages(buffer_manager.get_dirty_pages(relation)[:2],
+                                      duration=0.2, batch_size=1) == 2
+    assert time.monotonic() - start >= 0.2
+
+    redo_lsn = global_vars.xact_manager.max_lsn()
+    global_vars.xact_manager.checkpoint()
+    assert buffer_manager.dirty_page_count() == 0
+    assert global_vars.xact_manager.read_checkpoint_lsn() == redo_lsn
+
+    global_vars.xact_manager.commit_transaction(xid)
+    close_relation(table_oid)
+    hot_drop_table('test_bgwriter')
+
+
+def test_recovery_after_checkpoint():
+    table_oid = hot_create_table('test_recovery_checkpoint', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    relation = open_relation(table_oid)
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    pageno, tid = hot_simple_insert(relation, (1, 'uncommitted'))
+    # the row is written by the checkpoint, and its BEGIN is before the redo point
+    xact_manager.checkpoint()
+
+    # crash: the transaction never ends
+    global_vars.buffer_manager.evict_relation(relation)
+    xact_manager.active_transactions.pop(xid)
+    xact_manager.undo_manager.active_transactions.pop(xid)
+    xact_manager.set_xid(INVALID_XID)
+    assert hot_simple_select(relation, pageno, tid) == (1, 'uncommitted')
+    xact_manager.recovery()
+    assert hot_simple_select(relation, pageno, tid) == ()
+    close_relation(table_oid)
+    hot_drop_table('test_recovery_checkpoint')
+
+
+def test_no_force_commit():
+    table_oid = hot_create_table('test_no_force', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    buffer_manager = global_vars.buffer_manager
+    wal_manager = global_vars.xact_manager.wal_manager
+    old_mode = global_vars.commit_mode
+    global_vars.commit_mode = 'no_force'
+    try:
+        xid = global_vars.xact_manager.allocate_xid()
+        global_vars.xact_manager.begin_transaction(xid)
+        relation = open_relation(table_oid)
+        for i in range(10):
+            hot_simple_insert(relation, (i, 'no force'))
+        global_vars.xact_manager.commit_transaction(xid)
+        # WAL is durable up to the commit record, but pages are still dirty
+        assert wal_manager.flush_lsn == wal_manager.write_lsn
+        dirty_pages = buffer_manager.get_dirty_pages(relation)
+        assert len(dirty_pages) == 1
+
+        xid = global_vars.xact_manager.allocate_xid()
+        global_vars.xact_manager.begin_transaction(xid)
+        pageno, tid = hot_simple_insert(relation, (10, 'no force'))
+        buffer_page = buffer_manager.get_page(relation, pageno)
+        assert wal_manager.flush_lsn < buffer_page.lsn
+        # WAL-before-data
+        assert buffer_manager.flush_page(buffer_page)
+        assert wal_manager.flush_lsn >= buffer_page.lsn
+        global_vars.xact_manager.commit_transaction(xid)
+    finally:
+        global_vars.commit_mode = old_mode
+    close_relation(table_oid)
+    hot_drop_table('test_no_force')
+
+
+def test_recovery_after_abort():
+    table_oid = hot_create_table('test_recovery_abort', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    relation = open_relation(table_oid)
+    xact_manager.checkpoint()
+    old_mode = global_vars.commit_mode
+    global_vars.commit_mode = 'no_force'
+    try:
+        xid = xact_manager.allocate_xid()
+        xact_manager.begin_transaction(xid)
+        pageno, tid = hot_simple_insert(relation, (2, 'aborted'))
+        xact_manager.abort_transaction(xid)
+    finally:
+        global_vars.commit_mode = old_mode
+    records = [record for record in xact_manager.wal_manager.replay(xact_manager.read_checkpoint_lsn())
+               if record.xid == xid]
+    assert [record.action for record in records][-2:] == [WALAction.UNDO, WALAction.ABORT]
+
+    # crash: pages are lost, redo replays the insert and then its undo
+    global_vars.buffer_manager.evict_relation(relation)
+    xact_manager.recovery()
+    assert hot_simple_select(relation, pageno, tid) == ()
+    close_relation(table_oid)
+    hot_drop_table('test_recovery_abort')
+
+
+def test_recovery_no_force():
+    table_oid = hot_create_table('test_recovery_no_force', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    buffer_manager = global_vars.buffer_manager
+    relation = open_relation(table_oid)
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    hot_simple_insert(relation, (0, 'on disk'))
+    xact_manager.commit_transaction(xid)
+    # the page is on disk, then it is changed only in the buffer pool
+    xact_manager.checkpoint()
+    old_mode = global_vars.commit_mode
+    global_vars.commit_mode = 'no_force'
+    try:
+        xid = xact_manager.allocate_xid()
+        xact_manager.begin_transaction(xid)
+        for i in range(1, 6):
+            hot_simple_insert(relation, (i, 'no force'))
+        xact_manager.commit_transaction(xid)
+    finally:
+        global_vars.commit_mode = old_mode
+
+    def all_ids():
+        return sorted(python_tuple[0] for python_tuple in hot_simple_select_all(relation))
+
+    # crash: the pages are lost, redo brings the rows back as dirty pages
+    buffer_manager.evict_relation(relation)
+    xact_manager.recovery()
+    assert all_ids() == list(range(6))
+    assert len(buffer_manager.get_dirty_pages(relation)) == 1
+
+    # the checkpoint writes them before moving the redo point past their records
+    xact_manager.checkpoint()
+    buffer_manager.evict_relation(relation)
+    xact_manager.recovery()
+    assert all_ids() == list(range(6))
+    close_relation(table_oid)
+    hot_drop_table('test_recovery_no_force')
+
+
+def test_synchronous_commit_off():
+    table_oid = hot_create_table('test_async_commit', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    session_vars.SessionVars.synchronous_commit = 'off'
+    try:
+        xid = xact_manager.allocate_xid()
+        xact_manager.begin_transaction(xid)
+        relation = open_relation(table_oid)
+        hot_simple_insert(relation, (1, 'async'))
+        start_lsn = xact_manager.max_lsn()
+        commit_lsn = xact_manager.commit_transaction(xid)
+        # the WAL writer flushes it soon
+        deadline = time.monotonic() + 5
+        while xact_manager.flushed_lsn() < commit_lsn and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert xact_manager.flushed_lsn() >= commit_lsn
+        # the end of the commit record, not what is written after it
+        commit_record, = [record for record in xact_manager.wal_manager.replay(start_lsn)
+                          if record.xid == xid and record.action == WALAction.COMMIT]
+        assert commit_record.lsn == commit_lsn
+    finally:
+        session_vars.SessionVars.synchronous_commit = None
+    assert xact_manager.synchronous_commit()
+    close_relation(table_oid)
+    hot_drop_table('test_async_commit')
+
+
+def test_parallel_redo():
+    table_oid = hot_create_table('test_redo', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    buffer_manager = global_vars.buffer_manager
+    start_lsn = xact_manager.max_lsn()
+    old_mode = global_vars.commit_mode
+    global_vars.commit_mode = 'no_force'
+    try:
+        xid = xact_manager.allocate_xid()
+        xact_manager.begin_transaction(xid)
+        relation = open_relation(table_oid)
+        locations = [hot_simple_insert(relation, (i, 'x' * 100)) for i in range(300)]
+        for pageno, tid in locations[::3]:
+            hot_simple_update(relation, pageno, tid, (-1, 'y'))
+        for pageno, tid in locations[1::3]:
+            hot_simple_delete(relation, pageno, tid)
+        xact_manager.commit_transaction(xid)
+    finally:
+        global_vars.commit_mode = old_mode
+
+    def all_items():
+        return sorted((pageno, tid, python_tuple) for pageno in range(relation.last_pageno() + 1)
+                      for tid, python_tuple in hot_page_decode(relation, buffer_manager.get_page(relation, pageno)))
+
+    expected = all_items()
+    assert relation.last_pageno() >= 3
+
+    # crash: dirty pages are lost, and redo them from WAL
+    buffer_manager.evict_relation(relation)
+    partitions = {}
+    for record in xact_manager.wal_manager.replay(start_lsn):
+        if record.relation_oid == table_oid:
+            partitions.setdefault((table_oid, record.location[0]), []).append(record)
+    xact_manager.parallel_redo(partitions, workers=4)
+    assert all_items() == expected
+
+    # applied changes are skipped by page LSN
+    xact_manager.parallel_redo(partitions, workers=4)
+    assert all_items() == expected
+    close_relation(table_oid)
+    hot_drop_table('test_redo')
+
+
+def test_multi_insert():
+    table_oid = hot_create_table('test_multi_insert', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    buffer_manager = global_vars.buffer_manager
+    relation = open_relation(table_oid)
+    python_tuples = [(i, 'x' * 100) for i in range(500)]
+
+    start_lsn = xact_manager.max_lsn()
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    locations = hot_multi_insert(relation, python_tuples)
+    xact_manager.commit_transaction(xid)
+    assert [hot_simple_select(relation, pageno, tid) for pageno, tid in locations] == python_tuples
+    # one WAL record per page
+    records = [record for record in xact_manager.wal_manager.replay(start_lsn)
+               if record.relation_oid == table_oid]
+    assert all(record.action == WALAction.HEAP_MULTI_INSERT for record in records)
+    assert len(records) == len({pageno for pageno, _ in locations}) == relation.last_pageno() + 1
+
+    # redo from WAL
+    buffer_manager.evict_relation(relation)
+    partitions = {}
+    for record in records:
+        partitions.setdefault((table_oid, record.location[0]), []).append(record)
+    xact_manager.parallel_redo(partitions)
+    assert [hot_simple_select(relation, pageno, tid) for pageno, tid in locations] == python_tuples
+
+    # undo
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    more_locations = hot_multi_insert(relation, [(i, 'y') for i in range(300)])
+    xact_manager.abort_transaction(xid)
+    assert all(hot_simple_select(relation, pageno, tid) == () for pageno, tid in set(more_locations) - set(locations))
+    assert [hot_simple_select(relation, pageno, tid) for pageno, tid in locations] == python_tuples
+    close_relation(table_oid)
+    hot_drop_table('test_multi_insert')
+
+
+def test_mvcc():
+    table_oid = hot_create_table('test_mvcc', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    relation = open_relation(table_oid)
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    pageno, first_tid = hot_simple_insert(relation, (1, 'a'))
+    _, second_tid = hot_simple_insert(relation, (2, 'b'))
+    xact_manager.commit_transaction(xid)
+
+    writer_xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(writer_xid)
+    # a reader that started after the writer
+    snapshot = xact_manager.get_snapshot()
+    reader = Snapshot(snapshot.xmin, snapshot.xmax, snapshot.xip, xid=0)
+    _, new_tid = hot_simple_insert(relation, (3, 'c'))
+    assert hot_simple_update(relation, pageno, first_tid, (1, 'aa')) == (pageno, first_tid)
+    assert hot_simple_delete(relation, pageno, second_tid)
+
+    # the writer sees its own changes, the reader sees the old versions
+    assert hot_simple_select(relation, pageno, first_tid) == (1, 'aa')
+    assert hot_simple_select(relation, pageno, second_tid) == ()
+    assert hot_simple_select(relation, pageno, new_tid) == (3, 'c')
+    assert hot_simple_select(relation, pageno, first_tid, reader) == (1, 'a')
+    assert hot_simple_select(relation, pageno, second_tid, reader) == (2, 'b')
+    assert hot_simple_select(relation, pageno, new_tid, reader) == ()
+
+    # the first updater wins
+    other_xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(other_xid)
+    try:
+        hot_simple_update(relation, pageno, first_tid, (1, 'x'))
+    except RollbackError:
+        pass
+    else:
+        raise AssertionError()
+    xact_manager.abort_transaction(other_xid)
+
+    xact_manager.set_xid(writer_xid)
+    xact_manager.commit_transaction(writer_xid)
+    assert hot_simple_select(relation, pageno, first_tid, reader) == (1, 'a')
+    assert list(hot_simple_select_all(relation)) == [(1, 'aa'), (3, 'c')]
+
+    # no snapshot can see the deleted tuple now
+    assert vacuum_relation(relation) == 1
+    assert hot_simple_select(relation, pageno, second_tid, reader) == ()
+    close_relation(table_oid)
+    hot_drop_table('test_mvcc')
+
+
+def test_tuple_lock():
+    table_oid = hot_create_table('test_tuple_lock', (('id', 'int', True), ('name', 'text', False)),
+                                 database_oid=OID_DATABASE_ANDB)
+    xact_manager = global_vars.xact_manager
+    relation = open_relation(table_oid)
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    locations = [hot_simple_insert(relation, (i, 'a')) for i in range(2)]
+    xact_manager.commit_transaction(xid)
+
+    xid = xact_manager.allocate_xid()
+    xact_manager.begin_transaction(xid)
+    pageno, tid = locations[0]
+    assert hot_simple_update(relation, pageno, tid, (0, 'b')) == (pageno, tid)
+
+    other_xid = xact_manager.allocate_xid()
+    events = []
+
+    def other_writer():
+        xact_manager.begin_transaction(other_xid)
+        # another row is not blocked
+        xact_manager.lock_tuple(other_xid, table_oid, *locations[1])
+        events.append('locked another row')
+        xact_manager.lock_tuple(other_xid, table_oid, pageno, tid)
+        events.append('locked the same row')
+        xact_manager.commit_transaction(other_xid)
+
+    thread = threading.Thread(target=other_writer)
+    thread.start()
+    time.sleep(0.2)
+    assert events == ['locked another row']
+    xact_manager.set_xid(xid)
+    xact_manager.commit_transaction(xid)
+    thread.join()
+    assert events == ['locked another row', 'locked the same row']
+    assert not xact_manager.is_active(other_xid)
+
+    close_relation(table_oid)
+    hot_drop_table('test_tuple_lock')
@@ -1,5 +1,12 @@
 from andb.constants.values import WAL_SEGMENT_SIZE
+import pytest
+
+from andb.errno.errors import WALError
+from andb.storage.engines.heap.bptree import TuplePointer
 from andb.storage.engines.heap.redo import lsn_to_filename, WALManager, WALRecord, WALAction
+from andb.storage.engines.heap.walpayload import encode_btree_entry, encode_btree_key, encode_tid_list, \
+    encode_checkpoint, decode_payload, decode_checkpoint_xid, decode_checkpoint_running_xids, encode_tuple_list, \
+    decode_tuple_list
 
 
 def test_wal():
@@ -8,6 +15,28 @@ def test_wal():
     assert (lsn_to_filename(WAL_SEGMENT_SIZE * 2 + 1)) == '0000000000000002'
 
 
+def test_wal_payload():
+    key_data, tuple_pointer = decode_payload(WALAction.BTREE_INSERT, encode_btree_entry(b'key', TuplePointer(3, 7)))
+    assert key_data == b'key'
+    assert (tuple_pointer.pageno, tuple_pointer.tid) == (3, 7)
+    assert decode_payload(WALAction.BTREE_DELETE, encode_btree_key(b'key')) == b'key'
+    assert decode_payload(WALAction.HEAP_BATCH_DELETE, encode_tid_list([0, 5, 300])) == [0, 5, 300]
+    assert decode_payload(WALAction.CHECKPOINT, encode_checkpoint(2 ** 40)) == 2 ** 40
+    assert decode_payload(WALAction.CHECKPOINT, b'') is None
+    data = encode_checkpoint(2 ** 40, 9, [3, 2 ** 33])
+    assert decode_payload(WALAction.CHECKPOINT, data) == 2 ** 40
+    assert decode_checkpoint_xid(data) == 9
+    assert decode_checkpoint_running_xids(data) == [3, 2 ** 33]
+    assert decode_checkpoint_running_xids(encode_checkpoint(2 ** 40, 9)) == []
+    assert decode_payload(WALAction.HEAP_INSERT, b'tuple') == b'tuple'
+    # old tuples in the undo record of a batch delete
+    assert decode_tuple_list(encode_tuple_list([b'a', b'', b'xyz'])) == [b'a', b'', b'xyz']
+    # smaller than pickle
+    assert len(encode_btree_entry(b'key', TuplePointer(3, 7))) == 12
+    with pytest.raises(WALError):
+        decode_payload(WALAction.BTREE_DELETE, b'\xffkey')
+
+
 def a_test_wal_manager():
     manager = WALManager()
     iterations = 50000  # 50000
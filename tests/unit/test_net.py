@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from andb.net.client import ClientError, connect
+from andb.net.server import SessionServer
+
+
+def test_session_server():
+    server = SessionServer(port=0, max_connections=4).start()
+    host, port = server.address
+    try:
+        with connect(host, port) as conn:
+            conn.execute('create table test_net (a int, b text)')
+
+        def insert(n):
+            with connect(host, port) as conn:
+                for i in range(10):
+                    conn.execute(f"insert into test_net values ({n * 10 + i}, 'n{n}')")
+
+        threads = [threading.Thread(target=insert, args=(n,)) for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with connect(host, port) as conn:
+            result = conn.execute('select a from test_net')
+            assert sorted(row[0] for row in result.rows) == list(range(30))
+
+            # each session has its own transaction block
+            conn.execute('begin')
+            conn.execute("insert into test_net values (100, 'x')")
+            with connect(host, port) as other:
+                assert len(other.execute('select a from test_net').rows) == 30
+                result = other.execute('commit')
+                assert result.warning == 'there is no transaction in progress'
+            conn.execute('commit')
+            assert len(conn.execute('select a from test_net').rows) == 31
+
+            with pytest.raises(ClientError):
+                conn.execute('selec a from test_net')
+            # an unfinished block is rolled back when the client goes away
+            with connect(host, port) as other:
+                other.execute('begin')
+                other.execute('delete from test_net')
+            # and its row locks are released
+            assert conn.execute('delete from test_net where a = 100').effect_rows == 1
+            assert len(conn.execute('select a from test_net').rows) == 30
+
+        # connections beyond max_connections are refused
+        while server.active_sessions() > 0:
+            time.sleep(0.01)
+        conns = [connect(host, port) for _ in range(4)]
+        with pytest.raises(ClientError, match='too many connections'):
+            connect(host, port)
+        for conn in conns:
+            conn.close()
+    finally:
+        server.stop()
+    assert server.active_sessions() == 0
+
+
+def test_session_server_stress():
+    # more clients than workers, the others wait for a session to end
+    server = SessionServer(port=0, max_connections=8, workers=4).start()
+    host, port = server.address
+    try:
+        with connect(host, port) as conn:
+            conn.execute('create table test_net_stress (a int, b text)')
+            conn.execute('create index test_net_stress_a on test_net_stress (a)')
+
+        errors = []
+
+        def insert(n):
+            try:
+                with connect(host, port) as conn:
+                    for i in range(150):
+                        conn.execute(f"insert into test_net_stress values ({n * 1000 + i}, 'n{n}')")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=insert, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+        expected = sorted(n * 1000 + i for n in range(8) for i in range(150))
+        with connect(host, port) as conn:
+            result = conn.execute('select * from test_net_stress')
+            assert sorted(row[0] for row in result.rows) == expected
+            # every row can be found through the index
+            for a in expected:
+                rows = conn.execute(f'select * from test_net_stress where a = {a}').rows
+                assert rows == [(a, f'n{a // 1000}')]
+    finally:
+        server.stop()
@@ -2,11 +2,18 @@ import os
 import unittest
 from unittest.mock import patch, MagicMock
 import shutil
+import threading
 import time
 
+from andb.catalog.oid import INVALID_OID
 from andb.constants.filename import WAL_DIR, UNDO_DIR
+from andb.constants.values import WAL_SEGMENT_SIZE, UNDO_SEGMENT_SIZE
+from andb.runtime import global_vars
+from andb.storage.engines.heap.bptree import TuplePointer
 from andb.storage.engines.heap.redo import WALManager, WALRecord, WALAction
 from andb.storage.engines.heap.undo import UndoManager, UndoRecord, UndoOperation
+from andb.storage.engines.heap.walwriter import WALWriter
+from andb.storage.engines.heap.walsegment import start_wal_preallocator, stop_wal_preallocator
 
 class TestRedoUndo(unittest.TestCase):
     @classmethod
@@ -154,6 +161,46 @@ class TestRedoUndo(unittest.TestCase):
         # Verify last record is ABORT
         self.assertEqual(undo_records[0].operation, UndoOperation.ABORT)
 
+    def test_undo_segments(self):
+        """Undo records go to shared segments, which are truncated once no
+        running transaction needs them"""
+        btree_record = UndoRecord(self.test_xid, UndoOperation.BTREE_DELETE, self.test_oid,
+                                  (b'key', [TuplePointer(1, 2), TuplePointer(3, 4)]), b'')
+        parsed = UndoRecord.from_bytes(btree_record.to_bytes())
+        self.assertEqual(parsed.location, (b'key', [TuplePointer(1, 2), TuplePointer(3, 4)]))
+        self.assertEqual(parsed.relation, self.test_oid)
+
+        # this one keeps its segment until it ends, even if it has not
+        # flushed anything yet
+        old_xid = 1000
+        self.undo_manager.begin_transaction(old_xid)
+        data = b'x' * (UNDO_SEGMENT_SIZE // 4)
+        for xid in range(1, 13):
+            self.undo_manager.begin_transaction(xid)
+            self.undo_manager.write_record(UndoRecord(
+                xid, UndoOperation.HEAP_UPDATE, self.test_oid, (self.test_pageno, xid), data))
+            self.undo_manager.commit_transaction(xid)
+        self.assertGreaterEqual(len(self.undo_manager.list_segments()), 3)
+        self.assertEqual(self.undo_manager.truncate(), 0)
+
+        self.undo_manager.abort_transaction(old_xid)
+        self.assertEqual([r.operation for r in self.undo_manager.parse_record(old_xid)],
+                         [UndoOperation.ABORT, UndoOperation.BEGIN])
+        self.assertGreater(self.undo_manager.truncate(), 0)
+        self.assertEqual(len(self.undo_manager.list_segments()), 1)
+
+    def test_undo_before_data(self):
+        """Records of a page are flushed before the page is written"""
+        self.undo_manager.begin_transaction(self.test_xid)
+        self.undo_manager.write_record(UndoRecord(
+            self.test_xid, UndoOperation.HEAP_INSERT, self.test_oid, (self.test_pageno, self.test_tid), b''))
+        self.undo_manager.flush_page_writers(self.test_oid, self.test_pageno + 1)
+        self.assertEqual(self.undo_manager.list_segments(), [])
+        self.undo_manager.flush_page_writers(self.test_oid, self.test_pageno)
+        self.assertEqual([r.operation for r in self.undo_manager.parse_record(self.test_xid)],
+                         [UndoOperation.HEAP_INSERT, UndoOperation.BEGIN])
+        self.undo_manager.commit_transaction(self.test_xid)
+
     def test_wal_record_splitting(self):
         """Test WAL record splitting when record is too large for single page"""
         # Create a large record that will need splitting
@@ -179,5 +226,122 @@ class TestRedoUndo(unittest.TestCase):
         final_record = replayed_records[-1]
         self.assertEqual(final_record.data, large_data)
 
+    def test_group_commit(self):
+        """Concurrent commits share flushes"""
+        threads_num, commits_per_thread = 8, 10
+
+        def committer(xid):
+            for _ in range(commits_per_thread):
+                self.wal_manager.write_record(WALRecord(
+                    xid=xid, oid=self.test_oid, pageno=self.test_pageno, tid=self.test_tid,
+                    action=WALAction.HEAP_INSERT, data=self.test_data))
+                self.wal_manager.write_record(WALRecord(
+                    xid=xid, oid=0, pageno=0, tid=0, action=WALAction.COMMIT, data=b''))
+
+        old_delay, old_siblings = global_vars.commit_delay, global_vars.commit_siblings
+        global_vars.commit_delay, global_vars.commit_siblings = 1000, 0
+        try:
+            threads = [threading.Thread(target=committer, args=(xid,)) for xid in range(1, threads_num + 1)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            global_vars.commit_delay, global_vars.commit_siblings = old_delay, old_siblings
+
+        self.assertEqual(self.wal_manager.flush_lsn, self.wal_manager.write_lsn)
+        self.assertLess(self.wal_manager.group_flushes, threads_num * commits_per_thread)
+        commits = [r for r in WALManager.replay(0) if r.action == WALAction.COMMIT]
+        self.assertEqual(len(commits), threads_num * commits_per_thread)
+
+    def test_asynchronous_commit(self):
+        """Asynchronous commits are flushed by the WAL writer"""
+        def write_commit():
+            self.wal_manager.write_record(WALRecord(
+                xid=self.test_xid, oid=self.test_oid, pageno=self.test_pageno, tid=self.test_tid,
+                action=WALAction.HEAP_INSERT, data=self.test_data))
+            self.wal_manager.write_record(WALRecord(
+                xid=self.test_xid, oid=0, pageno=0, tid=0, action=WALAction.COMMIT, data=b''),
+                asynchronous=True)
+
+        # flush on the interval
+        wal_writer = WALWriter(self.wal_manager, delay=0.05, flush_after=1024 * 1024)
+        self.wal_manager.wal_writer = wal_writer
+        write_commit()
+        self.assertLess(self.wal_manager.flush_lsn, self.wal_manager.write_lsn)
+        wal_writer.start()
+        try:
+            deadline = time.monotonic() + 5
+            while self.wal_manager.flush_lsn < self.wal_manager.write_lsn and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.wal_manager.flush_lsn, self.wal_manager.write_lsn)
+
+            # flush on the byte threshold, long before the interval
+            wal_writer.delay = 60
+            wal_writer.flush_after = 1
+            time.sleep(0.1)
+            write_commit()
+            deadline = time.monotonic() + 5
+            while self.wal_manager.flush_lsn < self.wal_manager.write_lsn and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.wal_manager.flush_lsn, self.wal_manager.write_lsn)
+        finally:
+            self.wal_manager.wal_writer = None
+            wal_writer.stop()
+        commits = [r for r in WALManager.replay(0) if r.action == WALAction.COMMIT]
+        self.assertEqual(len(commits), 2)
+
+    def test_wal_buffer_ring(self):
+        """Records wrap around the WAL buffer many times, and split records
+        cross pages"""
+        sizes = [i * 97 % 8000 for i in range(200)]
+        for i, size in enumerate(sizes):
+            self.wal_manager.write_record(WALRecord(
+                xid=i, oid=self.test_oid, pageno=self.test_pageno, tid=self.test_tid,
+                action=WALAction.HEAP_INSERT, data=bytes([i % 256]) * size))
+        self.wal_manager.flush(self.wal_manager.max_lsn())
+        self.assertGreater(self.wal_manager.flush_lsn, len(self.wal_manager.wal_buffer) * 3)
+
+        replayed_records = list(WALManager.replay(0))
+        self.assertEqual(len(replayed_records), len(sizes))
+        for i, record in enumerate(replayed_records):
+            self.assertEqual(record.xid, i)
+            self.assertEqual(record.data, bytes([i % 256]) * sizes[i])
+
+    def test_wal_segment_recycling(self):
+        """Preallocated and recycled segments are not taken as WAL"""
+        # the preallocator of the running database would create segments here too
+        preallocator = global_vars.wal_preallocator_worker
+        stop_wal_preallocator()
+        try:
+            segment_manager = self.wal_manager.segment_manager
+            self.assertEqual(segment_manager.preallocate(-1, 3), 3)
+            self.assertEqual(segment_manager.list_segments(), [0, 1, 2])
+            for i in range(100):
+                self.wal_manager.write_record(WALRecord(
+                    xid=i, oid=self.test_oid, pageno=self.test_pageno, tid=self.test_tid,
+                    action=WALAction.HEAP_INSERT, data=b'x' * 500))
+            self.wal_manager.flush(self.wal_manager.max_lsn())
+            self.assertEqual(len(list(WALManager.replay(0))), 100)
+
+            # WAL goes on at segment 3, so segments 0-2 are obsolete
+            segment_manager.recycle(3 * WAL_SEGMENT_SIZE, current_segno=3, max_future_segments=1)
+            self.assertEqual(segment_manager.list_segments(), [4])
+            self.wal_manager.set_lsn(4 * WAL_SEGMENT_SIZE)
+            self.wal_manager.write_record(WALRecord(
+                xid=200, oid=INVALID_OID, pageno=0, tid=0, action=WALAction.COMMIT, data=b''))
+            # old records of the recycled segment are behind
+            replayed_records = list(WALManager.replay(4 * WAL_SEGMENT_SIZE))
+            self.assertEqual([r.xid for r in replayed_records], [200])
+
+            usage = self.wal_manager.segment_usage()
+            self.assertEqual(usage['segments'], 1)
+            self.assertEqual(usage['disk_usage'], WAL_SEGMENT_SIZE)
+            self.assertEqual((usage['recycled_segments'], usage['removed_segments']), (1, 2))
+        finally:
+            if preallocator is not None:
+                start_wal_preallocator()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -112,3 +112,11 @@ def test_ddl():
 def test_checkpoint():
     assert_parsing("CHECKPOINT",
                    "<Command command=CHECKPOINT>")
+
+
+def test_transaction():
+    assert_parsing("BEGIN", "<TransactionStmt action=BEGIN>")
+    assert_parsing("start transaction", "<TransactionStmt action=BEGIN>")
+    assert_parsing("COMMIT", "<TransactionStmt action=COMMIT>")
+    assert_parsing("END", "<TransactionStmt action=COMMIT>")
+    assert_parsing("ROLLBACK", "<TransactionStmt action=ROLLBACK>")
@@ -1,5 +1,12 @@
+import threading
+import time
+
 from andb.errno.errors import BufferOverflow
-from andb.common.replacement import LRUCache
+from andb.common.replacement import LRUCache, REPLACEMENT_POLICIES, create_cache
+from andb.catalog.oid import OID_DATABASE_ANDB
+from andb.runtime import global_vars
+from andb.storage.engines.heap.relation import hot_create_table, hot_drop_table, open_relation, close_relation
+from andb.storage.lock.lwlock import SharedExclusiveLatch
 
 
 def test_lrucache():
@@ -44,4 +51,117 @@ def test_lrucache():
     assert len(list(cache.items())) == 0
 
 
+def test_replacement_policies():
+    for policy in REPLACEMENT_POLICIES:
+        cache = create_cache(policy, 4)
+        for i in range(4):
+            cache.put(i, str(i))
+        assert cache.get(0) == '0'
+        assert cache.get(10) is None
+        cache.pin(0)
+        assert cache.is_pinned(0)
+        for i in range(4, 20):
+            cache.put(i, str(i))
+        # the pinned one is never evicted
+        assert cache.get(0) == '0'
+        assert len(cache) == 4
+        assert len(cache.get_evicted_list()) == 16
+        assert all(isinstance(v, str) for v in cache.get_evicted_list())
+        stats = cache.get_stats()
+        assert stats['evictions'] == 16
+        assert stats['hits'] == 2 and stats['misses'] == 1
+
+        for i in range(1, 20):
+            cache.pop(i)
+        cache.put(1, '1', pinned=True)
+        cache.put(2, '2', pinned=True)
+        cache.put(3, '3', pinned=True)
+        try:
+            cache.put(4, '4', pinned=True)
+        except BufferOverflow:
+            pass
+        else:
+            raise AssertionError(policy)
+        assert cache.get(4) is None
+        cache.unpin(3)
+        cache.put(4, '4')
+        assert cache.get(4) == '4'
+        assert cache.pop(4) == '4'
+        assert not cache.is_pinned(4)
+        cache.clear()
+        assert len(list(cache.items())) == 0
+
+
+def test_scan_resistance():
+    # clock sweep only resists scans that the usage counts of the hot set can
+    # bear, and 2q promotes a page after it comes back from the ghost queue
+    for policy, other_pages, scan_length in (('lru', 0, 100), ('clock_sweep', 0, 100),
+                                             ('2q', 16, 1000), ('arc', 16, 1000)):
+        cache = create_cache(policy, 64)
+        # the hot set is used repeatedly among other pages
+        for round_ in range(5):
+            for i in range(16):
+                if cache.get(('hot', i)) is None:
+                    cache.put(('hot', i), i)
+            for i in range(other_pages):
+                cache.put(('other', round_, i), i)
+        # then a large scan comes
+        for i in range(scan_length):
+            if cache.get(('scan', i)) is None:
+                cache.put(('scan', i), i)
+        hot_pages = sum(1 for i in range(16) if cache.get(('hot', i)) == i)
+        assert hot_pages == (0 if policy == 'lru' else 16), policy
+
+
 test_lrucache()
+
+
+def test_shared_exclusive_latch():
+    latch = SharedExclusiveLatch()
+    events = []
+
+    def write():
+        with latch:
+            events.append('write')
+
+    with latch.shared():
+        with latch.shared():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.1)
+            # readers block the writer
+            assert events == []
+    writer.join()
+    assert events == ['write']
+
+    # the writer may read and write again
+    with latch:
+        with latch.shared():
+            with latch:
+                pass
+    def read():
+        with latch.shared():
+            events.append('read')
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    reader.join()
+    assert events == ['write', 'read']
+
+
+def test_buffer_pin_count():
+    table_oid = hot_create_table('test_buffer_pin_count', (('id', 'int', True),), database_oid=OID_DATABASE_ANDB)
+    relation = open_relation(table_oid)
+    buffer_manager = global_vars.buffer_manager
+    buffer_page = buffer_manager.get_page(relation, 0, pin=True)
+    buffer_manager.pin_page(buffer_page)
+    assert buffer_page.pin_count == 2
+    buffer_manager.unpin_page(buffer_page)
+    # still pinned by the other one
+    assert buffer_manager.is_pinned(buffer_page)
+    buffer_manager.unpin_page(buffer_page)
+    assert not buffer_manager.is_pinned(buffer_page)
+    assert buffer_manager.lookup_page(relation, 0) is buffer_page
+    assert buffer_manager.get_stats()['hits'] >= 0
+    close_relation(table_oid)
+    hot_drop_table('test_buffer_pin_count')
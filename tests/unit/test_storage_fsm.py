@@ -0,0 +1,32 @@
+from andb.constants.values import PAGE_SIZE
+from andb.storage.engines.heap.fsm import FreeSpaceMap, FSM_CATEGORY_SIZE, INVALID_PAGENO
+
+
+def test_free_space_map(tmp_path):
+    filename = str(tmp_path / 'test_fsm')
+    fsm = FreeSpaceMap(filename)
+    assert fsm.get_page_with_free_space(100) == INVALID_PAGENO
+
+    fsm.record_free_space(0, 10)
+    fsm.record_free_space(3, 1000)
+    fsm.record_free_space(5, PAGE_SIZE)
+    assert len(fsm) == 6
+    assert fsm.get_free_space(3) == 1000 // FSM_CATEGORY_SIZE * FSM_CATEGORY_SIZE
+    assert fsm.get_free_space(4) == 0
+    assert fsm.get_page_with_free_space(990) == 3
+    # never promise more than recorded
+    assert fsm.get_page_with_free_space(1000) == 5
+    # the search continues from the last found page
+    assert fsm.get_page_with_free_space(10) == 5
+    # no page can hold more than a page
+    assert fsm.get_page_with_free_space(PAGE_SIZE * 2) == INVALID_PAGENO
+    fsm.record_free_space(5, 0)
+    assert fsm.get_page_with_free_space(1000) == INVALID_PAGENO
+    assert fsm.get_page_with_free_space(10) == 3
+
+    for pageno in range(len(fsm)):
+        fsm.persist(pageno)
+    fsm.close()
+    reloaded = FreeSpaceMap(filename)
+    assert reloaded.categories == fsm.categories
+    reloaded.close()
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from andb.storage.lock import rlock
+
+
+def _in_thread(target, *args):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(target(*args)))
+    thread.start()
+    return thread, results
+
+
+def test_lock_conflicts():
+    assert not rlock.lock_conflicts(rlock.ACCESS_SHARE_LOCK, rlock.ROW_EXCLUSIVE_LOCK)
+    assert not rlock.lock_conflicts(rlock.ROW_EXCLUSIVE_LOCK, rlock.ROW_EXCLUSIVE_LOCK)
+    assert rlock.lock_conflicts(rlock.ROW_EXCLUSIVE_LOCK, rlock.SHARE_LOCK)
+    assert not rlock.lock_conflicts(rlock.SHARE_LOCK, rlock.SHARE_LOCK)
+    assert rlock.lock_conflicts(rlock.SHARE_UPDATE_EXCLUSIVE_LOCK, rlock.SHARE_UPDATE_EXCLUSIVE_LOCK)
+    assert rlock.lock_conflicts(rlock.ACCESS_SHARE_LOCK, rlock.ACCESS_EXCLUSIVE_LOCK)
+    for mode1 in range(1, rlock.MAX_LOCK_MODE + 1):
+        for mode2 in range(1, rlock.MAX_LOCK_MODE + 1):
+            assert rlock.lock_conflicts(mode1, mode2) == rlock.lock_conflicts(mode2, mode1)
+
+
+def test_lock_wait_queue():
+    tag = 'test_lock_wait_queue'
+    assert rlock.lock_acquire(tag, rlock.ROW_EXCLUSIVE_LOCK, False, 0) == rlock.LOCK_OK
+    # the owner is not blocked by itself
+    assert rlock.lock_acquire(tag, rlock.ACCESS_EXCLUSIVE_LOCK, False, 0) == rlock.LOCK_OK
+    assert rlock.lock_release(tag, rlock.ACCESS_EXCLUSIVE_LOCK)
+
+    # others are
+    thread, results = _in_thread(rlock.lock_acquire, tag, rlock.SHARE_LOCK, True, 0)
+    thread.join()
+    assert results == [rlock.LOCK_NOT_AVAILABLE]
+    thread, results = _in_thread(rlock.lock_acquire, tag, rlock.SHARE_LOCK, False, 0.1)
+    thread.join()
+    assert results == [rlock.LOCK_NOT_AVAILABLE]
+
+    def acquire_and_release(mode):
+        rc = rlock.lock_acquire(tag, mode, False, 5)
+        order.append(mode)
+        rlock.lock_release(tag, mode)
+        return rc
+
+    # a later ACCESS_SHARE does not overtake the waiting ACCESS_EXCLUSIVE
+    order = []
+    exclusive, exclusive_results = _in_thread(acquire_and_release, rlock.ACCESS_EXCLUSIVE_LOCK)
+    time.sleep(0.1)
+    shared, shared_results = _in_thread(acquire_and_release, rlock.ACCESS_SHARE_LOCK)
+    time.sleep(0.1)
+    assert order == []
+    assert rlock.lock_release(tag, rlock.ROW_EXCLUSIVE_LOCK)
+    assert not rlock.lock_release(tag, rlock.ROW_EXCLUSIVE_LOCK)
+    exclusive.join()
+    shared.join()
+    assert order == [rlock.ACCESS_EXCLUSIVE_LOCK, rlock.ACCESS_SHARE_LOCK]
+    assert exclusive_results == shared_results == [rlock.LOCK_OK]
+
+
+def test_deadlock_detection():
+    tag1, tag2 = 'test_deadlock_1', 'test_deadlock_2'
+    assert rlock.lock_acquire(tag1, rlock.ACCESS_EXCLUSIVE_LOCK, False, 0) == rlock.LOCK_OK
+    tag2_locked = threading.Event()
+
+    def lock_both():
+        rlock.lock_acquire(tag2, rlock.ACCESS_EXCLUSIVE_LOCK, False, 0)
+        tag2_locked.set()
+        rc = rlock.lock_acquire(tag1, rlock.ACCESS_SHARE_LOCK, False, 0)
+        rlock.lock_release(tag1, rlock.ACCESS_SHARE_LOCK)
+        rlock.lock_release(tag2, rlock.ACCESS_EXCLUSIVE_LOCK)
+        return rc
+
+    thread, results = _in_thread(lock_both)
+    tag2_locked.wait()
+    time.sleep(0.1)
+    assert rlock.check_deadlock() == 0
+    detector = threading.Timer(0.1, rlock.check_deadlock)
+    detector.start()
+    # both wait for each other, the later waiter is canceled
+    assert rlock.lock_acquire(tag2, rlock.ACCESS_SHARE_LOCK, False, 0) == rlock.LOCK_DEADLOCK
+    detector.join()
+    assert rlock.lock_release(tag1, rlock.ACCESS_EXCLUSIVE_LOCK)
+    thread.join()
+    assert results == [rlock.LOCK_OK]
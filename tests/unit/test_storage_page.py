@@ -149,3 +149,81 @@ def test_page():
     fixture_page_delete(page0)
     fixture_page_update(page0)
     fixture_pack_and_unpack(page0)
+
+
+def test_page_buffer():
+    buffer = bytearray(PAGE_SIZE)
+    page = SlotPage.allocate(0, buffer=buffer)
+    # fill the page up, every item is written into the given buffer in place
+    data = b'0123456789'
+    count = 0
+    while page.insert(count, data) != INVALID_ITEM_ID:
+        count += 1
+    assert page.free_space_size() < len(data) + ItemIdData.BYTES
+    assert page.item_count == count
+    assert page.buffer is buffer
+    assert page.pack() == bytes(buffer)
+    assert SlotPage(bytearray(page.pack())) == page
+    assert bytes(page.select_view(count - 1)) == page.select(count - 1) == data
+
+    assert page.delete_inplace(count, 0)
+    assert page.item_count == count - 1
+    assert page.free_space_size() >= len(data) + ItemIdData.BYTES
+    assert page.header.size() + page.free_space_size() + page.item_data_size() + page.item_ids_size() == PAGE_SIZE
+    assert page.select(count - 2) == data
+
+
+def test_page_overwrite():
+    page = SlotPage.allocate(0)
+    data = b'0123456789'
+    count = 0
+    while page.insert(count, data) != INVALID_ITEM_ID:
+        count += 1
+    # shorter and equal data are put in place
+    assert page.overwrite(count, 1, b'abc')
+    assert page.select(1) == b'abc'
+    assert page.overwrite(count, 1, b'xyz')
+    assert page.select(1) == b'xyz'
+    # dead items cannot be overwritten
+    assert page.delete(count, 2)
+    assert not page.overwrite(count, 2, data)
+    # a longer one compacts the page to use the hole left by the shrunk one
+    assert not page.overwrite(count, 3, data * 3)
+    assert page.overwrite(count, 3, data + b'0123456')
+    assert page.select(3) == data + b'0123456'
+    assert page.item_count == count
+    for idx in range(count):
+        if idx not in (1, 2, 3):
+            assert page.select(idx) == data
+    assert page.select(1) == b'xyz'
+    assert page.select(2) == INVALID_BYTES
+    # the dead item is still there and can be rolled back
+    assert page.rollback_delete(count, 2)
+    assert page.select(2) == data
+    assert not page.overwrite(count, count, data)
+
+
+def test_page_prune():
+    page = SlotPage.allocate(0)
+    for i in range(5):
+        assert page.insert(0, b'item%d' % i) == i
+    free_space_size = page.free_space_size()
+    assert page.delete(1, 1)
+    assert page.delete(1, 4)
+    assert page.dead_item_count() == 2
+    assert page.prune(2) == 2
+    assert page.dead_item_count() == 0
+    assert page.header.lsn == 2
+    # the trailing item id is truncated, the others keep their ids
+    assert page.item_count == 4
+    assert page.get_item_id(1)[1] == ItemIdFlags.UNUSED
+    for idx in (0, 2, 3):
+        assert page.select(idx) == b'item%d' % idx
+    assert page.select(1) == INVALID_BYTES
+    assert page.free_space_size() == free_space_size + 2 * len(b'item0') + ItemIdData.BYTES
+    # the unused item id is reused first
+    assert page.insert(3, b'new') == 1
+    assert page.select(1) == b'new'
+    assert page.insert(3, b'next') == 4
+    assert page.prune(4) == 0
+    assert page.item_count == 5